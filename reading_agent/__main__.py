@@ -1,19 +1,26 @@
 import argparse
+import inspect
 import json
 import logging
 import os
+import sys
+import time
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 
-import gradio as gr
-from gradio_pdf import PDF
-from dotenv import load_dotenv
+# gradio and the backend SDKs are imported on first use, so the CLI and headless commands start without them
+_start = time.perf_counter()
 
-from reading_agent.agent import Agent
-from reading_agent.pdf_extractor import AzureDocumentIntelligenceExtractor
-from reading_agent.utils import encode_gists, encode_pages, decode_gists, decode_pages, decode_paragraphs, encode_paragraphs
-
-load_dotenv()
+from reading_agent.agent import Agent, GistTree, LookupStrategySelector
+from reading_agent.artifacts import ArtifactStore
+from reading_agent.document import Document
+from reading_agent.retrieval import RetrievalIndex
+from reading_agent.backends.cache import CachedBackend, ResponseCache
+from reading_agent.backends.registry import BACKEND_NAMES, get_backend
+from reading_agent.metrics import tracer
+from reading_agent.pdf_extractor import AzureDocumentIntelligenceExtractor, PdfiumTextExtractor
+from reading_agent.utils import (encode_gists, encode_pages, decode_gists, decode_pages, decode_paragraphs,
+                                 encode_paragraphs, document_id)
 
 
 def init_logger(level: str):
@@ -39,43 +46,112 @@ def init_logger(level: str):
 
 def exception_handling(logger=None):
     def exception_handling_wrapping(func):
+        if inspect.isgeneratorfunction(func):
+            def generator_wrapper(*args, **kwargs):
+                try:
+                    yield from func(*args, **kwargs)
+                except Exception as exc:
+                    import gradio as gr
+                    raise gr.Error(f"{exc}") from None
+            return generator_wrapper
+
         def wrapper(*args, **kwargs):
             try:
                 return func(*args, **kwargs)
             except Exception as exc:
+                import gradio as gr
                 raise gr.Error(f"{exc}") from None
         return wrapper
     return exception_handling_wrapping
 
 
-def get_backend(backend_name):
-    if backend_name == "gpt":
-        from readagent.backends.chatgpt import GPTBackend
-        return GPTBackend()
-    elif backend_name == "gemini":
-        from readagent.backends.gemini import GeminiBackend
-        return GeminiBackend()
-    elif backend_name == "haiku":
-        from readagent.backends.bedrock import Claude3Backend
-        return Claude3Backend()
-    else:
-        raise ValueError("Unknown backend")
-
-
 def parse_cli_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--logging_level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="DEBUG")
     parser.add_argument("--server_name", default=None, type=str)
     parser.add_argument("--server_port", default=None, type=int)
+    parser.add_argument("--extractor", choices=["azure", "pdfium"], default="azure",
+                        help="pdfium reads the PDF text layer locally and only sends pages without text to Azure")
+    parser.add_argument("--pagination_workers", default=1, type=int)
+    parser.add_argument("--gisting_workers", default=4, type=int)
+    parser.add_argument("--llm_cache_path", default=None, type=str,
+                        help="SQLite file caching backend responses, disabled if not given")
+    parser.add_argument("--llm_cache_ttl", default=None, type=float, help="seconds a cached response stays valid")
+    parser.add_argument("--llm_cache_max_entries", default=100_000, type=int)
+    parser.add_argument("--artifact_dir", default=None, type=str,
+                        help="directory keeping extracted paragraphs, pages and gists per document, disabled if not given")
+    parser.add_argument("--metrics_jsonl", default=None, type=str, help="file every span is appended to")
+    parser.add_argument("--metrics_port", default=None, type=int, help="port serving Prometheus metrics on /metrics")
+    parser.add_argument("--lookup_strategy", choices=["parallel", "sequential", "auto"], default="parallel",
+                        help="auto reads pages one at a time when the document is small and its measured cost fits")
+    parser.add_argument("--index_top_k", default=None, type=int,
+                        help="show the model only the gists of the k pages the retrieval index ranks best, "
+                             "and an outline of the others, disabled if not given")
+    parser.add_argument("--hierarchical_lookup_pages", default=None, type=int,
+                        help="documents with more pages are looked up through section gists, as are documents "
+                             "whose gists do not fit the context window whether given or not")
+    parser.add_argument("--full_reread", action="store_true",
+                        help="paginate and gist all paragraphs again when reading edited paragraphs, instead of only "
+                             "the pages the edits touch")
+    parser.add_argument("--gist_tree_branching", default=8, type=int, help="gists summarised by one section gist")
+    subparsers = parser.add_subparsers(dest="command")
+    ingest_parser = subparsers.add_parser("ingest", help="extract, paginate and gist every PDF of a directory")
+    ingest_parser.add_argument("directory", type=str)
+    ingest_parser.add_argument("--backend", choices=BACKEND_NAMES, default="gpt")
+    ingest_parser.add_argument("--document_workers", default=2, type=int, help="documents processed concurrently")
+    ingest_parser.add_argument("--summary_path", default=None, type=str,
+                               help="defaults to ingest_summary.json in the directory")
+    ingest_parser.add_argument("--cost_per_1k_tokens", default=0.0, type=float)
+    serve_parser = subparsers.add_parser("serve", help="serve extraction, reading and questions as an async HTTP API")
+    serve_parser.add_argument("--host", default="127.0.0.1", type=str)
+    serve_parser.add_argument("--port", default=8000, type=int)
+    serve_parser.add_argument("--max_concurrent_llm_calls", default=16, type=int,
+                              help="backend calls in flight at once over all requests")
     return parser.parse_args()
 
 
+def run_ingest(cli_args, pdf_extractor, response_cache):
+    from reading_agent.ingest import Ingestor
+    artifact_dir = cli_args.artifact_dir or os.path.join(cli_args.directory, ".artifacts")
+    ingestor = Ingestor(
+        pdf_extractor, get_backend(cli_args.backend, response_cache), ArtifactStore(artifact_dir),
+        document_workers=cli_args.document_workers, pagination_workers=cli_args.pagination_workers,
+        gisting_workers=cli_args.gisting_workers,
+    )
+    ingestor(cli_args.directory, summary_path=cli_args.summary_path, cost_per_1k_tokens=cli_args.cost_per_1k_tokens)
+
+
+def run_server(cli_args, pdf_extractor, response_cache):
+    from reading_agent.server import ReadingService, serve
+    service = ReadingService(
+        ArtifactStore(cli_args.artifact_dir or ".artifacts"), pdf_extractor, response_cache,
+        max_concurrent_calls=cli_args.max_concurrent_llm_calls, pagination_workers=cli_args.pagination_workers,
+        gisting_workers=cli_args.gisting_workers, index_top_k=cli_args.index_top_k,
+    )
+    serve(service, host=cli_args.host, port=cli_args.port)
+
+
 if __name__ == "__main__":
     cli_args = parse_cli_args()
     init_logger(cli_args.logging_level)
     default_logger = logging.getLogger("reading_agent")
+    from dotenv import load_dotenv
+    load_dotenv()
     agent = Agent()
-    pdf_extractor = AzureDocumentIntelligenceExtractor()
+    pdf_extractor = PdfiumTextExtractor() if cli_args.extractor == "pdfium" else AzureDocumentIntelligenceExtractor()
+    response_cache = ResponseCache(
+        cli_args.llm_cache_path, ttl_seconds=cli_args.llm_cache_ttl, max_entries=cli_args.llm_cache_max_entries
+    ) if cli_args.llm_cache_path else None
+    tracer.jsonl_path = cli_args.metrics_jsonl
+    if cli_args.metrics_port is not None:
+        tracer.serve(cli_args.metrics_port)
+    if cli_args.command == "ingest":
+        run_ingest(cli_args, pdf_extractor, response_cache)
+        sys.exit(0)
+    if cli_args.command == "serve":
+        run_server(cli_args, pdf_extractor, response_cache)
+        sys.exit(0)
+    artifact_store = ArtifactStore(cli_args.artifact_dir) if cli_args.artifact_dir else None
 
     paragraphs_memory_temporary_file = NamedTemporaryFile(delete=False, prefix="paragraphs_", suffix=".json")
     paragraphs_memory_temporary_filename = paragraphs_memory_temporary_file.name
@@ -84,12 +160,65 @@ if __name__ == "__main__":
     pages_memory_temporary_file = NamedTemporaryFile(delete=False, prefix="pages_", suffix=".json")
     pages_memory_temporary_filename = pages_memory_temporary_file.name
 
-    def chat(message, history, gists_raw, pages_raw, backend_name):
-        gists = encode_gists(gists_raw)
-        pages = encode_pages(pages_raw)
-        backend = get_backend(backend_name)
-        response = agent.parallel_lookup(gists, pages, message, backend)
-        return response
+    import gradio as gr
+    from gradio_pdf import PDF
+
+    gist_trees = {}
+    indexes = {}
+    lookup_strategy_selector = LookupStrategySelector()
+
+    def get_index(gists, pages):
+        doc_id = document_id(gists)
+        if doc_id not in indexes:
+            indexes[doc_id] = agent.build_index(pages, gists)
+        return indexes[doc_id]
+
+    def get_gist_tree(gists, backend):
+        key = ArtifactStore.gist_tree_key(gists, backend, cli_args.gist_tree_branching)
+        if key not in gist_trees:
+            artifact = artifact_store.load("gist_tree", key) if artifact_store is not None else None
+            if artifact is None:
+                tree = agent.gist_tree(gists, backend, branching=cli_args.gist_tree_branching,
+                                       max_workers=cli_args.gisting_workers)
+                artifact = {"branching": tree.branching, "levels": tree.levels}
+                if artifact_store is not None:
+                    artifact_store.save("gist_tree", key, artifact)
+            gist_trees[key] = GistTree(**artifact)
+        return gist_trees[key]
+
+    def document_from_views(gists_raw, pages_raw):
+        """Document of the gists and pages shown, None if they are empty or cannot be parsed."""
+        if not gists_raw or not pages_raw:
+            return None
+        try:
+            return Document.from_pages(encode_pages(pages_raw), encode_gists(gists_raw))
+        except (IndexError, ValueError, SyntaxError) as e:
+            default_logger.warning(f"[Document] Cannot parse gists and pages: {e}")
+            return None
+
+    def chat(message, history, gists_raw, pages_raw, backend_name, document):
+        if document is None:
+            # the views have not been turned into a document yet, e.g. while still reading
+            document = Document.from_pages(encode_pages(pages_raw), encode_gists(gists_raw))
+        gists, pages = document.gists, document.pages
+        backend = get_backend(backend_name, response_cache)
+        response = ""
+        # the id of the paragraphs, as when reading, so both are reported under the same document
+        with tracer.document(document_id(document.paragraphs)):
+            if cli_args.hierarchical_lookup_pages is not None and len(pages) > cli_args.hierarchical_lookup_pages \
+                    or not agent.memory_fits(gists, backend, message):
+                deltas = agent.stream_hierarchical_lookup(get_gist_tree(gists, backend), pages, message, backend)
+            elif cli_args.lookup_strategy != "parallel":
+                strategy = lookup_strategy_selector if cli_args.lookup_strategy == "auto" else cli_args.lookup_strategy
+                deltas = agent.stream_lookup(gists, pages, message, backend, strategy=strategy)
+            elif cli_args.index_top_k is not None:
+                deltas = agent.stream_parallel_lookup(gists, pages, message, backend, index=get_index(gists, pages),
+                                                      top_k=cli_args.index_top_k)
+            else:
+                deltas = agent.stream_parallel_lookup(gists, pages, message, backend)
+        for delta in deltas:
+            response += delta
+            yield response
 
     with gr.Blocks(fill_height=True) as demo:
         # layout
@@ -105,12 +234,15 @@ if __name__ == "__main__":
         with gr.Row():
             gists_view = gr.Textbox(label="Gists", interactive=True, show_copy_button=True)
             pages_view = gr.Textbox(label="Pages", interactive=True, show_copy_button=True)
+        document_state = gr.State(None)
+        # backend the gists of ``document_state`` were read with
+        read_backend_state = gr.State(None)
         with gr.Row():
             gists_upload = gr.UploadButton("Upload gists.json")
             gists_download = gr.DownloadButton("Download gists.json")
             pages_upload = gr.UploadButton("Upload pages.json")
             pages_download = gr.DownloadButton("Download pages.json")
-        gr.ChatInterface(fn=chat, title="Read Agent", additional_inputs=[gists_view, pages_view, backend_dropdown],
+        gr.ChatInterface(fn=chat, title="Read Agent", additional_inputs=[gists_view, pages_view, backend_dropdown, document_state],
                          examples=[["What's the major contribution of this paper?"]])
 
         # callbacks
@@ -124,8 +256,14 @@ if __name__ == "__main__":
         def submit_pdf(pdf_file, paragraphs_raw):
             if pdf_file is not None:
                 pdf_bytes = Path(pdf_file).read_bytes()
-                paragraphs = pdf_extractor(pdf_bytes)
-                return decode_paragraphs(paragraphs)
+                if artifact_store is None:
+                    return decode_paragraphs(pdf_extractor(pdf_bytes))
+                key = ArtifactStore.paragraphs_key(pdf_bytes, pdf_extractor)
+                artifact = artifact_store.load("paragraphs", key)
+                if artifact is None:
+                    artifact = {"paragraphs": pdf_extractor(pdf_bytes)}
+                    artifact_store.save("paragraphs", key, artifact)
+                return decode_paragraphs(artifact["paragraphs"])
             else:
                 return paragraphs_raw
 
@@ -142,15 +280,54 @@ if __name__ == "__main__":
 
 
         @exception_handling(logger=default_logger)
-        def read_paragraphs(paragraphs_raw, backend_name, gists_raw, pages_raw):
+        def read_paragraphs(paragraphs_raw, backend_name, gists_raw, pages_raw, document, read_backend_name):
             if paragraphs_raw is not None and backend_name is not None:
-                backend = get_backend(backend_name)
+                backend = get_backend(backend_name, response_cache)
                 paragraphs = encode_paragraphs(paragraphs_raw)
-                pages = agent.pagination(paragraphs, backend)
-                gists = agent.gisting(pages, backend)
-                return decode_gists(gists), decode_pages(pages)
+                key = None
+                if artifact_store is not None:
+                    key = ArtifactStore.reading_key(paragraphs, backend, max_workers=cli_args.pagination_workers)
+                    artifact = artifact_store.load("reading", key)
+                    if artifact is not None:
+                        if "index" in artifact:
+                            indexes[document_id(artifact["gists"])] = RetrievalIndex.from_artifact(artifact["index"])
+                        document = artifact_store.load_document("reading", key) or Document.from_pages(
+                            artifact["pages"], artifact["gists"])
+                        yield decode_gists(artifact["gists"]), decode_pages(artifact["pages"]), document, backend_name
+                        return
+                doc_id = document_id(paragraphs)
+                edited = document is not None and len(document.pages) and backend_name == read_backend_name \
+                    and 2 * len(set(paragraphs).intersection(document.paragraphs)) >= len(paragraphs)
+                if edited and not cli_args.full_reread:
+                    # paragraphs edited since the last reading, only the pages they touch are read again
+                    with tracer.document(doc_id):
+                        pages, gists = agent.incremental_reading(paragraphs, document.pages, document.gists, backend,
+                                                                 max_workers=cli_args.gisting_workers)
+                elif cli_args.pagination_workers > 1:
+                    with tracer.document(doc_id):
+                        pages = agent.pagination(paragraphs, backend, max_workers=cli_args.pagination_workers)
+                        gists = agent.gisting(pages, backend, max_workers=cli_args.gisting_workers)
+                else:
+                    # show every gist as soon as it is ready while later pages are still being paginated
+                    pages, gists = [], []
+                    with tracer.document(doc_id):
+                        reading = agent.stream_reading(paragraphs, backend, max_workers=cli_args.gisting_workers)
+                    for page, gist in reading:
+                        pages.append(page)
+                        gists.append(gist)
+                        yield decode_gists(gists), decode_pages(pages), None, read_backend_name
+                default_logger.debug(f"[Metrics] document {doc_id}: {tracer.document_summary(doc_id)}")
+                if isinstance(backend.backend, CachedBackend):
+                    default_logger.info(f"LLM cache: {backend.backend.stats()}")
+                with tracer.document(doc_id):
+                    index = indexes[document_id(gists)] = agent.build_index(pages, gists)
+                document = Document.from_pages(pages, gists)
+                if artifact_store is not None:
+                    artifact_store.save("reading", key, {"pages": pages, "gists": gists, "index": index.to_artifact()})
+                    artifact_store.save_document("reading", key, document)
+                yield decode_gists(gists), decode_pages(pages), document, backend_name
             else:
-                return gists_raw, pages_raw
+                yield gists_raw, pages_raw, document, read_backend_name
 
         def on_backend_dropdown_change(backend_name):
             if backend_name is not None:
@@ -186,12 +363,19 @@ if __name__ == "__main__":
         paragraphs_upload.upload(upload_paragraphs, inputs=paragraphs_upload, outputs=paragraph_view)
         paragraphs_download.click(download_paragraphs,  inputs=paragraph_view, outputs=paragraphs_download)
         backend_dropdown.change(on_backend_dropdown_change, inputs=backend_dropdown, outputs=read)
-        read.click(read_paragraphs, inputs=[paragraph_view, backend_dropdown, gists_view, pages_view],
-                   outputs=[gists_view, pages_view])
-        gists_upload.upload(upload_gists, inputs=gists_upload, outputs=gists_view)
+        read.click(read_paragraphs,
+                   inputs=[paragraph_view, backend_dropdown, gists_view, pages_view, document_state, read_backend_state],
+                   outputs=[gists_view, pages_view, document_state, read_backend_state])
+        # gists and pages are only parsed again when the user changes them, not on every question
+        gists_upload.upload(upload_gists, inputs=gists_upload, outputs=gists_view).then(
+            document_from_views, inputs=[gists_view, pages_view], outputs=document_state)
+        gists_view.blur(document_from_views, inputs=[gists_view, pages_view], outputs=document_state)
         gists_download.click(download_gists,  inputs=gists_view, outputs=gists_download)
-        pages_upload.upload(upload_pages, inputs=pages_upload, outputs=pages_view)
+        pages_upload.upload(upload_pages, inputs=pages_upload, outputs=pages_view).then(
+            document_from_views, inputs=[gists_view, pages_view], outputs=document_state)
+        pages_view.blur(document_from_views, inputs=[gists_view, pages_view], outputs=document_state)
         pages_download.click(download_pages,  inputs=pages_view, outputs=pages_download)
+    default_logger.info(f"[Startup] UI ready {time.perf_counter() - _start:.2f}s after import")
     demo.launch(server_name=cli_args.server_name, server_port=cli_args.server_port,
                 auth=None if os.environ.get("DEBUG", 0)
                 else (os.environ["GRADIO_READAGENT_DEFAULT_USERNAME"], os.environ["GRADIO_READAGENT_DEFAULT_PASSWORD"]))
@@ -1,63 +1,347 @@
+import asyncio
+import contextvars
 import logging
-from typing import List
+import queue
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Generator, Hashable, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
 
 from reading_agent.backends.base import BackendBase
-from reading_agent.prompts.lookup import prompt_parallel_lookup_template, prompt_answer_template
+from reading_agent.document import Document, PageArray
+from reading_agent.metrics import submit, traced, tracer
+from reading_agent.prompts.lookup import (prompt_gist_memory_template, prompt_parallel_lookup_template,
+                                          prompt_outline_memory_template, prompt_candidate_pages_template,
+                                          prompt_section_memory_template, prompt_section_lookup_template,
+                                          prompt_sequential_reread_template, prompt_sequential_lookup_template,
+                                          prompt_answer_template, prompt_batch_answer_template,
+                                          parse_sequential_page, parse_batch_answers)
 from reading_agent.prompts.pagination import prompt_pagination_template, parse_pause_point
 from reading_agent.prompts.shorten import prompt_shorten_template
+from reading_agent.retrieval import Embed, RetrievalIndex
+from reading_agent.tokens import TokenEstimator, count_pieces, get_estimator, prompt_tokens
 from reading_agent.utils import count_words, replace_consecutive_newlines
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class LookupResult:
+    """Answer to one question with its own token and latency breakdown."""
+    question: str
+    answer: str
+    page_ids: List[int]
+    lookup_tokens: int = 0
+    answer_tokens: int = 0
+    latency: float = 0.0
+    shared_with: int = 1
+    strategy: str = "parallel"
+
+    @property
+    def token_usage(self) -> int:
+        return self.lookup_tokens + self.answer_tokens
+
+
+@dataclass
+class GistTree:
+    """Page gists at level 0 and, at every level above, gists of ``branching`` consecutive entries below."""
+    branching: int
+    levels: List[List[str]]
+
+    def children(self, level: int, index: int) -> range:
+        """Indices at ``level - 1`` summarised by entry ``index`` of ``level``."""
+        start = index * self.branching
+        return range(start, min(start + self.branching, len(self.levels[level - 1])))
+
+
+_PAGINATION_TEMPLATE_PIECES = count_pieces(prompt_pagination_template.format("", "", ""))
+
+
+@dataclass(frozen=True)
+class PageBudget:
+    """Size of the pagination windows, in words or in word pieces of the token estimate.
+
+    Windows hold ``limit`` of text, paragraphs are labelled as break points once ``start_threshold`` is reached,
+    and a window shorter than ``min_window`` becomes the last page without asking the model. With
+    ``prompt_tokens``, pagination prompts estimated above it by ``estimator`` are cut down to fit.
+    """
+    limit: int
+    start_threshold: int
+    min_window: int
+    unit: str = "words"
+    prompt_tokens: Optional[int] = None
+    estimator: Optional[TokenEstimator] = None
+
+    # gists are assumed to take at most this share of the tokens of their page
+    GIST_RATIO = 0.5
+
+    @classmethod
+    def words(cls, word_limit: int = 600, start_threshold: int = 280) -> "PageBudget":
+        # windows under 350 words end the document, fewer for limits too small to ever reach it
+        return cls(word_limit, start_threshold, min(350, 350 * word_limit // 600))
+
+    @classmethod
+    def for_backend(cls, backend: BackendBase, *keys: Hashable) -> "PageBudget":
+        """Largest pages the pagination and gisting prompts of ``backend`` still fit with.
+
+        A pagination prompt holds the page before, the window and the paragraph after it within the context
+        window, and the gist of a page has to fit the output limit. With ``keys`` identifying the document,
+        pages are sized with the estimator frozen for it, so reading it again gives the same pages.
+        """
+        estimator = get_estimator(backend)
+        if keys:
+            estimator = estimator.frozen(*keys)
+        available = prompt_tokens(backend) - estimator.estimate(prompt_pagination_template)
+        page_tokens = max(1, min(available // 3, int(backend.max_output_tokens / cls.GIST_RATIO)))
+        limit = max(1, estimator.to_pieces(page_tokens))
+        # keep the proportions of the word limits the prompts were written for
+        return cls(limit, limit * 280 // 600, limit * 350 // 600, "pieces", prompt_tokens(backend), estimator)
+
+    @classmethod
+    def resolve(cls, backend: BackendBase, word_limit: Optional[int], start_threshold: Optional[int],
+                *keys: Hashable) -> "PageBudget":
+        """Word limits if any is given, else the token budget of ``backend`` for the document of ``keys``."""
+        if word_limit is None and start_threshold is None:
+            return cls.for_backend(backend, *keys)
+        return cls.words(word_limit or 600, 280 if start_threshold is None else start_threshold)
+
+
+class LookupStrategySelector:
+    """Chooses between parallel and sequential look-up for every question.
+
+    Sequential look-up reads the pages one at a time and re-sends the gist memory on every step, so it is only
+    chosen for documents of at most ``max_sequential_pages`` pages whose expected cost fits ``token_budget``.
+    The cost of each strategy is tracked as tokens per word of gist memory, a moving average of the look-ups
+    reported through ``observe``.
+    """
+
+    def __init__(self, token_budget: int = 30000, max_sequential_pages: int = 64, max_steps: int = 5,
+                 smoothing: float = 0.2):
+        self.token_budget = token_budget
+        self.max_sequential_pages = max_sequential_pages
+        self.smoothing = smoothing
+        # priors: the memory is sent twice by parallel look-up and about once per step plus the answer by sequential
+        self.tokens_per_memory_word = {"parallel": 2 * 4 / 3, "sequential": (max_steps / 2 + 1) * 4 / 3}
+        self._lock = threading.Lock()
+
+    def expected_tokens(self, strategy: str, memory_words: int) -> float:
+        with self._lock:
+            return self.tokens_per_memory_word[strategy] * memory_words
+
+    def choose(self, memory_words: int, num_pages: int) -> str:
+        if num_pages <= self.max_sequential_pages and \
+                self.expected_tokens("sequential", memory_words) <= self.token_budget:
+            return "sequential"
+        return "parallel"
+
+    def observe(self, strategy: str, memory_words: int, token_usage: int):
+        # look-ups routed to a gist tree because the memory did not fit are not a choice of the selector
+        if memory_words <= 0 or token_usage <= 0 or strategy not in self.tokens_per_memory_word:
+            return
+        with self._lock:
+            self.tokens_per_memory_word[strategy] += \
+                self.smoothing * (token_usage / memory_words - self.tokens_per_memory_word[strategy])
+
+
 class Agent:
     @staticmethod
+    def _as_document(paragraphs: Union[List[str], Document]) -> Document:
+        return paragraphs if isinstance(paragraphs, Document) else Document.from_paragraphs(paragraphs)
+
+    @staticmethod
+    def _pagination_window(document: Document, i: int, budget: PageBudget, stop: Optional[int] = None,
+                           j: Optional[int] = None) -> Tuple[List[str], str, int, int]:
+        stop = len(document.paragraphs) if stop is None else stop
+        j = document.window_end(i, budget.limit, stop, budget.unit) if j is None else j
+        # paragraphs are labelled once the window has reached ``start_threshold`` with them
+        first_label = max(i + 1, document.window_end(i, budget.start_threshold, j + 1, budget.unit) - 1)
+        passage = [document.paragraphs[i]]
+        for k in range(i + 1, j):
+            if k >= first_label:
+                passage.append(f"<{k}>")
+            passage.append(document.paragraphs[k])
+        passage.append(f"<{j}>")
+        end_tag = "" if j == stop else document.paragraphs[j] + "\n..."
+        return passage, end_tag, j, document.length(i, j, budget.unit)
+
+    @staticmethod
+    def _resolve_pause_point(prompt: str, response: str, i: int, j: int, allow_fallback_to_last: bool) -> int:
+        response = response.strip()
+        pause_point = parse_pause_point(response)
+        if pause_point and (pause_point <= i or pause_point > j):
+            logger.info(f"prompt:\n{prompt},\nresponse:\n{response}\n")
+            logger.info(f"i:{i} j:{j} pause_point:{pause_point}")
+            pause_point = None
+        if pause_point is None:
+            if allow_fallback_to_last:
+                pause_point = j
+            else:
+                raise ValueError(f"prompt:\n{prompt},\nresponse:\n{response}\n")
+        return pause_point
+
+    @staticmethod
+    def _pagination_prompt(document: Document, i: int, previous_page: Optional[Tuple[int, int]],
+                           budget: PageBudget, stop: int) -> Tuple[Optional[str], int]:
+        """Prompt choosing the end of the page starting at paragraph ``i``.
+
+        Returns:
+            Optional[str]: prompt, None if the page ends at the end of the window without asking the model
+            int: end of the window
+        """
+        passage, end_tag, j, length = Agent._pagination_window(document, i, budget, stop)
+        if length < budget.min_window:
+            return None, stop
+        preceding = "" if previous_page is None or previous_page[0] == previous_page[1] \
+            else "...\n" + document.text(*previous_page)
+        while True:
+            if j == i + 1:
+                # a single paragraph fills the window, it can only be a page of its own
+                return None, j
+            if budget.prompt_tokens is None or Agent._pagination_prompt_tokens(
+                document, budget, passage, i, j, previous_page if preceding else None, bool(end_tag)
+            ) <= budget.prompt_tokens:
+                return prompt_pagination_template.format(preceding, '\n'.join(passage), end_tag), j
+            # too long for the model: drop the context, then the paragraph after the window, then shrink it
+            if preceding:
+                preceding = ""
+            elif end_tag:
+                end_tag = ""
+            else:
+                passage, end_tag, j, _ = Agent._pagination_window(document, i, budget, stop, j - 1)
+                end_tag = ""
+
+    @staticmethod
+    def _pagination_prompt_tokens(document: Document, budget: PageBudget, passage: List[str], i: int, j: int,
+                                  previous_page: Optional[Tuple[int, int]], end_tag: bool) -> int:
+        """Token estimate of a pagination prompt, from the piece counts of its paragraphs."""
+        # labels "<k>" are two symbols and the digits of k, and the last labels of the window are the labelled ones
+        labels = range(j + 1 + (j - i) - len(passage), j + 1)
+        pieces = _PAGINATION_TEMPLATE_PIECES + document.length(i, j, "pieces") + \
+            sum(2 + (len(str(k)) + 2) // 3 for k in labels)
+        if previous_page is not None:
+            pieces += 3 + document.length(*previous_page, "pieces")
+        if end_tag:
+            pieces += 3 + document.length(j, j + 1, "pieces")
+        return budget.estimator.from_pieces(pieces)
+
+    @staticmethod
+    def _pagination_step(
+        document: Document,
+        i: int,
+        previous_page: Optional[Tuple[int, int]],
+        backend: BackendBase,
+        budget: PageBudget,
+        allow_fallback_to_last: bool,
+        stop: Optional[int] = None,
+    ) -> Tuple[int, int, bool]:
+        """Choose the end of the page starting at paragraph ``i``.
+
+        Args:
+            previous_page: paragraph range of the page before, shown as context
+
+        Returns:
+            int: pause point (exclusive end of the page)
+            int: token usage
+            bool: whether the backend was queried
+        """
+        stop = len(document.paragraphs) if stop is None else stop
+        prompt, j = Agent._pagination_prompt(document, i, previous_page, budget, stop)
+        if prompt is None:
+            return j, 0, False
+        token_usage, response = backend.query_model(prompt=prompt)
+        return Agent._resolve_pause_point(prompt, response, i, j, allow_fallback_to_last), token_usage, True
+
+    @staticmethod
+    def _paginate_range(
+        document: Document,
+        start: int,
+        stop: int,
+        backend: BackendBase,
+        budget: PageBudget,
+        allow_fallback_to_last: bool,
+        hard_stop: bool = False,
+    ) -> Tuple[List[Tuple[int, bool]], int]:
+        """Serially paginate from ``start`` until a page ends at or after ``stop``.
+
+        With ``hard_stop`` the windows never look past ``stop``, otherwise the last page may run into the
+        paragraphs after it, exactly like the serial algorithm would.
+
+        Returns:
+            List[Tuple[int, bool]]: page ends and whether each one cost a backend call
+            int: token usage
+        """
+        i = start
+        previous_page = None
+        ends = []
+        total_token_used = 0
+        while i < stop:
+            pause_point, token_usage, queried = Agent._pagination_step(
+                document, i, previous_page, backend, budget, allow_fallback_to_last,
+                stop=stop if hard_stop else None
+            )
+            total_token_used += token_usage
+            ends.append((pause_point, queried))
+            previous_page = (i, pause_point)
+            i = pause_point
+        return ends, total_token_used
+
+    @staticmethod
+    @traced("pagination")
     def pagination(
-        paragraphs: List[str],
+        paragraphs: Union[List[str], Document],
         backend: BackendBase,
-        word_limit=600,
-        start_threshold=280,
+        word_limit: Optional[int] = None,
+        start_threshold: Optional[int] = None,
         verbose=True,
-        allow_fallback_to_last=True
+        allow_fallback_to_last=True,
+        max_workers=1,
+        max_divergence: Optional[int] = 0,
     ) -> List[List[str]]:
+        """Split paragraphs into pages at the break points chosen by the model.
 
-        i = 0
-        total_token_used = 0
-        pages = []
-        while i < len(paragraphs):
-            preceding = "" if i == 0 else "...\n" + '\n'.join(pages[-1])
-            passage = [paragraphs[i]]
-            wcount = count_words(paragraphs[i])
-            j = i + 1
-            while wcount < word_limit and j < len(paragraphs):
-                wcount += count_words(paragraphs[j])
-                if wcount >= start_threshold:
-                    passage.append(f"<{j}>")
-                passage.append(paragraphs[j])
-                j += 1
-            passage.append(f"<{j}>")
-            end_tag = "" if j == len(paragraphs) else paragraphs[j] + "\n..."
+        Args:
+            paragraphs: paragraphs of the document, or a ``Document`` to reuse its word counts
+            backend: LLM backend
+            word_limit: number of words shown to the model per window, by default windows are sized to the
+                token budget of ``backend`` instead
+            start_threshold: number of words before the first candidate label
+            verbose: log every page
+            allow_fallback_to_last: break at the end of the window when the response cannot be parsed
+            max_workers: number of shards paginated concurrently, 1 keeps the serial behaviour
+            max_divergence: only used with ``max_workers > 1``. A shard's speculative page boundaries are
+                adopted once the reconciled pagination lands within ``max_divergence`` paragraphs of one of
+                them, 0 requires an exact match. ``None`` turns the shard seams into hard page boundaries
+                and skips reconciliation.
 
-            pause_point = None
-            if wcount < 350:
-                pause_point = len(paragraphs)
-            else:
-                prompt = prompt_pagination_template.format(preceding, '\n'.join(passage), end_tag)
-                token_usage, response = backend.query_model(prompt=prompt)
-                total_token_used += token_usage
-                response = response.strip()
-                pause_point = parse_pause_point(response)
-                if pause_point and (pause_point <= i or pause_point > j):
-                    logger.info(f"prompt:\n{prompt},\nresponse:\n{response}\n")
-                    logger.info(f"i:{i} j:{j} pause_point:{pause_point}")
-                    pause_point = None
-                if pause_point is None:
-                    if allow_fallback_to_last:
-                        pause_point = j
-                    else:
-                        raise ValueError(f"prompt:\n{prompt},\nresponse:\n{response}\n")
+        Returns:
+            List[List[str]]: pages
+        """
+        document = Agent._as_document(paragraphs)
+        budget = PageBudget.resolve(backend, word_limit, start_threshold, document.digest())
+        num_paragraphs = len(document.paragraphs)
+        if max_workers > 1 and num_paragraphs > 1:
+            ends, total_token_used = Agent._parallel_pagination(
+                document, backend, budget, allow_fallback_to_last, max_workers, max_divergence
+            )
+        else:
+            page_ends, total_token_used = Agent._paginate_range(
+                document, 0, num_paragraphs, backend, budget, allow_fallback_to_last
+            )
+            ends = [end for end, _ in page_ends]
 
-            page = paragraphs[i:pause_point]
+        return Agent._pages_from_ends(document, ends, total_token_used, verbose)
+
+    @staticmethod
+    def _pages_from_ends(document: Document, ends: List[int], total_token_used: int, verbose: bool):
+        pages = []
+        i = 0
+        for pause_point in ends:
+            page = document.paragraphs[i:pause_point]
             pages.append(page)
             if verbose:
                 logger.info(f"[Pagination] Paragraph {i}-{pause_point - 1} {page}")
@@ -66,20 +350,263 @@ class Agent:
         return pages
 
     @staticmethod
-    def gisting(pages: List[List[str]], backend: BackendBase, verbose=True):
-        article = '\n'.join([t for p in pages for t in p])
-        word_count = count_words(article)
-        logger.info(f"[Gisting] Document Word Count: {word_count}")
-        shortened_pages = []
+    def _read_window(stream: Iterator[str], paragraphs: List[str], prefix: List[int], i: int,
+                     budget: PageBudget) -> bool:
+        """Read ``stream`` into ``paragraphs`` until they hold the window of the page starting at ``i`` and the
+        paragraph after it, the part of the document its pagination prompt is made of.
+
+        Returns:
+            bool: whether ``stream`` ran out first
+        """
+        count = count_words if budget.unit == "words" else count_pieces
+        while len(paragraphs) <= i or \
+                bisect_left(prefix, prefix[i] + budget.limit, i + 1, len(paragraphs)) >= len(paragraphs):
+            paragraph = next(stream, None)
+            if paragraph is None:
+                return True
+            paragraphs.append(paragraph)
+            prefix.append(prefix[-1] + count(paragraph))
+        return False
+
+    @staticmethod
+    @traced("pagination")
+    def iter_pagination(
+        paragraphs: Union[Iterable[str], Document],
+        backend: BackendBase,
+        word_limit: Optional[int] = None,
+        start_threshold: Optional[int] = None,
+        verbose=True,
+        allow_fallback_to_last=True
+    ) -> Iterator[List[str]]:
+        """Serial ``pagination`` that yields every page as soon as its break point is chosen.
+
+        ``paragraphs`` may also be a stream, like ``extractor.stream(pdf_bytes)``. Every page is then paginated
+        as soon as the paragraphs its prompt is made of are read, while later ones are still being extracted,
+        with the same prompts as once the whole document is known.
+        """
+        stream = None if isinstance(paragraphs, (list, tuple, Document)) else iter(paragraphs)
+        if stream is None:
+            document = Agent._as_document(paragraphs)
+            key = document.digest()
+        else:
+            document = Document.from_paragraphs([])
+            # the document is only known once read, it is sized with a snapshot handed over to it then
+            key = object()
+            read, prefix, exhausted = [], [0], False
+        budget = PageBudget.resolve(backend, word_limit, start_threshold, key)
+        i = 0
         total_token_used = 0
-        for i, page in enumerate(pages):
-            prompt = prompt_shorten_template.format('\n'.join(page))
-            token_usage, response = backend.query_model(prompt)
+        num_pages = 0
+        previous_page = None
+        while True:
+            if stream is not None and not exhausted:
+                exhausted = Agent._read_window(stream, read, prefix, i, budget)
+                if len(read) != len(document.paragraphs):
+                    document = document.extend(read[len(document.paragraphs):])
+                if exhausted and budget.estimator is not None:
+                    get_estimator(backend).frozen(key, document.digest())
+            if i >= len(document.paragraphs):
+                break
+            pause_point, token_usage, _ = Agent._pagination_step(
+                document, i, previous_page, backend, budget, allow_fallback_to_last
+            )
             total_token_used += token_usage
-            shortened_text = replace_consecutive_newlines(response.strip())
-            shortened_pages.append(shortened_text)
+            page = document.paragraphs[i:pause_point]
             if verbose:
-                logger.info(f"[Gisting] page {i}: {shortened_text}")
+                logger.info(f"[Pagination] Paragraph {i}-{pause_point - 1} {page}")
+            num_pages += 1
+            yield page
+            previous_page = (i, pause_point)
+            i = pause_point
+        logger.info(f"[Pagination] Done with {num_pages} pages, token usage: {total_token_used}")
+
+    @staticmethod
+    def _shard_starts(num_paragraphs: int, max_workers: int) -> List[int]:
+        num_shards = min(max_workers, num_paragraphs)
+        return [num_paragraphs * k // num_shards for k in range(num_shards)] + [num_paragraphs]
+
+    @staticmethod
+    def _reconcile_shards(
+        num_paragraphs: int,
+        shard_starts: List[int],
+        shards: List[Tuple[List[Tuple[int, bool]], int]],
+        max_divergence: int,
+    ) -> Generator[Tuple[int, Tuple[int, int]], Tuple[int, int, bool], Tuple[List[int], int]]:
+        """Stitch speculatively paginated shards together.
+
+        Yields the ``(i, previous_page)`` of every page that has to be paginated serially and expects the
+        ``_pagination_step`` result back, so the same reconciliation drives both the sync and the async API.
+
+        Returns:
+            List[int]: page ends
+            int: token usage of the reconciliation
+        """
+        ends = [end for end, _ in shards[0][0]]
+        total_token_used = 0
+        wasted_calls = 0
+        reconcile_calls = 0
+        for k in range(1, len(shards)):
+            speculative = [(shard_starts[k], False)] + shards[k][0]
+            candidates = [end for end, _ in speculative]
+            while True:
+                i = ends[-1]
+                if i >= num_paragraphs or i > candidates[-1] + max_divergence:
+                    # the reconciled pagination went past the whole shard without converging
+                    wasted_calls += sum(queried for _, queried in speculative)
+                    break
+                lower_bound = ends[-2] if len(ends) > 1 else 0
+                matches = [
+                    idx for idx in range(bisect_left(candidates, i - max_divergence),
+                                         bisect_right(candidates, i + max_divergence))
+                    if candidates[idx] > lower_bound
+                ]
+                if matches:
+                    idx = min(matches, key=lambda m: abs(candidates[m] - i))
+                    # converged: every speculative page after this boundary is adopted as is
+                    ends[-1] = candidates[idx]
+                    wasted_calls += sum(queried for _, queried in speculative[:idx + 1])
+                    ends.extend(candidates[idx + 1:])
+                    break
+                pause_point, token_usage, queried = yield i, (lower_bound, i)
+                total_token_used += token_usage
+                reconcile_calls += queried
+                ends.append(pause_point)
+        logger.info(
+            f"[Pagination] {len(shards)} shards reconciled with {reconcile_calls} extra calls, "
+            f"{wasted_calls} speculative calls wasted"
+        )
+        return ends, total_token_used
+
+    @staticmethod
+    def _parallel_pagination(
+        document: Document,
+        backend: BackendBase,
+        budget: PageBudget,
+        allow_fallback_to_last: bool,
+        max_workers: int,
+        max_divergence: Optional[int],
+    ) -> Tuple[List[int], int]:
+        shard_starts = Agent._shard_starts(len(document.paragraphs), max_workers)
+        hard_stop = max_divergence is None
+        # count the text once, before the shards share the document
+        document.prefix(budget.unit)
+        with ThreadPoolExecutor(max_workers=len(shard_starts) - 1) as executor:
+            futures = [
+                submit(
+                    executor, Agent._paginate_range, document, start, stop, backend,
+                    budget, allow_fallback_to_last, hard_stop
+                )
+                for start, stop in zip(shard_starts, shard_starts[1:])
+            ]
+            shards = [future.result() for future in futures]
+        total_token_used = sum(token_usage for _, token_usage in shards)
+        if hard_stop:
+            logger.info(f"[Pagination] {len(shards)} shards split at hard boundaries {shard_starts[1:-1]}")
+            return [end for page_ends, _ in shards for end, _ in page_ends], total_token_used
+
+        reconciliation = Agent._reconcile_shards(len(document.paragraphs), shard_starts, shards, max_divergence)
+        try:
+            i, previous_page = next(reconciliation)
+            while True:
+                i, previous_page = reconciliation.send(Agent._pagination_step(
+                    document, i, previous_page, backend, budget, allow_fallback_to_last
+                ))
+        except StopIteration as stop:
+            ends, token_usage = stop.value
+        return ends, total_token_used + token_usage
+
+    @staticmethod
+    def _word_count(pages: Sequence[List[str]]) -> int:
+        if isinstance(pages, PageArray):
+            return pages.num_words
+        return count_words('\n'.join([t for p in pages for t in p]))
+
+    @staticmethod
+    def _page_text(pages: Sequence[List[str]], page_id: int) -> str:
+        return pages.text(page_id) if isinstance(pages, PageArray) else '\n'.join(pages[page_id])
+
+    @staticmethod
+    def _gist_prompts(page: List[str], backend: BackendBase) -> List[str]:
+        """Shorten prompts of ``page`` that fit the context window of ``backend``, usually a single one.
+
+        Pages too long for it are shortened in parts, truncating paragraphs that do not fit a part on their own.
+        """
+        text = '\n'.join(page)
+        estimator = get_estimator(backend).frozen(("page", hash(text)))
+        budget = prompt_tokens(backend) - estimator.estimate(prompt_shorten_template.format(""))
+        if estimator.estimate(text) <= budget:
+            return [prompt_shorten_template.format(text)]
+        limit = max(1, estimator.to_pieces(budget))
+        chunks = [[]]
+        used = 0
+        for paragraph in page:
+            pieces = count_pieces(paragraph) + 1
+            if pieces > limit:
+                logger.warning(f"[Gisting] Truncating a paragraph of {pieces} word pieces to {limit}")
+                paragraph = paragraph[:len(paragraph) * limit // pieces]
+                pieces = limit
+            if used + pieces > limit and chunks[-1]:
+                chunks.append([])
+                used = 0
+            chunks[-1].append(paragraph)
+            used += pieces
+        logger.info(f"[Gisting] Page too long for the backend, shortened in {len(chunks)} parts")
+        return [prompt_shorten_template.format('\n'.join(chunk)) for chunk in chunks]
+
+    @staticmethod
+    def _gist_page(page: List[str], backend: BackendBase) -> Tuple[int, str]:
+        total_token_used = 0
+        gists = []
+        for prompt in Agent._gist_prompts(page, backend):
+            token_usage, response = backend.query_model(prompt)
+            total_token_used += token_usage
+            gists.append(replace_consecutive_newlines(response.strip()))
+        return total_token_used, '\n'.join(gists)
+
+    @staticmethod
+    @traced("gisting")
+    def gisting(pages: List[List[str]], backend: BackendBase, verbose=True, max_workers=1):
+        """Shorten every page into a gist.
+
+        Every call is retried on its own by the rate limiter of ``backend`` while it is throttled or fails
+        transiently, any other error, or running out of retries, is propagated.
+
+        Args:
+            pages: paginated paragraphs
+            backend: LLM backend
+            verbose: log every gist
+            max_workers: number of pages gisted concurrently, 1 keeps the serial behaviour
+
+        Returns:
+            List[str]: gists in page order
+        """
+        word_count = Agent._word_count(pages)
+        logger.info(f"[Gisting] Document Word Count: {word_count}")
+        shortened_pages = [None] * len(pages)
+        total_token_used = 0
+        if max_workers > 1 and len(pages) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    submit(executor, Agent._gist_page, page, backend): i
+                    for i, page in enumerate(pages)
+                }
+                for future in as_completed(futures):
+                    i = futures[future]
+                    token_usage, shortened_pages[i] = future.result()
+                    total_token_used += token_usage
+                    if verbose:
+                        logger.info(f"[Gisting] page {i}: {shortened_pages[i]}")
+        else:
+            for i, page in enumerate(pages):
+                token_usage, shortened_pages[i] = Agent._gist_page(page, backend)
+                total_token_used += token_usage
+                if verbose:
+                    logger.info(f"[Gisting] page {i}: {shortened_pages[i]}")
+        Agent._log_gisting_summary(shortened_pages, word_count, total_token_used, verbose)
+        return shortened_pages
+
+    @staticmethod
+    def _log_gisting_summary(shortened_pages: List[str], word_count: int, total_token_used: int, verbose: bool):
         shortened_article = '\n'.join(shortened_pages)
         gist_word_count = count_words(shortened_article)
         if verbose:
@@ -89,17 +616,191 @@ class Agent:
                 f"[Gisting] compression rate {round(100.0 - gist_word_count / word_count * 100, 2)}% ({gist_word_count}/{word_count}), "
                 f"token usage: {total_token_used}"
             )
-        return shortened_pages
 
     @staticmethod
-    def parallel_lookup(gists, pages, question, backend, verbose=True):
-        shortened_article = '\n'.join(gists)
-        prompt_lookup = prompt_parallel_lookup_template.format(shortened_article, question)
-        page_ids = []
+    @traced("reading")
+    def stream_reading(
+        paragraphs: Union[Iterable[str], Document],
+        backend: BackendBase,
+        word_limit: Optional[int] = None,
+        start_threshold: Optional[int] = None,
+        verbose=True,
+        allow_fallback_to_last=True,
+        max_workers=4,
+    ) -> Iterator[Tuple[List[str], str]]:
+        """Paginate and gist as a pipeline, yielding ``(page, gist)`` pairs in page order.
+
+        Pagination runs in a producer thread and hands every finalized page to a pool of ``max_workers``
+        gisting workers, so gists are produced while later pages are still being paginated. Given a stream of
+        paragraphs, like ``extractor.stream(pdf_bytes)``, the producer extracts too, see ``iter_pagination``.
+        """
+        start = time.perf_counter()
+        pending = queue.Queue()
+        stopped = threading.Event()
+
+        def produce(executor):
+            try:
+                for page in Agent.iter_pagination(
+                    paragraphs, backend, word_limit, start_threshold, verbose, allow_fallback_to_last
+                ):
+                    if stopped.is_set():
+                        break
+                    with tracer.attribute_to("gisting"):
+                        pending.put((page, submit(executor, Agent._gist_page, page, backend)))
+                pending.put(None)
+            except BaseException as e:
+                pending.put(e)
+
         total_token_used = 0
-        token_usage, response = backend.query_model(prompt=prompt_lookup)
-        total_token_used += token_usage
-        response = response.strip()
+        num_pages = 0
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            producer = threading.Thread(
+                target=contextvars.copy_context().run, args=(produce, executor), daemon=True
+            )
+            producer.start()
+            try:
+                while True:
+                    item = pending.get()
+                    if item is None:
+                        break
+                    if isinstance(item, BaseException):
+                        raise item
+                    page, future = item
+                    token_usage, gist = future.result()
+                    total_token_used += token_usage
+                    if num_pages == 0:
+                        logger.info(f"[Reading] First gist after {time.perf_counter() - start:.2f}s")
+                    if verbose:
+                        logger.info(f"[Gisting] page {num_pages}: {gist}")
+                    num_pages += 1
+                    yield page, gist
+            finally:
+                stopped.set()
+                producer.join()
+        logger.info(
+            f"[Reading] Done with {num_pages} pages in {time.perf_counter() - start:.2f}s, "
+            f"gisting token usage: {total_token_used}"
+        )
+
+    @staticmethod
+    def _reusable_pages(previous: Document, old_to_new: np.ndarray, budget: PageBudget) -> Dict[int, int]:
+        """New start of every previous page whose paragraphs and pagination window are unchanged.
+
+        Args:
+            previous: paragraphs and pages of the previous reading
+            old_to_new: new index of every previous paragraph, -1 if it changed, and of the end of the document
+
+        Returns:
+            Dict[int, int]: new paragraph index to previous page
+        """
+        num_paragraphs = len(previous.paragraphs)
+        starts = {}
+        for k in range(len(previous.pages)):
+            start, end = int(previous.page_bounds[k]), int(previous.page_bounds[k + 1])
+            # the model chose the end of the page from its window and the paragraph after it
+            window_end = previous.window_end(start, budget.limit, unit=budget.unit)
+            covered = min(max(end, window_end + 1), num_paragraphs + 1)
+            mapped = old_to_new[start:covered]
+            if len(mapped) and np.all(mapped >= 0) and mapped[-1] - mapped[0] == covered - 1 - start:
+                starts[int(mapped[0])] = k
+        return starts
+
+    @staticmethod
+    @traced("pagination")
+    def _incremental_pagination(
+        document: Document,
+        previous: Document,
+        backend: BackendBase,
+        budget: PageBudget,
+        allow_fallback_to_last: bool,
+    ) -> Tuple[List[int], List[Optional[int]]]:
+        """Page ends of ``document``, adopting the pages of ``previous`` wherever the boundaries line up.
+
+        Returns:
+            List[int]: page ends
+            List[Optional[int]]: previous page adopted as every page, None if it was paginated again
+        """
+        matcher = SequenceMatcher(None, list(previous.paragraphs), list(document.paragraphs))
+        num_old, num_new = len(previous.paragraphs), len(document.paragraphs)
+        old_to_new = np.full(num_old + 1, -1, dtype=np.int64)
+        for tag, a1, a2, b1, b2 in matcher.get_opcodes():
+            if tag == "equal":
+                old_to_new[a1:a2] = np.arange(b1, b2)
+        if num_old == 0 or old_to_new[num_old - 1] == num_new - 1:
+            old_to_new[num_old] = num_new
+        reusable = Agent._reusable_pages(previous, old_to_new, budget)
+
+        ends, origins = [], []
+        i = 0
+        previous_page = None
+        total_token_used = 0
+        num_calls = 0
+        while i < num_new:
+            k = reusable.get(i)
+            if k is not None:
+                pause_point = i + int(previous.page_bounds[k + 1] - previous.page_bounds[k])
+            else:
+                pause_point, token_usage, queried = Agent._pagination_step(
+                    document, i, previous_page, backend, budget, allow_fallback_to_last
+                )
+                total_token_used += token_usage
+                num_calls += queried
+            ends.append(pause_point)
+            origins.append(k)
+            previous_page = (i, pause_point)
+            i = pause_point
+        logger.info(
+            f"[Pagination] {sum(k is None for k in origins)} of {len(ends)} pages paginated again with "
+            f"{num_calls} calls, token usage: {total_token_used}"
+        )
+        return ends, origins
+
+    @staticmethod
+    def incremental_reading(
+        paragraphs: Union[List[str], Document],
+        previous_pages: Sequence[List[str]],
+        previous_gists: Sequence[str],
+        backend: BackendBase,
+        word_limit: Optional[int] = None,
+        start_threshold: Optional[int] = None,
+        verbose=True,
+        allow_fallback_to_last=True,
+        max_workers=1,
+    ) -> Tuple[List[List[str]], List[str]]:
+        """Read ``paragraphs`` again after edits, reusing the pages and gists of the previous reading.
+
+        The paragraphs are diffed against those of ``previous_pages``. Previous pages whose paragraphs and
+        pagination window are untouched are adopted as they are, the others are paginated again until a page
+        ends where an adoptable page starts. Only pages whose text is not one of the previous pages are gisted.
+
+        Returns:
+            List[List[str]]: pages
+            List[str]: gists
+        """
+        document = Agent._as_document(paragraphs)
+        previous = Document.from_pages(previous_pages, previous_gists)
+        # the previous pages were sized with the estimator frozen for the previous paragraphs
+        budget = PageBudget.resolve(backend, word_limit, start_threshold, previous.digest(), document.digest())
+        ends, _ = Agent._incremental_pagination(
+            document, previous, backend, budget, allow_fallback_to_last
+        )
+        pages = Agent._pages_from_ends(document, ends, 0, verbose)
+
+        previous_gist_of = {previous.pages.text(k): previous.gists[k]
+                            for k in range(min(len(previous.pages), len(previous.gists)))}
+        gists = [previous_gist_of.get('\n'.join(page)) for page in pages]
+        changed = [p for p, gist in enumerate(gists) if gist is None]
+        if changed:
+            new_gists = Agent.gisting([pages[p] for p in changed], backend, verbose=verbose,
+                                      max_workers=max_workers)
+            for p, gist in zip(changed, new_gists):
+                gists[p] = gist
+        logger.info(f"[Reading] {len(changed)} of {len(pages)} pages gisted again")
+        return pages, gists
+
+    @staticmethod
+    def _parse_page_ids(response: str, num_pages: int) -> List[int]:
+        page_ids = []
         try:
             start = response.index('[')
         except ValueError:
@@ -110,31 +811,667 @@ class Agent:
             end = 0
         if start < end:
             page_ids_str = response[start + 1:end].split(',')
-            page_ids = []
             for p in page_ids_str:
                 if p.strip().isnumeric():
                     page_id = int(p)
-                    if page_id < 0 or page_id >= len(pages):
+                    if page_id < 0 or page_id >= num_pages:
                         logger.info(f"[Look Up] Skip invalid page number: {page_id}")
                     else:
                         page_ids.append(page_id)
+        return page_ids
+
+    @staticmethod
+    def _gist_memory(gists: List[str], page_ids: Optional[List[int]] = None) -> str:
+        """The labelled gists every look-up and answer prompt of the document starts with, byte for byte."""
+        page_ids = range(len(gists)) if page_ids is None else page_ids
+        return prompt_gist_memory_template.format('\n'.join(f"<Page {i}>\n{gists[i]}" for i in page_ids))
+
+    @staticmethod
+    def _reread_pages(pages: List[List[str]], page_ids: List[int], token_budget: Optional[int] = None,
+                      estimator: Optional[TokenEstimator] = None) -> str:
+        # Memory expansion after look-up, the target pages are read again in full after the gists
+        texts = {page_id: f"<Page {page_id}>\n" + Agent._page_text(pages, page_id) for page_id in page_ids}
+        if token_budget is not None:
+            # pages are kept in the order the model chose them until the prompt would overrun the context window
+            kept = {}
+            for page_id, text in texts.items():
+                tokens = estimator.estimate(text) + 1
+                if tokens > token_budget:
+                    logger.info(f"[Look Up] Page {page_id} does not fit the context window, not read again")
+                    continue
+                kept[page_id] = text
+                token_budget -= tokens
+            texts = kept
+        if not texts:
+            return "(none)"
+        return '\n'.join(texts[page_id] for page_id in sorted(texts))
+
+    @staticmethod
+    def _reread_budget(backend: BackendBase, *parts: str) -> Tuple[int, TokenEstimator]:
+        """Estimated tokens left to the pages read again by a prompt made of ``parts`` and those pages.
+
+        The first part is the gist memory, the estimator frozen for it decides the pages of the document that fit.
+        """
+        estimator = get_estimator(backend).frozen(("memory", hash(parts[0])))
+        return prompt_tokens(backend) - sum(estimator.estimate(part) for part in parts), estimator
+
+    @staticmethod
+    def _memory_room(memory: str, question, backend: BackendBase) -> Tuple[int, TokenEstimator]:
+        """Estimated tokens left by the longer of the look-up and answer prompts starting with ``memory``."""
+        lookup = prompt_parallel_lookup_template.format(question)
+        answer = prompt_answer_template.format("", question)
+        return Agent._reread_budget(backend, memory, max(lookup, answer, key=len))
+
+    @staticmethod
+    def memory_fits(gists: List[str], backend: BackendBase, question: str = "") -> bool:
+        """Whether look-ups over the whole gist memory fit the context window of ``backend``.
 
+        Documents whose memory does not fit are looked up with ``hierarchical_lookup`` over a ``gist_tree``.
+        """
+        return Agent._memory_room(Agent._gist_memory(gists), question, backend)[0] >= 0
+
+    @staticmethod
+    @traced("indexing")
+    def build_index(pages: List[List[str]], gists: List[str], embed: Optional[Embed] = None) -> RetrievalIndex:
+        """Index every page with its gist for ``parallel_lookup`` to narrow down the pages shown to the model."""
+        texts = [gists[page_id] + '\n' + Agent._page_text(pages, page_id)
+                 for page_id in range(min(len(pages), len(gists)))]
+        return RetrievalIndex.build(texts, embed=embed)
+
+    @staticmethod
+    def _indexed_memory(gists: List[str], index: RetrievalIndex, question, top_k: int,
+                        outline_words: int) -> Tuple[str, str]:
+        """A one-line-per-page outline, the same for every question, and the gists of the ``top_k`` best pages.
+
+        Returns:
+            str: memory the prompts start with
+            str: candidate pages following it
+        """
+        outline = '\n'.join(f"<Page {i}> {' '.join(gist.split()[:outline_words])}" for i, gist in enumerate(gists))
+        candidates = sorted(index.search(question, top_k))
+        logger.info(f"[Look Up] Index candidates: {candidates}")
+        return (
+            prompt_outline_memory_template.format(outline),
+            prompt_candidate_pages_template.format('\n'.join(f"<Page {i}>\n{gists[i]}" for i in candidates)),
+        )
+
+    @staticmethod
+    def _lookup_memory(gists, index: Optional[RetrievalIndex], question, top_k: int,
+                       outline_words: int) -> Tuple[str, str]:
+        if index is None or len(gists) <= top_k:
+            return Agent._gist_memory(gists), ""
+        return Agent._indexed_memory(gists, index, question, top_k, outline_words)
+
+    @staticmethod
+    def _lookup_prompt(memory: str, question, candidates: str = "") -> str:
+        return memory + candidates + prompt_parallel_lookup_template.format(question)
+
+    @staticmethod
+    def _parse_lookup(response: str, num_pages: int, verbose=True) -> List[int]:
+        page_ids = Agent._parse_page_ids(response.strip(), num_pages)
         if verbose:
             logger.info("[Look Up] Model chose to look up page {}".format(page_ids))
+        return page_ids
 
-        # Memory expansion after look-up, replacing the target shortened page with the original page
-        expanded_shortened_pages = gists[:]
-        if len(page_ids) > 0:
-            for page_id in page_ids:
-                expanded_shortened_pages[page_id] = '\n'.join(pages[page_id])
-
-        expanded_shortened_article = '\n'.join(expanded_shortened_pages)
+    @staticmethod
+    def _answer_prompt(memory: str, pages, page_ids: List[int], question, backend, verbose=True,
+                       candidates: str = "") -> str:
+        """The answer prompt with the pages of ``page_ids`` that fit appended."""
+        reread_pages = Agent._reread_pages(pages, page_ids, *Agent._reread_budget(
+            backend, memory, candidates, prompt_answer_template.format("", question)
+        ))
         if verbose:
-            logger.info(f"[Look Up] Expanded shortened article:\n {expanded_shortened_article}")
-        prompt_answer = prompt_answer_template.format(expanded_shortened_article, question)
+            logger.info(f"[Look Up] Pages read again:\n {reread_pages}")
+        return memory + candidates + prompt_answer_template.format(reread_pages, question)
+
+    @staticmethod
+    def _lookup_pages(memory: str, num_pages: int, question, backend, verbose=True,
+                      candidates: str = "") -> Tuple[int, List[int]]:
+        """Ask the model which pages to re-read."""
+        token_usage, response = backend.query_model(
+            prompt=Agent._lookup_prompt(memory, question, candidates), cache_prefix=memory
+        )
+        return token_usage, Agent._parse_lookup(response, num_pages, verbose)
+
+    @staticmethod
+    def _lookup_answer_prompt(memory: str, pages, question, backend, verbose=True,
+                              candidates: str = "") -> Tuple[int, List[int], str]:
+        """Ask the model which pages to re-read and build the answer prompt with those pages appended."""
+        token_usage, page_ids = Agent._lookup_pages(memory, len(pages), question, backend, verbose, candidates)
+        return token_usage, page_ids, Agent._answer_prompt(memory, pages, page_ids, question, backend, verbose,
+                                                           candidates)
+
+    @staticmethod
+    @traced("lookup")
+    def parallel_lookup(gists, pages, question, backend, verbose=True, index: Optional[RetrievalIndex] = None,
+                        top_k=8, outline_words=12):
+        """Look up pages to re-read and answer ``question``.
 
-        token_usage, response = backend.query_model(prompt=prompt_answer)
-        total_token_used += total_token_used
+        With an ``index``, only the gists of the ``top_k`` best matching pages are shown in full, the other pages
+        as an outline of their first ``outline_words`` words.
+        """
+        total_token_used = 0
+        memory, candidates = Agent._lookup_memory(gists, index, question, top_k, outline_words)
+        token_usage, _, prompt_answer = Agent._lookup_answer_prompt(
+            memory, pages, question, backend, verbose, candidates
+        )
+        total_token_used += token_usage
+
+        token_usage, response = backend.query_model(prompt=prompt_answer, cache_prefix=memory)
+        total_token_used += token_usage
         response = response.strip()
         logger.info(f"[Look Up] Token usage: {total_token_used}")
         return response
+
+    @staticmethod
+    @traced("lookup")
+    def stream_parallel_lookup(gists, pages, question, backend, verbose=True, index: Optional[RetrievalIndex] = None,
+                               top_k=8, outline_words=12) -> Iterator[str]:
+        """``parallel_lookup`` that yields the answer as text deltas while it is being generated."""
+        memory, candidates = Agent._lookup_memory(gists, index, question, top_k, outline_words)
+        total_token_used, _, prompt_answer = Agent._lookup_answer_prompt(
+            memory, pages, question, backend, verbose, candidates
+        )
+        yield from Agent._stream_answer(prompt_answer, memory, backend, total_token_used)
+
+    @staticmethod
+    def _stream_answer(prompt_answer: str, memory: str, backend, total_token_used: int) -> Generator[str, None, int]:
+        """Yields the answer deltas and returns the token usage including ``total_token_used``."""
+        leading = True
+        for token_usage, delta in backend.stream_query_model(prompt_answer, cache_prefix=memory):
+            total_token_used += token_usage
+            if leading:
+                # match the stripped response of the blocking look-ups
+                delta = delta.lstrip()
+                leading = not delta
+            if delta:
+                yield delta
+        logger.info(f"[Look Up] Token usage: {total_token_used}")
+        return total_token_used
+
+    @staticmethod
+    def _sequential_answer_prompt(memory: str, pages, question, backend, max_steps=5,
+                                  verbose=True) -> Tuple[int, List[int], str]:
+        """Ask the model for one page to re-read at a time, until it says STOP or ``max_steps`` pages are read.
+
+        The memory is rendered once and every page read is appended to the re-read text, so a step only adds
+        the new page to the previous step's prompt.
+        """
+        total_token_used = 0
+        page_ids = []
+        reread_pages = ""
+        token_budget, estimator = Agent._reread_budget(
+            backend, memory, prompt_sequential_lookup_template.format(', '.join(map(str, range(max_steps))), question),
+            prompt_sequential_reread_template.format("")
+        )
+        for step in range(max_steps):
+            reread = prompt_sequential_reread_template.format(reread_pages) if page_ids else ""
+            prompt_lookup = memory + reread + prompt_sequential_lookup_template.format(
+                ', '.join(map(str, page_ids)) or "(none)", question
+            )
+            token_usage, response = backend.query_model(prompt=prompt_lookup, cache_prefix=memory)
+            total_token_used += token_usage
+            page_id = parse_sequential_page(response.strip(), len(pages))
+            if page_id is None or page_id in page_ids:
+                if verbose:
+                    logger.info(f"[Look Up] Model stopped after {step} page(s): {response.strip()[:80]}")
+                break
+            text = f"<Page {page_id}>\n" + Agent._page_text(pages, page_id)
+            tokens = estimator.estimate(text) + 1
+            if tokens > token_budget:
+                logger.info(f"[Look Up] Page {page_id} does not fit the context window, stopping after {step} page(s)")
+                break
+            token_budget -= tokens
+            page_ids.append(page_id)
+            reread_pages += ('\n' if reread_pages else '') + text
+            if verbose:
+                logger.info(f"[Look Up] Step {step}: model chose to look up page {page_id}")
+        return total_token_used, page_ids, memory + prompt_answer_template.format(reread_pages or "(none)", question)
+
+    @staticmethod
+    @traced("lookup")
+    def sequential_lookup(gists, pages, question, backend, max_steps=5, verbose=True):
+        """Look up pages one at a time before answering ``question``, see ``_sequential_answer_prompt``."""
+        memory = Agent._gist_memory(gists)
+        total_token_used, _, prompt_answer = Agent._sequential_answer_prompt(
+            memory, pages, question, backend, max_steps, verbose
+        )
+        token_usage, response = backend.query_model(prompt=prompt_answer, cache_prefix=memory)
+        total_token_used += token_usage
+        logger.info(f"[Look Up] Token usage: {total_token_used}")
+        return response.strip()
+
+    @staticmethod
+    def _strategy_answer_prompt(gists, pages, question, backend, strategy, max_steps, verbose,
+                                tree: Optional[GistTree] = None) -> Tuple[str, int, List[int], str, str]:
+        """Resolve ``strategy`` and look up the pages to re-read.
+
+        A gist memory that does not fit the context window is looked up hierarchically over ``tree``, and
+        ``ValueError`` is raised without one.
+
+        Returns:
+            str: strategy used
+            int: look-up token usage
+            List[int]: pages read again
+            str: memory the answer prompt starts with
+            str: answer prompt
+        """
+        memory = Agent._gist_memory(gists)
+        room, _ = Agent._memory_room(memory, question, backend)
+        if room < 0:
+            if tree is None:
+                raise ValueError(
+                    f"The gist memory of {len(gists)} pages overruns the {prompt_tokens(backend)} prompt tokens of "
+                    f"the backend by about {-room} tokens, look it up over a tree built with Agent.gist_tree"
+                )
+            logger.info(f"[Look Up] Gist memory overruns the context window by {-room} tokens, looking up by section")
+            strategy = "hierarchical"
+        elif isinstance(strategy, LookupStrategySelector):
+            strategy = strategy.choose(count_words(memory), len(pages))
+        if strategy == "hierarchical":
+            if tree is None:
+                raise ValueError("Hierarchical look-up needs the tree built by Agent.gist_tree")
+            lookup_tokens, page_ids, memory, prompt_answer = Agent._hierarchical_answer_prompt(
+                tree, pages, question, backend, verbose=verbose
+            )
+            return strategy, lookup_tokens, page_ids, memory, prompt_answer
+        if strategy == "sequential":
+            lookup = Agent._sequential_answer_prompt(memory, pages, question, backend, max_steps, verbose)
+        elif strategy == "parallel":
+            lookup = Agent._lookup_answer_prompt(memory, pages, question, backend, verbose)
+        else:
+            raise ValueError(f"Unknown look-up strategy {strategy}")
+        return (strategy, *lookup[:2], memory, lookup[2])
+
+    @staticmethod
+    @traced("lookup")
+    def lookup(gists, pages, question, backend, strategy="parallel", max_steps=5, verbose=True,
+               tree: Optional[GistTree] = None) -> LookupResult:
+        """Answer ``question`` with parallel or sequential look-up, reporting the same metrics for both.
+
+        Args:
+            strategy: "parallel", "sequential", "hierarchical" or a ``LookupStrategySelector`` choosing between
+                the first two per question and learning from the token usage of the result
+            max_steps: most pages read by sequential look-up
+            tree: ``gist_tree`` of ``gists``, looked up instead when the gist memory does not fit the context
+                window
+        """
+        start = time.perf_counter()
+        strategy_used, lookup_tokens, page_ids, memory, prompt_answer = Agent._strategy_answer_prompt(
+            gists, pages, question, backend, strategy, max_steps, verbose, tree
+        )
+        answer_tokens, response = backend.query_model(prompt=prompt_answer, cache_prefix=memory)
+        result = LookupResult(question=question, answer=response.strip(), page_ids=page_ids,
+                              lookup_tokens=lookup_tokens, answer_tokens=answer_tokens,
+                              latency=time.perf_counter() - start, strategy=strategy_used)
+        if isinstance(strategy, LookupStrategySelector):
+            strategy.observe(strategy_used, count_words(memory), result.token_usage)
+        logger.info(f"[Look Up] {strategy_used} look-up token usage: {result.token_usage}")
+        return result
+
+    @staticmethod
+    @traced("lookup")
+    def stream_lookup(gists, pages, question, backend, strategy="parallel", max_steps=5, verbose=True,
+                      tree: Optional[GistTree] = None) -> Generator[str, None, LookupResult]:
+        """``lookup`` that yields the answer as text deltas and returns the ``LookupResult``."""
+        start = time.perf_counter()
+        strategy_used, lookup_tokens, page_ids, memory, prompt_answer = Agent._strategy_answer_prompt(
+            gists, pages, question, backend, strategy, max_steps, verbose, tree
+        )
+        deltas = []
+        stream = Agent._stream_answer(prompt_answer, memory, backend, lookup_tokens)
+        while True:
+            try:
+                deltas.append(next(stream))
+            except StopIteration as stop:
+                total_token_used = stop.value
+                break
+            yield deltas[-1]
+        result = LookupResult(question=question, answer="".join(deltas), page_ids=page_ids,
+                              lookup_tokens=lookup_tokens, answer_tokens=total_token_used - lookup_tokens,
+                              latency=time.perf_counter() - start, strategy=strategy_used)
+        if isinstance(strategy, LookupStrategySelector):
+            strategy.observe(strategy_used, count_words(memory), result.token_usage)
+        return result
+
+    @staticmethod
+    @traced("gist_tree")
+    def gist_tree(gists: List[str], backend: BackendBase, branching=8, verbose=True, max_workers=1) -> GistTree:
+        """Gist every ``branching`` consecutive gists into a section gist, recursively, until a level fits.
+
+        Args:
+            gists: page gists
+            backend: LLM backend
+            branching: entries summarised by one section, and most entries of the top level
+            verbose: log every section gist
+            max_workers: number of sections gisted concurrently
+
+        Returns:
+            GistTree: ``levels[0]`` are ``gists``, the last level has at most ``branching`` sections
+        """
+        if branching < 2:
+            raise ValueError("branching must be at least 2")
+        levels = [list(gists)]
+        while len(levels[-1]) > branching:
+            below = levels[-1]
+            sections = [below[i:i + branching] for i in range(0, len(below), branching)]
+            levels.append(Agent.gisting(sections, backend, verbose=verbose, max_workers=max_workers))
+            logger.info(f"[Gisting] Level {len(levels) - 1}: {len(sections)} sections of {len(below)} gists")
+        return GistTree(branching=branching, levels=levels)
+
+    @staticmethod
+    def _hierarchical_answer_prompt(tree: GistTree, pages, question, backend, max_sections=2,
+                                    verbose=True) -> Tuple[int, List[int], str, str]:
+        """Walk down ``tree`` opening sections, then look up pages among the opened ones.
+
+        Every prompt holds at most ``max_sections * branching`` entries, whatever the number of pages. Gists of
+        the opened pages that would overrun the context window are left out, the last opened first.
+
+        Returns:
+            int: token usage
+            List[int]: pages read again
+            str: memory the answer prompt starts with
+            str: answer prompt
+        """
+        total_token_used = 0
+        top = len(tree.levels) - 1
+        candidates = list(range(len(tree.levels[top])))
+        for level in range(top, 0, -1):
+            memory = prompt_section_memory_template.format(
+                '\n'.join(f"<Section {i}>\n{tree.levels[level][i]}" for i in candidates)
+            )
+            prompt_lookup = memory + prompt_section_lookup_template.format(max_sections, question)
+            # only the top level is the same for every question
+            token_usage, response = backend.query_model(
+                prompt=prompt_lookup, cache_prefix=memory if level == top else None
+            )
+            total_token_used += token_usage
+            chosen = [i for i in Agent._parse_page_ids(response.strip(), len(tree.levels[level])) if i in candidates]
+            if not chosen:
+                logger.info(f"[Look Up] No valid section chosen at level {level}, opening all of them")
+            chosen = chosen[:max_sections] or candidates
+            if verbose:
+                logger.info(f"[Look Up] Level {level}: model chose to open section {chosen}")
+            candidates = [child for i in chosen for child in tree.children(level, i)]
+
+        memory = Agent._gist_memory(tree.levels[0], candidates)
+        room, estimator = Agent._memory_room(memory, question, backend)
+        if room < 0:
+            opened = len(candidates)
+            while candidates and room < 0:
+                room += estimator.estimate(f"<Page {candidates[-1]}>\n{tree.levels[0][candidates[-1]]}") + 1
+                candidates = candidates[:-1]
+            logger.info(f"[Look Up] {len(candidates)} of the {opened} opened gists fit the context window")
+            memory = Agent._gist_memory(tree.levels[0], candidates)
+        token_usage, page_ids, prompt_answer = Agent._lookup_answer_prompt(memory, pages, question, backend, verbose)
+        return total_token_used + token_usage, page_ids, memory, prompt_answer
+
+    @staticmethod
+    @traced("lookup")
+    def hierarchical_lookup(tree: GistTree, pages, question, backend, max_sections=2, verbose=True):
+        """``parallel_lookup`` over a ``GistTree``, for documents whose gists do not fit one prompt."""
+        total_token_used, _, memory, prompt_answer = Agent._hierarchical_answer_prompt(
+            tree, pages, question, backend, max_sections, verbose
+        )
+        token_usage, response = backend.query_model(prompt=prompt_answer, cache_prefix=memory)
+        total_token_used += token_usage
+        logger.info(f"[Look Up] Token usage: {total_token_used}")
+        return response.strip()
+
+    @staticmethod
+    @traced("lookup")
+    def stream_hierarchical_lookup(tree: GistTree, pages, question, backend, max_sections=2,
+                                   verbose=True) -> Iterator[str]:
+        """``hierarchical_lookup`` that yields the answer as text deltas while it is being generated."""
+        total_token_used, _, memory, prompt_answer = Agent._hierarchical_answer_prompt(
+            tree, pages, question, backend, max_sections, verbose
+        )
+        yield from Agent._stream_answer(prompt_answer, memory, backend, total_token_used)
+
+    @staticmethod
+    @traced("lookup")
+    def batch_lookup(
+        gists: List[str],
+        pages: List[List[str]],
+        questions: List[str],
+        backend: BackendBase,
+        max_workers=8,
+        group_answers=False,
+        verbose=False,
+    ) -> List[LookupResult]:
+        """Answer many questions about one document.
+
+        Identical questions (up to whitespace) are looked up and answered once, and split the tokens of their
+        calls. Look-ups run concurrently on ``max_workers`` threads. With ``group_answers``, questions that selected
+        the same pages share a single answer prompt; their answer tokens are split between them, the first one
+        taking the remainder.
+
+        Returns:
+            List[LookupResult]: one result per question, in the order of ``questions``
+        """
+        unique_questions = list(dict.fromkeys(' '.join(q.split()) for q in questions))
+        memory = Agent._gist_memory(gists)
+
+        def lookup(question):
+            start = time.perf_counter()
+            token_usage, page_ids = Agent._lookup_pages(memory, len(pages), question, backend, verbose)
+            return token_usage, page_ids, time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            lookups = [f.result() for f in [submit(executor, lookup, q) for q in unique_questions]]
+
+            # questions asking for the same pages share the expanded article, and with group_answers the call
+            groups = {}
+            for question, (_, page_ids, _) in zip(unique_questions, lookups):
+                groups.setdefault(tuple(sorted(set(page_ids))), []).append(question)
+            if group_answers:
+                jobs = [(page_ids, group) for page_ids, group in groups.items()]
+            else:
+                jobs = [(page_ids, [question]) for page_ids, group in groups.items() for question in group]
+            answered = [f.result() for f in [
+                submit(executor, Agent._answer_questions, memory, pages, list(page_ids), group, backend)
+                for page_ids, group in jobs
+            ]]
+
+        # duplicates of a question split its tokens the way the questions of a group do
+        occurrences = {}
+        for i, question in enumerate(questions):
+            occurrences.setdefault(' '.join(question.split()), []).append(i)
+        results: List[Optional[LookupResult]] = [None] * len(questions)
+        for question, (lookup_tokens, page_ids, lookup_latency) in zip(unique_questions, lookups):
+            share, remainder = divmod(lookup_tokens, len(occurrences[question]))
+            for k, i in enumerate(occurrences[question]):
+                results[i] = LookupResult(
+                    question=questions[i], answer="", page_ids=list(page_ids),
+                    lookup_tokens=share + (remainder if k == 0 else 0), latency=lookup_latency
+                )
+        for (_, group), (answers, answer_tokens, answer_latency) in zip(jobs, answered):
+            sharing = [(question, i) for question in group for i in occurrences[question]]
+            share, remainder = divmod(answer_tokens, len(sharing))
+            for k, (question, i) in enumerate(sharing):
+                result = results[i]
+                result.answer = answers[question]
+                # the shares add up to the tokens of the call
+                result.answer_tokens = share + (remainder if k == 0 else 0)
+                result.latency += answer_latency
+                result.shared_with = len(sharing)
+        logger.info(
+            f"[Look Up] Answered {len(questions)} questions ({len(unique_questions)} unique) with "
+            f"{len(jobs)} answer prompts, token usage: {sum(r.token_usage for r in results)}"
+        )
+        return results
+
+    @staticmethod
+    def _answer_questions(memory, pages, page_ids, questions, backend) -> Tuple[Dict[str, str], int, float]:
+        """Answer ``questions`` with ``page_ids`` read again in a single prompt if possible."""
+        start = time.perf_counter()
+        numbered = '\n'.join(f"{i + 1}. {q}" for i, q in enumerate(questions))
+        reread_pages = Agent._reread_pages(pages, page_ids, *Agent._reread_budget(
+            backend, memory, prompt_batch_answer_template.format("", numbered)
+        ))
+        if len(questions) == 1:
+            token_usage, response = backend.query_model(
+                prompt=memory + prompt_answer_template.format(reread_pages, questions[0]), cache_prefix=memory
+            )
+            return {questions[0]: response.strip()}, token_usage, time.perf_counter() - start
+
+        token_usage, response = backend.query_model(
+            prompt=memory + prompt_batch_answer_template.format(reread_pages, numbered), cache_prefix=memory
+        )
+        parsed = parse_batch_answers(response, len(questions))
+        answers = {}
+        for i, question in enumerate(questions):
+            if i in parsed:
+                answers[question] = parsed[i]
+            else:
+                logger.info(f"[Look Up] Batch answer missing question {i + 1}, answering it on its own")
+                fallback_tokens, fallback = backend.query_model(
+                    prompt=memory + prompt_answer_template.format(reread_pages, question), cache_prefix=memory
+                )
+                token_usage += fallback_tokens
+                answers[question] = fallback.strip()
+        return answers, token_usage, time.perf_counter() - start
+
+    # Async counterparts, sharing the prompt building and parsing with the blocking API above.
+
+    @staticmethod
+    async def _apagination_step(
+        document: Document,
+        i: int,
+        previous_page: Optional[Tuple[int, int]],
+        backend: BackendBase,
+        budget: PageBudget,
+        allow_fallback_to_last: bool,
+        stop: Optional[int] = None,
+    ) -> Tuple[int, int, bool]:
+        stop = len(document.paragraphs) if stop is None else stop
+        prompt, j = Agent._pagination_prompt(document, i, previous_page, budget, stop)
+        if prompt is None:
+            return j, 0, False
+        token_usage, response = await backend.aquery_model(prompt=prompt)
+        return Agent._resolve_pause_point(prompt, response, i, j, allow_fallback_to_last), token_usage, True
+
+    @staticmethod
+    async def _apaginate_range(
+        document: Document,
+        start: int,
+        stop: int,
+        backend: BackendBase,
+        budget: PageBudget,
+        allow_fallback_to_last: bool,
+        hard_stop: bool = False,
+    ) -> Tuple[List[Tuple[int, bool]], int]:
+        i = start
+        previous_page = None
+        ends = []
+        total_token_used = 0
+        while i < stop:
+            pause_point, token_usage, queried = await Agent._apagination_step(
+                document, i, previous_page, backend, budget, allow_fallback_to_last,
+                stop=stop if hard_stop else None
+            )
+            total_token_used += token_usage
+            ends.append((pause_point, queried))
+            previous_page = (i, pause_point)
+            i = pause_point
+        return ends, total_token_used
+
+    @staticmethod
+    @traced("pagination")
+    async def apagination(
+        paragraphs: Union[List[str], Document],
+        backend: BackendBase,
+        word_limit: Optional[int] = None,
+        start_threshold: Optional[int] = None,
+        verbose=True,
+        allow_fallback_to_last=True,
+        max_workers=1,
+        max_divergence: Optional[int] = 0,
+    ) -> List[List[str]]:
+        """Async version of ``pagination``, shards are paginated as concurrent tasks."""
+        document = Agent._as_document(paragraphs)
+        budget = PageBudget.resolve(backend, word_limit, start_threshold, document.digest())
+        num_paragraphs = len(document.paragraphs)
+        if max_workers <= 1 or num_paragraphs <= 1:
+            page_ends, total_token_used = await Agent._apaginate_range(
+                document, 0, num_paragraphs, backend, budget, allow_fallback_to_last
+            )
+            return Agent._pages_from_ends(document, [end for end, _ in page_ends], total_token_used, verbose)
+
+        shard_starts = Agent._shard_starts(num_paragraphs, max_workers)
+        hard_stop = max_divergence is None
+        shards = await asyncio.gather(*[
+            Agent._apaginate_range(
+                document, start, stop, backend, budget, allow_fallback_to_last, hard_stop
+            )
+            for start, stop in zip(shard_starts, shard_starts[1:])
+        ])
+        total_token_used = sum(token_usage for _, token_usage in shards)
+        if hard_stop:
+            logger.info(f"[Pagination] {len(shards)} shards split at hard boundaries {shard_starts[1:-1]}")
+            ends = [end for page_ends, _ in shards for end, _ in page_ends]
+            return Agent._pages_from_ends(document, ends, total_token_used, verbose)
+
+        reconciliation = Agent._reconcile_shards(num_paragraphs, shard_starts, shards, max_divergence)
+        try:
+            i, previous_page = next(reconciliation)
+            while True:
+                i, previous_page = reconciliation.send(await Agent._apagination_step(
+                    document, i, previous_page, backend, budget, allow_fallback_to_last
+                ))
+        except StopIteration as stop:
+            ends, token_usage = stop.value
+        return Agent._pages_from_ends(document, ends, total_token_used + token_usage, verbose)
+
+    @staticmethod
+    async def _agist_page(page: List[str], backend: BackendBase) -> Tuple[int, str]:
+        total_token_used = 0
+        gists = []
+        for prompt in Agent._gist_prompts(page, backend):
+            token_usage, response = await backend.aquery_model(prompt)
+            total_token_used += token_usage
+            gists.append(replace_consecutive_newlines(response.strip()))
+        return total_token_used, '\n'.join(gists)
+
+    @staticmethod
+    @traced("gisting")
+    async def agisting(pages: List[List[str]], backend: BackendBase, verbose=True, max_workers=8):
+        """Async version of ``gisting``, at most ``max_workers`` pages are in flight at once."""
+        word_count = Agent._word_count(pages)
+        logger.info(f"[Gisting] Document Word Count: {word_count}")
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+
+        async def gist(i, page):
+            async with semaphore:
+                token_usage, shortened_text = await Agent._agist_page(page, backend)
+            if verbose:
+                logger.info(f"[Gisting] page {i}: {shortened_text}")
+            return token_usage, shortened_text
+
+        results = await asyncio.gather(*[gist(i, page) for i, page in enumerate(pages)])
+        shortened_pages = [shortened_text for _, shortened_text in results]
+        Agent._log_gisting_summary(shortened_pages, word_count, sum(t for t, _ in results), verbose)
+        return shortened_pages
+
+    @staticmethod
+    async def _alookup_pages(memory: str, num_pages: int, question, backend, verbose=True,
+                             candidates: str = "") -> Tuple[int, List[int]]:
+        token_usage, response = await backend.aquery_model(
+            prompt=Agent._lookup_prompt(memory, question, candidates), cache_prefix=memory
+        )
+        return token_usage, Agent._parse_lookup(response, num_pages, verbose)
+
+    @staticmethod
+    @traced("lookup")
+    async def aparallel_lookup(gists, pages, question, backend, verbose=True, index: Optional[RetrievalIndex] = None,
+                               top_k=8, outline_words=12):
+        """Async version of ``parallel_lookup``."""
+        memory, candidates = Agent._lookup_memory(gists, index, question, top_k, outline_words)
+        total_token_used, page_ids = await Agent._alookup_pages(memory, len(pages), question, backend, verbose,
+                                                                candidates)
+        prompt_answer = Agent._answer_prompt(memory, pages, page_ids, question, backend, verbose, candidates)
+
+        token_usage, response = await backend.aquery_model(prompt=prompt_answer, cache_prefix=memory)
+        total_token_used += token_usage
+        logger.info(f"[Look Up] Token usage: {total_token_used}")
+        return response.strip()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import os
+from tempfile import NamedTemporaryFile
+from typing import Any, Dict, List, Optional
+
+from reading_agent.backends.base import BackendBase
+from reading_agent.document import Document, DocumentFormatError
+from reading_agent.utils import extractor_identity
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ArtifactStore:
+    """On-disk store of extraction and reading results, keyed by content hashes.
+
+    Layout: ``<root>/<kind>/<key[:2]>/<key>.json``, and ``<key>.doc`` for documents. Writes go through a temporary file and ``os.replace`` so
+    concurrent readers never see a partial artifact.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def paragraphs_key(pdf_bytes: bytes, extractor: Any) -> str:
+        """Key of the paragraphs extracted from ``pdf_bytes`` by ``extractor`` with its current settings."""
+        return _hash(hashlib.sha256(pdf_bytes).hexdigest(), extractor_identity(extractor))
+
+    @staticmethod
+    def reading_key(paragraphs: List[str], backend: BackendBase, **pagination_params: Any) -> str:
+        """Key of the pages and gists read from ``paragraphs``.
+
+        The paragraphs are hashed rather than the PDF so that paragraphs edited in the UI get their own entry, and
+        the token limits of the backend are part of the key since pages are sized to them.
+        """
+        paragraphs_hash = hashlib.sha256("\n\n".join(paragraphs).encode("utf-8")).hexdigest()
+        limits = {"context_window": backend.context_window, "max_output_tokens": backend.max_output_tokens}
+        return _hash(paragraphs_hash, backend.identity(), limits, pagination_params)
+
+    @staticmethod
+    def gist_tree_key(gists: List[str], backend: BackendBase, branching: int) -> str:
+        """Key of the section gists built over ``gists``."""
+        return _hash(hashlib.sha256("\n\n".join(gists).encode("utf-8")).hexdigest(), backend.identity(), branching)
+
+    def _path(self, kind: str, key: str, extension: str = "json") -> str:
+        return os.path.join(self.root, kind, key[:2], f"{key}.{extension}")
+
+    def load(self, kind: str, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(kind, key)
+        try:
+            with open(path, "r") as f:
+                artifact = json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            logger.warning(f"[Artifacts] Ignoring corrupted artifact {path}")
+            return None
+        logger.info(f"[Artifacts] Loaded {kind} {key}")
+        return artifact
+
+    def save(self, kind: str, key: str, artifact: Dict[str, Any]):
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+            json.dump(artifact, f)
+        os.replace(f.name, path)
+        logger.info(f"[Artifacts] Saved {kind} {key}")
+
+    def load_document(self, kind: str, key: str) -> Optional[Document]:
+        """Memory-mapped document saved by ``save_document``."""
+        path = self._path(kind, key, "doc")
+        try:
+            document = Document.load(path)
+        except FileNotFoundError:
+            return None
+        except DocumentFormatError as e:
+            logger.warning(f"[Artifacts] Ignoring unreadable document {path}: {e}")
+            return None
+        logger.info(f"[Artifacts] Loaded {kind} document {key}")
+        return document
+
+    def save_document(self, kind: str, key: str, document: Document):
+        path = self._path(kind, key, "doc")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        document.save(path)
+        logger.info(f"[Artifacts] Saved {kind} document {key}")
@@ -0,0 +1,96 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator, Tuple
+
+from reading_agent.backends.base import BackendBase
+
+
+class AdmissionControl:
+    """Caps the backend calls in flight across every ``AdmissionControlledBackend`` sharing it.
+
+    Async calls wait on an ``asyncio.Semaphore``, meant for the single event loop of a server, blocking calls
+    on a thread semaphore of the same size.
+    """
+
+    def __init__(self, max_concurrent_calls: int = 16):
+        if max_concurrent_calls < 1:
+            raise ValueError("max_concurrent_calls must be at least 1")
+        self.max_concurrent_calls = max_concurrent_calls
+        self._async_slots = asyncio.Semaphore(max_concurrent_calls)
+        self._slots = threading.BoundedSemaphore(max_concurrent_calls)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+
+    def _update(self, waiting: int = 0, in_flight: int = 0):
+        with self._lock:
+            self.waiting += waiting
+            self.in_flight += in_flight
+            self.admitted += max(0, in_flight)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        self._update(waiting=1)
+        try:
+            self._slots.acquire()
+        finally:
+            self._update(waiting=-1)
+        self._update(in_flight=1)
+        try:
+            yield
+        finally:
+            self._slots.release()
+            self._update(in_flight=-1)
+
+    @asynccontextmanager
+    async def aslot(self) -> AsyncIterator[None]:
+        self._update(waiting=1)
+        try:
+            await self._async_slots.acquire()
+        finally:
+            self._update(waiting=-1)
+        self._update(in_flight=1)
+        try:
+            yield
+        finally:
+            self._async_slots.release()
+            self._update(in_flight=-1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"max_concurrent_calls": self.max_concurrent_calls, "in_flight": self.in_flight,
+                    "waiting": self.waiting, "admitted": self.admitted}
+
+
+class AdmissionControlledBackend(BackendBase):
+    """Wraps any backend so that its calls only start once ``admission`` has a free slot."""
+
+    def __init__(self, backend: BackendBase, admission: AdmissionControl):
+        self.backend = backend
+        self.admission = admission
+
+    def identity(self):
+        return self.backend.identity()
+
+    @property
+    def context_window(self) -> int:
+        return self.backend.context_window
+
+    @property
+    def max_output_tokens(self) -> int:
+        return self.backend.max_output_tokens
+
+    def query_model(self, prompt: str, **kwargs) -> Tuple[int, str]:
+        with self.admission.slot():
+            return self.backend.query_model(prompt, **kwargs)
+
+    def stream_query_model(self, prompt: str, **kwargs) -> Iterator[Tuple[int, str]]:
+        # the slot is held until the stream is consumed or closed
+        with self.admission.slot():
+            yield from self.backend.stream_query_model(prompt, **kwargs)
+
+    async def aquery_model(self, prompt: str, **kwargs) -> Tuple[int, str]:
+        async with self.admission.aslot():
+            return await self.backend.aquery_model(prompt, **kwargs)
@@ -1,16 +1,59 @@
+import asyncio
 from abc import ABC
-from typing import Tuple
+from typing import Any, Dict, Iterator, Optional, Tuple
 
 
 class BackendBase(ABC):
-    def query_model(self, prompt: str) -> Tuple[int, str]:
+    # tokens of prompt and response the model takes in one call, and response tokens it generates at most
+    context_window: int = 8192
+    max_output_tokens: int = 1024
+
+    def query_model(self, prompt: str, cache_prefix: Optional[str] = None) -> Tuple[int, str]:
         """
 
         Args:
             prompt (str):
+            cache_prefix (str): leading part of ``prompt`` shared by other calls, byte for byte. Backends with
+                provider prompt caching mark it cacheable and report the cached input tokens through
+                ``tracer.record_usage(prompt_cached_tokens=...)``, the others ignore it.
 
         Returns:
             int: token usage
             str: response
         """
         raise NotImplementedError
+
+    def stream_query_model(self, prompt: str, cache_prefix: Optional[str] = None) -> Iterator[Tuple[int, str]]:
+        """Stream the response as it is generated.
+
+        Backends with a streaming API override this. The default yields the whole ``query_model`` response at once.
+
+        Args:
+            prompt (str):
+            cache_prefix (str): see ``query_model``
+
+        Yields:
+            int: token usage, 0 for every pair but the last one, which carries the usage of the whole call
+            str: text delta, the last one may be empty
+        """
+        yield self.query_model(prompt, cache_prefix=cache_prefix)
+
+    def identity(self) -> Dict[str, Any]:
+        """Everything besides the prompt that determines the response: backend, model id and decoding parameters."""
+        return {"backend": type(self).__name__}
+
+    async def aquery_model(self, prompt: str, cache_prefix: Optional[str] = None) -> Tuple[int, str]:
+        """Async counterpart of ``query_model``.
+
+        Backends with an async client override this. The default runs ``query_model`` in a worker thread so
+        every backend can be awaited.
+
+        Args:
+            prompt (str):
+            cache_prefix (str): see ``query_model``
+
+        Returns:
+            int: token usage
+            str: response
+        """
+        return await asyncio.to_thread(self.query_model, prompt, cache_prefix=cache_prefix)
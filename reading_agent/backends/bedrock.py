@@ -10,41 +10,132 @@ to run inferences using Anthropic Claude 3 models.
 
 import json
 import logging
+from typing import Optional
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 from reading_agent.backends.base import BackendBase
+from reading_agent.backends.rate_limit import (budget_from_env, estimate_tokens, get_rate_limiter,
+                                               parse_retry_after)
+from reading_agent.metrics import tracer
 
 logger = logging.getLogger(__name__)
 
+_THROTTLING_ERROR_CODES = {
+    "ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException", "ModelNotReadyException",
+}
+
+
+# models Bedrock supports prompt caching for, others reject requests with cache breakpoints
+PROMPT_CACHING_MODELS = {
+    "anthropic.claude-3-5-haiku-20241022-v1:0",
+    "anthropic.claude-3-7-sonnet-20250219-v1:0",
+    "anthropic.claude-sonnet-4-20250514-v1:0",
+    "anthropic.claude-opus-4-20250514-v1:0",
+}
+
+
+def supports_prompt_caching(model_id: str) -> bool:
+    """Whether ``model_id``, or the model of a cross-region inference profile like ``us.<model id>``, caches."""
+    return model_id in PROMPT_CACHING_MODELS or model_id.split(".", 1)[-1] in PROMPT_CACHING_MODELS
+
+
+def _is_throttled(e: Exception) -> bool:
+    return isinstance(e, ClientError) and e.response["Error"]["Code"] in _THROTTLING_ERROR_CODES
+
+
+def _retry_after(e: Exception) -> Optional[float]:
+    return parse_retry_after(e.response.get("ResponseMetadata", {}).get("HTTPHeaders"))
+
 
 # snippet-start:[python.example_code.bedrock-runtime.Claude3Wrapper.class]
 class Claude3Backend(BackendBase):
     """Encapsulates Claude 3 model invocations using the Amazon Bedrock Runtime client."""
 
-    def __init__(self, model_id: str = "anthropic.claude-3-haiku-20240307-v1:0"):
+    def __init__(self, model_id: str = "anthropic.claude-3-haiku-20240307-v1:0", max_tokens: int = 1024,
+                 requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 8, context_window: int = 200_000, max_pool_connections: int = 32,
+                 prompt_caching: Optional[bool] = None):
         """
-        :param client: A low-level client representing Amazon Bedrock Runtime.
-                       Describes the API operations for running inference using Bedrock models.
-                       Default: None
+        :param model_id: Bedrock model id.
+        :param max_tokens: Max output tokens.
+        :param requests_per_minute: Request quota, defaults to BEDROCK_REQUESTS_PER_MINUTE.
+        :param tokens_per_minute: Token quota, defaults to BEDROCK_TOKENS_PER_MINUTE.
+        :param max_retries: Throttled attempts retried before giving up.
+        :param context_window: Context window of the model.
+        :param max_pool_connections: Keep-alive connections kept for the threads sharing the client.
+        :param prompt_caching: Mark cache prefixes as cache breakpoints, by default if the model supports it.
         """
-        # Initialize the Amazon Bedrock runtime client
+        # Initialize the Amazon Bedrock runtime client, retries are left to the shared rate limiter
         self.client = boto3.client(
-            service_name="bedrock-runtime", region_name="us-east-1"
+            service_name="bedrock-runtime", region_name="us-east-1",
+            config=Config(retries={"total_max_attempts": 1, "mode": "standard"},
+                          max_pool_connections=max_pool_connections),
         )
         self.model_id = model_id
+        self.max_tokens = max_tokens
+        self.max_output_tokens = max_tokens
+        self.context_window = context_window
+        self.prompt_caching = supports_prompt_caching(model_id) if prompt_caching is None else prompt_caching
+        env_requests_per_minute, env_tokens_per_minute = budget_from_env("BEDROCK")
+        self.rate_limiter = get_rate_limiter(
+            f"bedrock:{model_id}", requests_per_minute or env_requests_per_minute,
+            tokens_per_minute or env_tokens_per_minute, max_retries=max_retries,
+        )
+
+    def identity(self):
+        return {**super().identity(), "model": self.model_id, "max_tokens": self.max_tokens}
 
-    def query_model(self, prompt):
-        result = self.invoke_claude_3_with_text(prompt)
-        input_tokens = result["usage"]["input_tokens"]
+    @staticmethod
+    def _input_tokens(usage):
+        """Input tokens including those read from and written to the prompt cache, and the ones read from it."""
+        cache_read = usage.get("cache_read_input_tokens") or 0
+        return usage["input_tokens"] + cache_read + (usage.get("cache_creation_input_tokens") or 0), cache_read
+
+    def query_model(self, prompt, cache_prefix=None):
+        result = self.invoke_claude_3_with_text(prompt, cache_prefix)
+        input_tokens, cache_read = self._input_tokens(result["usage"])
         output_tokens = result["usage"]["output_tokens"]
+        tracer.record_usage(input_tokens, output_tokens, prompt_cached_tokens=cache_read)
         return input_tokens + output_tokens, result["content"][0]["text"]
 
+    def stream_query_model(self, prompt, cache_prefix=None):
+        estimated_tokens = estimate_tokens(prompt, self.max_tokens)
+        try:
+            response = self.rate_limiter.call(
+                lambda: self.client.invoke_model_with_response_stream(
+                    modelId=self.model_id, body=json.dumps(self._text_request_body(prompt, cache_prefix))
+                ),
+                estimated_tokens, _is_throttled, _retry_after,
+            )
+        except ClientError as err:
+            logger.error(
+                f"Couldn't invoke {self.model_id}. Here's why: %s: %s",
+                err.response["Error"]["Code"],
+                err.response["Error"]["Message"],
+            )
+            raise
+        input_tokens = output_tokens = cache_read = 0
+        for event in response["body"]:
+            chunk = json.loads(event["chunk"]["bytes"])
+            if chunk["type"] == "message_start":
+                input_tokens, cache_read = self._input_tokens(chunk["message"]["usage"])
+            elif chunk["type"] == "content_block_delta":
+                yield 0, chunk["delta"].get("text", "")
+            elif chunk["type"] == "message_delta":
+                output_tokens = chunk["usage"]["output_tokens"]
+        self.rate_limiter.settle(estimated_tokens, input_tokens + output_tokens)
+        tracer.record_usage(input_tokens, output_tokens, prompt_cached_tokens=cache_read)
+        yield input_tokens + output_tokens, ""
+
+    # boto3 has no async client, aquery_model falls back to BackendBase running query_model in a worker thread.
+
     def _process_response(self, response):
         # Process and logger.info the response
         result = json.loads(response.get("body").read())
-        input_tokens = result["usage"]["input_tokens"]
+        input_tokens, _ = self._input_tokens(result["usage"])
         output_tokens = result["usage"]["output_tokens"]
         output_list = result.get("content", [])
 
@@ -58,33 +149,49 @@ class Claude3Backend(BackendBase):
 
         return result
 
-    def invoke_claude_3_with_text(self, prompt):
+    def _text_request_body(self, prompt, cache_prefix=None):
+        content = [{"type": "text", "text": prompt}]
+        if self.prompt_caching and cache_prefix and prompt.startswith(cache_prefix) and len(prompt) > len(cache_prefix):
+            # the shared prefix becomes its own block ending at a cache breakpoint
+            content = [
+                {"type": "text", "text": cache_prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": prompt[len(cache_prefix):]},
+            ]
+        return {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": self.max_tokens,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": content,
+                }
+            ],
+        }
+
+    def invoke_claude_3_with_text(self, prompt, cache_prefix=None):
         """
         Invokes Anthropic Claude 3 Sonnet to run an inference using the input
         provided in the request body.
 
         :param prompt: The prompt that you want Claude 3 to complete.
+        :param cache_prefix: Leading part of the prompt to cache for later calls.
         :return: Inference response from the model.
         """
 
 
+        estimated_tokens = estimate_tokens(prompt, self.max_tokens)
         try:
-            response = self.client.invoke_model(
-                modelId=self.model_id,
-                body=json.dumps(
-                    {
-                        "anthropic_version": "bedrock-2023-05-31",
-                        "max_tokens": 1024,
-                        "messages": [
-                            {
-                                "role": "user",
-                                "content": [{"type": "text", "text": prompt}],
-                            }
-                        ],
-                    }
+            response = self.rate_limiter.call(
+                lambda: self.client.invoke_model(
+                    modelId=self.model_id,
+                    body=json.dumps(self._text_request_body(prompt, cache_prefix)),
                 ),
+                estimated_tokens, _is_throttled, _retry_after,
             )
             result = self._process_response(response)
+            self.rate_limiter.settle(
+                estimated_tokens, self._input_tokens(result["usage"])[0] + result["usage"]["output_tokens"]
+            )
             return result
 
         except ClientError as err:
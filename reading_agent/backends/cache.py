@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator, Optional, Tuple
+
+from reading_agent.backends.base import BackendBase
+from reading_agent.metrics import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Content-addressed SQLite store of backend responses.
+
+    Entries older than ``ttl_seconds`` are treated as misses and purged. Once more than ``max_entries`` are
+    stored, the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str, ttl_seconds: Optional[float] = None, max_entries: Optional[int] = 100_000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, token_usage INTEGER, response TEXT, created_at REAL, accessed_at REAL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(backend: BackendBase, prompt: str) -> str:
+        identity = json.dumps(backend.identity(), sort_keys=True)
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{identity}\n{prompt_hash}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[int, str]]:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT token_usage, response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            token_usage, response, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._connection.commit()
+                return None
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+        return token_usage, response
+
+    def put(self, key: str, token_usage: int, response: str):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, token_usage, response, now, now)
+            )
+            self._evict(now)
+            self._connection.commit()
+
+    def _evict(self, now: float):
+        if self.ttl_seconds is not None:
+            self._connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        if self.max_entries is not None:
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class CachedBackend(BackendBase):
+    """Wraps any backend and serves repeated prompts from a ``ResponseCache``.
+
+    A hit reports a token usage of 0 since nothing was billed, the tokens the original call cost are counted
+    in ``cached_tokens`` instead.
+    """
+
+    def __init__(self, backend: BackendBase, cache: ResponseCache):
+        self.backend = backend
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self.cached_tokens = 0
+        self._lock = threading.Lock()
+
+    def identity(self):
+        return self.backend.identity()
+
+    @property
+    def context_window(self) -> int:
+        return self.backend.context_window
+
+    @property
+    def max_output_tokens(self) -> int:
+        return self.backend.max_output_tokens
+
+    def _lookup(self, key: str) -> Optional[str]:
+        cached = self.cache.get(key)
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.cached_tokens += cached[0]
+        tracer.record_usage(cached_tokens=cached[0])
+        return cached[1]
+
+    def query_model(self, prompt: str, **kwargs) -> Tuple[int, str]:
+        key = ResponseCache.make_key(self.backend, prompt)
+        response = self._lookup(key)
+        if response is not None:
+            return 0, response
+        token_usage, response = self.backend.query_model(prompt, **kwargs)
+        self.cache.put(key, token_usage, response)
+        return token_usage, response
+
+    def stream_query_model(self, prompt: str, **kwargs) -> Iterator[Tuple[int, str]]:
+        key = ResponseCache.make_key(self.backend, prompt)
+        response = self._lookup(key)
+        if response is not None:
+            yield 0, response
+            return
+        deltas = []
+        token_usage = 0
+        for token_usage, delta in self.backend.stream_query_model(prompt, **kwargs):
+            deltas.append(delta)
+            yield token_usage, delta
+        self.cache.put(key, token_usage, "".join(deltas))
+
+    async def aquery_model(self, prompt: str, **kwargs) -> Tuple[int, str]:
+        # SQLite reads and writes block, they run in a worker thread so the event loop keeps serving requests
+        key = ResponseCache.make_key(self.backend, prompt)
+        response = await asyncio.to_thread(self._lookup, key)
+        if response is not None:
+            return 0, response
+        token_usage, response = await self.backend.aquery_model(prompt, **kwargs)
+        await asyncio.to_thread(self.cache.put, key, token_usage, response)
+        return token_usage, response
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "cached_tokens": self.cached_tokens}
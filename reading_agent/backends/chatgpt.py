@@ -1,48 +1,147 @@
-import datetime
 import logging
 import os
-import time
-from typing import Tuple
+import threading
+from typing import Any, Dict, Iterator, Optional, Tuple
 
 import openai
 from openai.types.chat import ChatCompletion
 
 from reading_agent.backends.base import BackendBase
+from reading_agent.backends.rate_limit import budget_from_env, estimate_tokens, get_rate_limiter
+from reading_agent.metrics import tracer
 
 logger = logging.getLogger(__name__)
 
 
+def _is_retryable(e: Exception) -> bool:
+    return isinstance(e, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
+
 class GPTBackend(BackendBase):
     def __init__(self, temperature: float = 0.0, max_decode_steps: int = 512,
-                 seconds_to_reset_tokens: float = 30.0, **kwargs):
+                 requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 8, context_window: Optional[int] = None, **kwargs):
+        """
+        Args:
+            temperature: sampling temperature
+            max_decode_steps: max completion tokens
+            requests_per_minute: request quota of the deployment, defaults to ``GPT_REQUESTS_PER_MINUTE``
+            tokens_per_minute: token quota of the deployment, defaults to ``GPT_TOKENS_PER_MINUTE``
+            max_retries: throttled attempts retried before giving up
+            context_window: context window of the deployed model, defaults to ``GPT_CONTEXT_WINDOW``, else 8192
+        """
         super().__init__(**kwargs)
         self.deployment = os.environ["GPT_DEPLOYMENT_NAME"]
         self.temperature = temperature
         self.max_decode_steps = max_decode_steps
-        self.seconds_to_reset_tokens = seconds_to_reset_tokens
+        self.max_output_tokens = max_decode_steps
+        self.context_window = context_window or int(os.environ.get("GPT_CONTEXT_WINDOW", 8192))
+        env_requests_per_minute, env_tokens_per_minute = budget_from_env("GPT")
+        # one limiter per deployment, shared by every backend instance and worker of the process
+        self.rate_limiter = get_rate_limiter(
+            f"gpt:{self.deployment}", requests_per_minute or env_requests_per_minute,
+            tokens_per_minute or env_tokens_per_minute, max_retries=max_retries,
+        )
+        # retries are left to the rate limiter so concurrent workers back off together
         self.client = openai.AzureOpenAI(
             azure_endpoint=os.environ["GPT_ENDPOINT"],
             api_key=os.environ["GPT_API_KEY"],
             api_version=os.environ["GPT_API_VERSION"],
+            max_retries=0,
         )
+        self._async_client = None
+        self._async_client_lock = threading.Lock()
 
-    def query_model(self, prompt: str, **kwargs) -> Tuple[int, str]:
-        while True:
-            try:
-                raw_response = self.client.chat.completions.with_raw_response.create(
-                    model=self.deployment,
-                    max_tokens=self.max_decode_steps,
-                    temperature=self.temperature,
-                    messages=[
-                        {'role': 'user', 'content': prompt},
-                    ]
+    @property
+    def async_client(self) -> openai.AsyncAzureOpenAI:
+        """Async client, created on the first async call since most processes only use the blocking one."""
+        with self._async_client_lock:
+            if self._async_client is None:
+                self._async_client = openai.AsyncAzureOpenAI(
+                    azure_endpoint=os.environ["GPT_ENDPOINT"],
+                    api_key=os.environ["GPT_API_KEY"],
+                    api_version=os.environ["GPT_API_VERSION"],
+                    max_retries=0,
                 )
-                completion: ChatCompletion = raw_response.parse()
-                return completion.usage.total_tokens, completion.choices[0].message.content
-            except (openai.RateLimitError, openai.Timeout) as e:
-                logger.warning(f'{datetime.datetime.now()}: query_gpt_model: {type(e)} {e.message}: {e}')
-                logger.error(f'{datetime.datetime.now()}: query_gpt_model: Retrying after {self.seconds_to_reset_tokens} seconds...')
-                time.sleep(self.seconds_to_reset_tokens)
-            except openai.APIError as e:
-                logger.error(f'{datetime.datetime.now()}: query_gpt_model: APIError {e.message}: {e}')
-                raise
+        return self._async_client
+
+    def identity(self) -> Dict[str, Any]:
+        return {
+            **super().identity(),
+            "model": self.deployment,
+            "temperature": self.temperature,
+            "max_tokens": self.max_decode_steps,
+        }
+
+    def _completion_kwargs(self, prompt: str) -> dict:
+        return dict(
+            model=self.deployment,
+            max_tokens=self.max_decode_steps,
+            temperature=self.temperature,
+            messages=[
+                {'role': 'user', 'content': prompt},
+            ]
+        )
+
+    def _record_usage(self, usage, estimated_tokens: int):
+        # Azure OpenAI caches prompt prefixes on its own, a shared ``cache_prefix`` only needs to lead the prompt
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.rate_limiter.settle(estimated_tokens, usage.total_tokens)
+        tracer.record_usage(usage.prompt_tokens, usage.completion_tokens,
+                            prompt_cached_tokens=getattr(details, "cached_tokens", None) or 0)
+
+    def _parse_completion(self, completion: ChatCompletion, estimated_tokens: int) -> Tuple[int, str]:
+        self._record_usage(completion.usage, estimated_tokens)
+        return completion.usage.total_tokens, completion.choices[0].message.content
+
+    def query_model(self, prompt: str, cache_prefix: Optional[str] = None, **kwargs) -> Tuple[int, str]:
+        estimated_tokens = estimate_tokens(prompt, self.max_decode_steps)
+        try:
+            completion = self.rate_limiter.call(
+                lambda: self.client.chat.completions.create(**self._completion_kwargs(prompt)),
+                estimated_tokens, _is_retryable,
+            )
+        except openai.APIError as e:
+            logger.error(f'query_gpt_model: APIError {e.message}: {e}')
+            raise
+        return self._parse_completion(completion, estimated_tokens)
+
+    def stream_query_model(self, prompt: str, cache_prefix: Optional[str] = None,
+                           **kwargs) -> Iterator[Tuple[int, str]]:
+        estimated_tokens = estimate_tokens(prompt, self.max_decode_steps)
+        try:
+            stream = self.rate_limiter.call(
+                lambda: self.client.chat.completions.create(
+                    **self._completion_kwargs(prompt), stream=True, stream_options={"include_usage": True}
+                ),
+                estimated_tokens, _is_retryable,
+            )
+        except openai.APIError as e:
+            logger.error(f'stream_gpt_model: APIError {e.message}: {e}')
+            raise
+        token_usage = None
+        response = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                response.append(chunk.choices[0].delta.content)
+                yield 0, chunk.choices[0].delta.content
+            if chunk.usage is not None:
+                token_usage = chunk.usage.total_tokens
+                self._record_usage(chunk.usage, estimated_tokens)
+        if token_usage is None:
+            # api versions older than 2024-07-01-preview ignore ``stream_options`` and send no usage chunk
+            token_usage = estimate_tokens(prompt) + estimate_tokens(''.join(response))
+            self.rate_limiter.settle(estimated_tokens, token_usage)
+        yield token_usage, ""
+
+    async def aquery_model(self, prompt: str, cache_prefix: Optional[str] = None, **kwargs) -> Tuple[int, str]:
+        estimated_tokens = estimate_tokens(prompt, self.max_decode_steps)
+        try:
+            completion = await self.rate_limiter.acall(
+                lambda: self.async_client.chat.completions.create(**self._completion_kwargs(prompt)),
+                estimated_tokens, _is_retryable,
+            )
+        except openai.APIError as e:
+            logger.error(f'aquery_gpt_model: APIError {e.message}: {e}')
+            raise
+        return self._parse_completion(completion, estimated_tokens)
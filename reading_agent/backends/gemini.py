@@ -1,29 +1,91 @@
 import logging
 import os
+from typing import Any, Dict, Iterator, Optional, Tuple
 
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 
 from reading_agent.backends.base import BackendBase
+from reading_agent.backends.rate_limit import budget_from_env, estimate_tokens, get_rate_limiter
+from reading_agent.metrics import tracer
 
 logger = logging.getLogger(__name__)
 
 
+def _is_retryable(e: Exception) -> bool:
+    return isinstance(e, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests,
+                          google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                          google_exceptions.DeadlineExceeded))
+
+
 class GeminiBackend(BackendBase):
-    def __init__(self):
+    def __init__(self, model_id: str = 'gemini-pro', retries: int = 10,
+                 requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 context_window: int = 30720, max_output_tokens: int = 2048):
+        """
+        Args:
+            model_id: Gemini model
+            retries: throttled attempts retried before giving up
+            requests_per_minute: request quota, defaults to ``GEMINI_REQUESTS_PER_MINUTE``
+            tokens_per_minute: token quota, defaults to ``GEMINI_TOKENS_PER_MINUTE``
+            context_window: input token limit of the model
+            max_output_tokens: output token limit of the model
+        """
         genai.configure(api_key=os.environ["GEMINI_API_KEY"])
-        self.client = genai.GenerativeModel('gemini-pro')
-
-    def query_gemini_model(
-            self,
-            prompt: str,
-            retries: int = 10,
-    ) -> str:
-        while retries > 0:
-            try:
-                response = self.client.generate_content(prompt)
-                text_response = response.text.replace("**", "")
-                return text_response
-            except Exception as e:
-                logger.error(f'Error: {e}')
-                logger.error('Retrying after 5 seconds...')
-                retries -= 1
+        self.model_id = model_id
+        self.context_window = context_window
+        self.max_output_tokens = max_output_tokens
+        self.client = genai.GenerativeModel(model_id)
+        env_requests_per_minute, env_tokens_per_minute = budget_from_env("GEMINI")
+        self.rate_limiter = get_rate_limiter(
+            f"gemini:{model_id}", requests_per_minute or env_requests_per_minute,
+            tokens_per_minute or env_tokens_per_minute, max_retries=retries,
+        )
+
+    def identity(self) -> Dict[str, Any]:
+        return {**super().identity(), "model": self.model_id}
+
+    def _parse_response(self, response, estimated_tokens: int) -> Tuple[int, str]:
+        usage_metadata = getattr(response, "usage_metadata", None)
+        if usage_metadata is None:
+            # without usage the call is charged the estimate of its prompt and response
+            token_usage = estimated_tokens + estimate_tokens(response.text)
+            self.rate_limiter.settle(estimated_tokens, token_usage)
+            return token_usage, response.text.replace("**", "")
+        self.rate_limiter.settle(estimated_tokens, usage_metadata.total_token_count)
+        # Gemini only reuses explicitly created cached contents, ``cache_prefix`` is not acted upon
+        tracer.record_usage(usage_metadata.prompt_token_count, usage_metadata.candidates_token_count,
+                            prompt_cached_tokens=getattr(usage_metadata, "cached_content_token_count", 0) or 0)
+        return usage_metadata.total_token_count, response.text.replace("**", "")
+
+    def query_model(self, prompt: str, cache_prefix: Optional[str] = None, **kwargs) -> Tuple[int, str]:
+        estimated_tokens = estimate_tokens(prompt)
+        response = self.rate_limiter.call(lambda: self.client.generate_content(prompt), estimated_tokens,
+                                          _is_retryable)
+        return self._parse_response(response, estimated_tokens)
+
+    def stream_query_model(self, prompt: str, cache_prefix: Optional[str] = None,
+                           **kwargs) -> Iterator[Tuple[int, str]]:
+        estimated_tokens = estimate_tokens(prompt)
+        response = self.rate_limiter.call(lambda: self.client.generate_content(prompt, stream=True),
+                                          estimated_tokens, _is_retryable)
+        chunks = []
+        for chunk in response:
+            chunks.append(chunk.text)
+            yield 0, chunk.text.replace("**", "")
+        usage_metadata = getattr(response, "usage_metadata", None)
+        if usage_metadata is not None:
+            token_usage = usage_metadata.total_token_count
+        else:
+            token_usage = estimated_tokens + estimate_tokens(''.join(chunks))
+        self.rate_limiter.settle(estimated_tokens, token_usage)
+        yield token_usage, ""
+
+    async def aquery_model(self, prompt: str, cache_prefix: Optional[str] = None, **kwargs) -> Tuple[int, str]:
+        estimated_tokens = estimate_tokens(prompt)
+        response = await self.rate_limiter.acall(lambda: self.client.generate_content_async(prompt),
+                                                 estimated_tokens, _is_retryable)
+        return self._parse_response(response, estimated_tokens)
+
+    def query_gemini_model(self, prompt: str) -> str:
+        return self.query_model(prompt)[1]
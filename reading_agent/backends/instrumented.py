@@ -0,0 +1,76 @@
+import time
+from typing import Iterator, Tuple
+
+from reading_agent.backends.base import BackendBase
+from reading_agent.metrics import Span, Tracer, tracer as default_tracer
+from reading_agent.tokens import get_estimator
+
+
+class InstrumentedBackend(BackendBase):
+    """Wraps any backend and records every call as a span of ``tracer``.
+
+    Latency and total tokens are measured here, the input/output split, retries and backoff sleeps are
+    reported by the wrapped backend while the call is in flight. The billed input tokens calibrate the token
+    estimator of the model.
+    """
+
+    def __init__(self, backend: BackendBase, tracer: Tracer = default_tracer):
+        self.backend = backend
+        self.tracer = tracer
+        self.name = backend.identity().get("backend", type(backend).__name__)
+
+    def identity(self):
+        return self.backend.identity()
+
+    @property
+    def context_window(self) -> int:
+        return self.backend.context_window
+
+    @property
+    def max_output_tokens(self) -> int:
+        return self.backend.max_output_tokens
+
+    def _calibrate(self, prompt: str, span: Span):
+        if span.input_tokens:
+            get_estimator(self.backend).observe(prompt, span.input_tokens)
+
+    def query_model(self, prompt: str, **kwargs) -> Tuple[int, str]:
+        with self.tracer.call(self.name) as span:
+            token_usage, response = self.backend.query_model(prompt, **kwargs)
+            span.total_tokens = token_usage
+        self._calibrate(prompt, span)
+        return token_usage, response
+
+    async def aquery_model(self, prompt: str, **kwargs) -> Tuple[int, str]:
+        with self.tracer.call(self.name, "aquery_model") as span:
+            token_usage, response = await self.backend.aquery_model(prompt, **kwargs)
+            span.total_tokens = token_usage
+        self._calibrate(prompt, span)
+        return token_usage, response
+
+    def stream_query_model(self, prompt: str, **kwargs) -> Iterator[Tuple[int, str]]:
+        # the consumer runs between deltas, so the span is only current while the wrapped stream steps
+        span = self.tracer.detached_call(self.name, "stream_query_model")
+        start = time.perf_counter()
+        stream = self.backend.stream_query_model(prompt, **kwargs)
+        try:
+            while True:
+                with self.tracer.current(span):
+                    step = next(stream, None)
+                if step is None:
+                    break
+                token_usage, delta = step
+                if span.first_token_latency is None and delta:
+                    span.first_token_latency = time.perf_counter() - start
+                span.total_tokens += token_usage
+                yield token_usage, delta
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            stream.close()
+            span.latency = time.perf_counter() - start
+            self.tracer.finish(span)
+        self._calibrate(prompt, span)
@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import itertools
+import random
+import re
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+from reading_agent.backends.base import BackendBase
+from reading_agent.backends.rate_limit import RateLimiter, estimate_tokens
+from reading_agent.metrics import tracer
+
+
+class MockRateLimitError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limited, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class MockBackend(BackendBase):
+    """Deterministic offline backend for benchmarks and local runs.
+
+    Responses are derived from the prompt: valid break points for pagination, page lists for look-ups,
+    truncated passages for shortening. Latency is drawn from a log-normal distribution and calls are
+    rate limited at random. Every draw is seeded by ``seed``, the prompt and the attempt, so results do not
+    depend on how concurrent calls interleave.
+
+    A ``cache_prefix`` must lead its prompt, else ``ValueError`` is raised. Like a provider prompt cache, a
+    prefix seen before byte for byte is a hit and its tokens are reported as ``prompt_cached_tokens``.
+    """
+
+    def __init__(self, seed: int = 0, latency_median: float = 0.0, latency_sigma: float = 0.5,
+                 rate_limit_probability: float = 0.0, retry_after: float = 0.01, max_retries: int = 5,
+                 gist_ratio: float = 0.3, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None, context_window: int = 1_000_000,
+                 max_output_tokens: int = 1024):
+        """
+        Args:
+            seed: seed of every random draw
+            latency_median: median simulated latency in seconds, 0 disables sleeping
+            latency_sigma: shape of the log-normal latency distribution
+            rate_limit_probability: probability of every attempt being rate limited
+            retry_after: retry-after in seconds of a simulated rate limit
+            max_retries: rate limited attempts retried before ``RetriesExhausted`` is raised
+            gist_ratio: fraction of the passage words kept when shortening
+            requests_per_minute: client-side request budget, None for unlimited
+            tokens_per_minute: client-side token budget, None for unlimited
+            context_window: simulated context window, longer prompts raise ``ValueError``
+            max_output_tokens: simulated output limit, longer responses are cut
+        """
+        self.seed = seed
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after = retry_after
+        self.max_retries = max_retries
+        self.gist_ratio = gist_ratio
+        self.context_window = context_window
+        self.max_output_tokens = max_output_tokens
+        self.calls = 0
+        self.rate_limited = 0
+        self.latencies = []
+        self.prefix_hits = 0
+        self.prefix_misses = 0
+        self._prefixes = set()
+        self._lock = threading.Lock()
+        # not shared through ``get_rate_limiter``, every mock simulates its own quota
+        self.rate_limiter = RateLimiter("mock", requests_per_minute, tokens_per_minute, max_retries=max_retries,
+                                        base_delay=retry_after)
+
+    def identity(self):
+        return {**super().identity(), "seed": self.seed, "gist_ratio": self.gist_ratio}
+
+    def _rng(self, prompt: str, attempt: int) -> random.Random:
+        digest = hashlib.sha256(f"{self.seed}:{attempt}:{prompt}".encode("utf-8")).hexdigest()
+        return random.Random(int(digest[:16], 16))
+
+    def _attempt(self, prompt: str, attempt: int) -> Tuple[float, bool]:
+        """Simulated latency of the attempt and whether it is rate limited."""
+        rng = self._rng(prompt, attempt)
+        latency = rng.lognormvariate(0.0, self.latency_sigma) * self.latency_median if self.latency_median else 0.0
+        limited = rng.random() < self.rate_limit_probability
+        with self._lock:
+            self.calls += 1
+            self.rate_limited += limited
+            if not limited:
+                self.latencies.append(latency)
+        return latency, limited
+
+    @staticmethod
+    def _token_count(text: str) -> int:
+        return len(text.split()) * 4 // 3 + 1
+
+    def respond(self, prompt: str) -> Tuple[int, int, str]:
+        """Input tokens, output tokens and the response to ``prompt``."""
+        rng = self._rng(prompt, -1)
+        if "Break point:" in prompt:
+            labels = re.findall(r"^<(\d+)>$", prompt, flags=re.MULTILINE)
+            # favour later labels like a model that prefers long pages
+            label = labels[min(len(labels) - 1, int(len(labels) * rng.uniform(0.5, 1.0)))] if labels else "0"
+            response = f"Break point: <{label}>\nBecause it ends a section."
+        elif "Specify a SINGLE page" in prompt:
+            page_ids = self._labels(prompt, "Page")
+            response = "STOP" if rng.random() < 0.4 else f"Page {rng.choice(page_ids)}"
+        elif "would you like to read again" in prompt:
+            page_ids = self._labels(prompt, "Page")
+            page_ids = sorted(rng.sample(page_ids, k=min(len(page_ids), rng.randint(1, 3))))
+            response = f"I want to look up Page {page_ids} to answer the question."
+        elif "would you like to open" in prompt:
+            section_ids = self._labels(prompt, "Section")
+            section_ids = sorted(rng.sample(section_ids, k=min(len(section_ids), rng.randint(1, 2))))
+            response = f"I want to open Section {section_ids} to answer the question."
+        elif "Please shorten the following passage" in prompt:
+            passage = prompt.split("Passage:", 1)[1].split()
+            # cut at the output limit like a real model
+            response = " ".join(passage[:max(1, min(int(len(passage) * self.gist_ratio),
+                                                    self.max_output_tokens * 3 // 4))])
+        elif "Questions:" in prompt:
+            questions = prompt.rsplit("Questions:", 1)[-1].replace("Answers:", "").strip().splitlines()
+            response = "\n".join(f"Answer {i + 1}: The article says {' '.join(q.split()[1:13])}"
+                                  for i, q in enumerate(questions))
+        else:
+            question = prompt.rsplit("Question:", 1)[-1].replace("Answer:", "").split()
+            response = "The article says " + " ".join(question[:12])
+        return self._token_count(prompt), self._token_count(response), response
+
+    def _check_context(self, prompt: str):
+        if self._token_count(prompt) + self.max_output_tokens > self.context_window:
+            raise ValueError(f"prompt of {self._token_count(prompt)} tokens overruns the context window of "
+                             f"{self.context_window} with {self.max_output_tokens} output tokens")
+
+    @staticmethod
+    def _labels(prompt: str, kind: str) -> List[int]:
+        """Numbers of the ``<Page n>`` or ``<Section n>`` labels of the remembered text, else one per line."""
+        text = prompt.split('"""')[1] if prompt.count('"""') >= 2 else prompt
+        labels = [int(n) for n in re.findall(rf"^<{kind} (\d+)>", text, flags=re.MULTILINE)]
+        return labels or list(range(max(1, len([line for line in text.splitlines() if line.strip()]))))
+
+    def _prefix_cached_tokens(self, prompt: str, cache_prefix: Optional[str]) -> int:
+        if cache_prefix is None:
+            return 0
+        if not prompt.startswith(cache_prefix):
+            raise ValueError("cache_prefix does not lead the prompt")
+        digest = hashlib.sha256(cache_prefix.encode("utf-8")).digest()
+        with self._lock:
+            hit = digest in self._prefixes
+            self._prefixes.add(digest)
+            self.prefix_hits += hit
+            self.prefix_misses += not hit
+        return self._token_count(cache_prefix) if hit else 0
+
+    def _finish(self, prompt: str, cache_prefix: Optional[str] = None) -> Tuple[int, str]:
+        self._check_context(prompt)
+        prompt_cached_tokens = self._prefix_cached_tokens(prompt, cache_prefix)
+        input_tokens, output_tokens, response = self.respond(prompt)
+        tracer.record_usage(input_tokens, output_tokens, prompt_cached_tokens=prompt_cached_tokens)
+        return input_tokens + output_tokens, response
+
+    def _is_rate_limited(self, e: Exception) -> bool:
+        return isinstance(e, MockRateLimitError)
+
+    def query_model(self, prompt: str, cache_prefix: Optional[str] = None, **kwargs) -> Tuple[int, str]:
+        attempts = itertools.count()
+
+        def attempt():
+            latency, limited = self._attempt(prompt, next(attempts))
+            if latency:
+                time.sleep(latency)
+            if limited:
+                raise MockRateLimitError(self.retry_after)
+            return self._finish(prompt, cache_prefix)
+
+        estimated_tokens = estimate_tokens(prompt)
+        token_usage, response = self.rate_limiter.call(attempt, estimated_tokens, self._is_rate_limited,
+                                                       lambda e: e.retry_after)
+        self.rate_limiter.settle(estimated_tokens, token_usage)
+        return token_usage, response
+
+    async def aquery_model(self, prompt: str, cache_prefix: Optional[str] = None, **kwargs) -> Tuple[int, str]:
+        attempts = itertools.count()
+
+        async def attempt():
+            latency, limited = self._attempt(prompt, next(attempts))
+            if latency:
+                await asyncio.sleep(latency)
+            if limited:
+                raise MockRateLimitError(self.retry_after)
+            return self._finish(prompt, cache_prefix)
+
+        estimated_tokens = estimate_tokens(prompt)
+        token_usage, response = await self.rate_limiter.acall(attempt, estimated_tokens, self._is_rate_limited,
+                                                              lambda e: e.retry_after)
+        self.rate_limiter.settle(estimated_tokens, token_usage)
+        return token_usage, response
+
+    def stream_query_model(self, prompt: str, cache_prefix: Optional[str] = None,
+                           **kwargs) -> Iterator[Tuple[int, str]]:
+        token_usage, response = self.query_model(prompt, cache_prefix)
+        words = response.split(" ")
+        for i, word in enumerate(words):
+            yield 0, word if i == 0 else " " + word
+        yield token_usage, ""
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = 0
+            self.rate_limited = 0
+            self.latencies = []
+            self.prefix_hits = 0
+            self.prefix_misses = 0
+            self._prefixes = set()
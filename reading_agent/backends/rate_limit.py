@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from reading_agent.metrics import tracer
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def estimate_tokens(prompt: str, max_output_tokens: int = 0) -> int:
+    """Tokens a call is charged against the budget before its usage is known, like Azure OpenAI's quota."""
+    return len(prompt) // 4 + max_output_tokens
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Seconds from ``retry-after-ms`` or ``retry-after`` response headers, None if absent or an HTTP date."""
+    if not headers:
+        return None
+    for header, scale in (("retry-after-ms", 1000), ("retry-after", 1)):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return float(value) / scale
+        except ValueError:
+            continue
+    return None
+
+
+def budget_from_env(prefix: str) -> Tuple[Optional[float], Optional[float]]:
+    """Requests and tokens per minute from ``<prefix>_REQUESTS_PER_MINUTE`` and ``<prefix>_TOKENS_PER_MINUTE``."""
+    return tuple(
+        float(os.environ[name]) if os.environ.get(name) else None
+        for name in (f"{prefix}_REQUESTS_PER_MINUTE", f"{prefix}_TOKENS_PER_MINUTE")
+    )
+
+
+def retry_after_of(e: Exception) -> Optional[float]:
+    """Retry-after of an exception carrying the HTTP response, like those of openai and google-api-core."""
+    return parse_retry_after(getattr(getattr(e, "response", None), "headers", None))
+
+
+class RetriesExhausted(Exception):
+    pass
+
+
+class _Bucket:
+    """Token bucket refilled continuously at ``per_minute``.
+
+    It holds ten seconds of budget, so bursts stay within the short windows quotas are enforced over.
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.capacity = per_minute / 6
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float, rate_factor: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.per_minute * rate_factor / 60)
+        self.updated = now
+
+    def wait_for(self, amount: float, rate_factor: float) -> float:
+        """Seconds until ``amount`` is available, a request larger than the bucket only waits for a full one."""
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / (self.per_minute * rate_factor))
+
+
+class RateLimiter:
+    """Client-side requests-per-minute and tokens-per-minute budget shared by every worker of a process.
+
+    Calls reserve their estimated tokens up front and ``settle`` the difference with the billed usage, attempts
+    that fail ``release`` their reservation. A
+    throttled call backs off with full jitter, or for the server's retry-after, pauses every other caller of
+    the limiter until then, and lowers the admitted rate, which recovers gradually on every success.
+    """
+
+    def __init__(self, name: str, requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None, max_retries: int = 8, base_delay: float = 1.0,
+                 max_delay: float = 60.0, min_rate_factor: float = 0.1):
+        """
+        Args:
+            name: label used in logs
+            requests_per_minute: request budget, None for unlimited
+            tokens_per_minute: token budget, None for unlimited
+            max_retries: throttled attempts retried before giving up
+            base_delay: backoff cap of the first retry in seconds, doubled every retry
+            max_delay: highest backoff in seconds
+            min_rate_factor: lowest fraction of the budgets admitted after repeated throttling
+        """
+        self.name = name
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_rate_factor = min_rate_factor
+        self.rate_factor = 1.0
+        self.paused_until = 0.0
+        self._requests = None
+        self._tokens = None
+        self._lock = threading.Lock()
+        self.configure(requests_per_minute, tokens_per_minute)
+
+    def configure(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        with self._lock:
+            self._requests = _Bucket(requests_per_minute) if requests_per_minute else None
+            self._tokens = _Bucket(tokens_per_minute) if tokens_per_minute else None
+
+    def _reserve(self, tokens: int) -> float:
+        """Takes budget for a call of ``tokens`` if available, else the seconds to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            wait = self.paused_until - now
+            for bucket, amount in ((self._requests, 1), (self._tokens, tokens)):
+                if bucket is not None:
+                    bucket.refill(now, self.rate_factor)
+                    wait = max(wait, bucket.wait_for(amount, self.rate_factor))
+            if wait > 0:
+                return wait
+            if self._requests is not None:
+                self._requests.level -= 1
+            if self._tokens is not None:
+                self._tokens.level -= tokens
+            return 0.0
+
+    def acquire(self, tokens: int = 0):
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            tracer.record_sleep(wait)
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0):
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            tracer.record_sleep(wait)
+            await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens: int, token_usage: int):
+        """Returns or takes the difference between the reserved and the billed tokens."""
+        with self._lock:
+            if self._tokens is not None and token_usage:
+                self._tokens.level = min(self._tokens.capacity,
+                                         self._tokens.level + estimated_tokens - token_usage)
+            self.rate_factor = min(1.0, self.rate_factor + 0.05)
+
+    def release(self, estimated_tokens: int):
+        """Returns the tokens reserved by an attempt that failed, and was not billed."""
+        with self._lock:
+            if self._tokens is not None:
+                self._tokens.level = min(self._tokens.capacity, self._tokens.level + estimated_tokens)
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Pauses every caller of the limiter before retry ``attempt`` (0-based), returns the pause in seconds."""
+        if retry_after is not None:
+            delay = min(self.max_delay, retry_after) + random.uniform(0, self.base_delay)
+        else:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        with self._lock:
+            now = time.monotonic()
+            # calls throttled together are one signal, the rate is only cut once per pause
+            if now >= self.paused_until:
+                self.rate_factor = max(self.min_rate_factor, self.rate_factor / 2)
+            self.paused_until = max(self.paused_until, now + delay)
+        # the pause itself is waited out, and recorded, by the next ``acquire``
+        tracer.record_retry()
+        return delay
+
+    def _on_throttled(self, e: Exception, attempt: int, retry_after: Callable[[Exception], Optional[float]]):
+        if attempt >= self.max_retries:
+            raise RetriesExhausted(f"{self.name}: gave up after {attempt} retries") from e
+        delay = self.backoff(attempt, retry_after(e))
+        logger.warning(f"[RateLimit] {self.name}: {type(e).__name__}: {e}, retrying in {delay:.1f}s "
+                       f"({attempt + 1}/{self.max_retries})")
+
+    def call(self, func: Callable[[], T], estimated_tokens: int, retryable: Callable[[Exception], bool],
+             retry_after: Callable[[Exception], Optional[float]] = retry_after_of) -> T:
+        """Runs ``func`` within the budget, retrying while it raises exceptions ``retryable`` accepts.
+
+        ``retry_after`` extracts the server's retry-after in seconds from an exception, if any.
+        """
+        attempt = 0
+        while True:
+            self.acquire(estimated_tokens)
+            try:
+                return func()
+            except Exception as e:
+                # successful calls are settled by the caller once their usage is known
+                self.release(estimated_tokens)
+                if not retryable(e):
+                    raise
+                self._on_throttled(e, attempt, retry_after)
+                attempt += 1
+
+    async def acall(self, func: Callable[[], Awaitable[T]], estimated_tokens: int,
+                    retryable: Callable[[Exception], bool],
+                    retry_after: Callable[[Exception], Optional[float]] = retry_after_of) -> T:
+        """Async counterpart of ``call``, ``func`` returns an awaitable."""
+        attempt = 0
+        while True:
+            await self.aacquire(estimated_tokens)
+            try:
+                return await func()
+            except Exception as e:
+                self.release(estimated_tokens)
+                if not retryable(e):
+                    raise
+                self._on_throttled(e, attempt, retry_after)
+                attempt += 1
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str, requests_per_minute: Optional[float] = None,
+                     tokens_per_minute: Optional[float] = None, **kwargs) -> RateLimiter:
+    """The process-wide limiter of ``name``, created on first use. Budgets given later reconfigure it."""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = _limiters[name] = RateLimiter(name, requests_per_minute, tokens_per_minute, **kwargs)
+        elif requests_per_minute or tokens_per_minute:
+            limiter.configure(requests_per_minute, tokens_per_minute)
+    return limiter
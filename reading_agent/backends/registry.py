@@ -0,0 +1,61 @@
+import importlib
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from reading_agent.backends.admission import AdmissionControl, AdmissionControlledBackend
+from reading_agent.backends.base import BackendBase
+from reading_agent.backends.cache import CachedBackend, ResponseCache
+from reading_agent.backends.instrumented import InstrumentedBackend
+
+logger = logging.getLogger(__name__)
+
+# module and class of every backend, imported on first use so that only the SDK of a backend in use is loaded
+_BACKENDS = {
+    "gpt": ("reading_agent.backends.chatgpt", "GPTBackend"),
+    "gemini": ("reading_agent.backends.gemini", "GeminiBackend"),
+    "haiku": ("reading_agent.backends.bedrock", "Claude3Backend"),
+    "mock": ("reading_agent.backends.mock", "MockBackend"),
+}
+BACKEND_NAMES = tuple(_BACKENDS)
+
+_backends: Dict[str, BackendBase] = {}
+_wrapped: Dict[Tuple[str, Optional[ResponseCache], Optional[AdmissionControl]], InstrumentedBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def _build(name: str) -> BackendBase:
+    if name not in _BACKENDS:
+        raise ValueError(f"Unknown backend {name}")
+    module_name, class_name = _BACKENDS[name]
+    start = time.perf_counter()
+    backend_class = getattr(importlib.import_module(module_name), class_name)
+    imported = time.perf_counter()
+    backend = backend_class()
+    logger.info(f"[Backend] {name} imported in {imported - start:.3f}s, "
+                f"clients created in {time.perf_counter() - imported:.3f}s")
+    return backend
+
+
+def get_backend(name: str, response_cache: Optional[ResponseCache] = None,
+                admission: Optional[AdmissionControl] = None) -> InstrumentedBackend:
+    """The process-wide backend ``name`` behind ``response_cache``, created on first use.
+
+    Backends are thread-safe and keep their HTTP clients, and with them their pooled keep-alive connections,
+    for the life of the process, so every request and worker shares them. With ``admission``, calls that miss
+    the cache wait for one of its slots.
+    """
+    key = (name, response_cache, admission)
+    with _backends_lock:
+        wrapped = _wrapped.get(key)
+        if wrapped is None:
+            backend = _backends.get(name)
+            if backend is None:
+                backend = _backends[name] = _build(name)
+            if admission is not None:
+                backend = AdmissionControlledBackend(backend, admission)
+            if response_cache is not None:
+                backend = CachedBackend(backend, response_cache)
+            wrapped = _wrapped[key] = InstrumentedBackend(backend)
+    return wrapped
@@ -0,0 +1,166 @@
+"""
+Benchmark of the reading pipeline against ``MockBackend``.
+
+    python -m reading_agent.benchmark --sizes 10 100 1000 10000 --save_baseline baseline.json
+    python -m reading_agent.benchmark --sizes 10 100 1000 10000 --compare baseline.json
+"""
+import argparse
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from reading_agent.agent import Agent
+from reading_agent.backends.instrumented import InstrumentedBackend
+from reading_agent.backends.mock import MockBackend
+from reading_agent.metrics import Span, Tracer
+
+logger = logging.getLogger(__name__)
+
+_VOCABULARY = [
+    "revenue", "growth", "market", "policy", "risk", "capital", "customer", "product", "quarter", "segment",
+    "operating", "margin", "demand", "supply", "research", "model", "reading", "memory", "agent", "page",
+    "the", "of", "and", "to", "in", "a", "is", "that", "for", "with", "as", "on", "by", "was", "were",
+]
+
+
+def synthetic_paragraphs(num_paragraphs: int, seed: int = 0) -> List[str]:
+    """Paragraphs of 10 to ~200 words with an occasional CSV table, like the output of the extractors."""
+    rng = random.Random(seed)
+    paragraphs = []
+    for _ in range(num_paragraphs):
+        if rng.random() < 0.05:
+            columns = rng.randint(3, 8)
+            rows = [", ".join(f"{rng.randint(0, 99999)}" for _ in range(columns)) for _ in range(rng.randint(3, 20))]
+            paragraphs.append("\n".join(rows))
+        else:
+            length = min(200, max(10, int(rng.lognormvariate(3.8, 0.6))))
+            paragraphs.append(" ".join(rng.choice(_VOCABULARY) for _ in range(length)))
+    return paragraphs
+
+
+class _CallLatencies(Tracer):
+    """Tracer keeping the wall time of every backend call, for exact percentiles."""
+
+    def __init__(self):
+        super().__init__()
+        self.latencies: List[float] = []
+
+    def finish(self, span: Span):
+        super().finish(span)
+        if span.kind == "call":
+            with self._lock:
+                self.latencies.append(span.latency)
+
+
+def _measure(name: str, backend: MockBackend, calls: _CallLatencies, num_paragraphs: int, func: Callable):
+    backend.reset_stats()
+    calls.latencies = []
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    latencies = sorted(calls.latencies) or [0.0]
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    stats = {
+        "stage": name,
+        "paragraphs": num_paragraphs,
+        "seconds": round(elapsed, 4),
+        "paragraphs_per_second": round(num_paragraphs / elapsed, 2) if elapsed else None,
+        "llm_calls": backend.calls,
+        "rate_limited": backend.rate_limited,
+        "latency_p50": round(quantiles[49], 4),
+        "latency_p95": round(quantiles[94], 4),
+        "latency_p99": round(quantiles[98], 4),
+        "prefix_hits": backend.prefix_hits,
+        "prefix_misses": backend.prefix_misses,
+    }
+    # tracing allocations slows everything down, so the peak is taken in a second pass that is not timed
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    stats["peak_memory_mb"] = round(peak / 2 ** 20, 3)
+    return result, stats
+
+
+def run(sizes: List[int], seed: int = 0, latency_median: float = 0.0, rate_limit_probability: float = 0.0,
+        max_workers: int = 8, num_questions: int = 5) -> List[Dict]:
+    results = []
+    for size in sizes:
+        paragraphs = synthetic_paragraphs(size, seed)
+        backend = MockBackend(seed=seed, latency_median=latency_median,
+                              rate_limit_probability=rate_limit_probability)
+        calls = _CallLatencies()
+        # the simulated latencies are 0 without latency_median, the wall time of every call is measured instead
+        instrumented = InstrumentedBackend(backend, calls)
+        pages, stats = _measure("pagination", backend, calls, size,
+                                lambda: Agent.pagination(paragraphs, instrumented, verbose=False))
+        results.append(stats)
+        gists, stats = _measure("gisting", backend, calls, size,
+                                lambda: Agent.gisting(pages, instrumented, verbose=False, max_workers=max_workers))
+        results.append(stats)
+        _, stats = _measure("parallel_lookup", backend, calls, size, lambda: [
+            Agent.parallel_lookup(gists, pages, f"What does page {q} say about revenue?", instrumented,
+                                  verbose=False)
+            for q in range(num_questions)
+        ])
+        results.append(stats)
+        logger.info(f"[Benchmark] {size} paragraphs, {len(pages)} pages")
+    return results
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """Regressions of ``results`` against ``baseline``: slower stages and stages issuing more calls."""
+    baseline_by_key = {(b["stage"], b["paragraphs"]): b for b in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline_by_key.get((result["stage"], result["paragraphs"]))
+        if reference is None:
+            continue
+        for metric in ("seconds", "llm_calls", "peak_memory_mb"):
+            if reference[metric] and result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{result['stage']} @ {result['paragraphs']} paragraphs: {metric} "
+                    f"{reference[metric]} -> {result[metric]}"
+                )
+    return regressions
+
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000, 10000])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency_ms", type=float, default=0.0, help="median simulated backend latency")
+    parser.add_argument("--rate_limit_probability", type=float, default=0.0)
+    parser.add_argument("--max_workers", type=int, default=8)
+    parser.add_argument("--num_questions", type=int, default=5)
+    parser.add_argument("--save_baseline", type=str, default=None)
+    parser.add_argument("--compare", type=str, default=None, help="baseline to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    cli_args = parse_cli_args()
+    logging.basicConfig(level=logging.WARNING)
+    benchmark_results = run(cli_args.sizes, cli_args.seed, cli_args.latency_ms / 1000,
+                            cli_args.rate_limit_probability, cli_args.max_workers, cli_args.num_questions)
+    columns = list(benchmark_results[0])
+    print("\t".join(columns))
+    for row in benchmark_results:
+        print("\t".join(str(row[c]) for c in columns))
+    if cli_args.save_baseline:
+        with open(cli_args.save_baseline, "w") as f:
+            json.dump(benchmark_results, f, indent=2)
+    if cli_args.compare:
+        with open(cli_args.compare, "r") as f:
+            found = compare(benchmark_results, json.load(f), cli_args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if found else 0)
@@ -0,0 +1,342 @@
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from tempfile import NamedTemporaryFile
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from reading_agent.tokens import count_pieces
+from reading_agent.utils import count_words
+
+MAGIC = b"RAGDOC"
+FORMAT_VERSION = 1
+# magic, version, paragraph count, page count, gist count, text bytes
+_HEADER = struct.Struct("<6sHQQQQ")
+_OFFSET = np.dtype("<u8")
+
+
+class DocumentFormatError(ValueError):
+    pass
+
+
+def _index(offsets: np.ndarray) -> Sequence[int]:
+    """Offsets indexed as Python ints, through a memoryview of the array where the byte order allows it."""
+    if sys.byteorder == "little" and offsets.flags.c_contiguous:
+        return memoryview(np.ascontiguousarray(offsets, dtype=_OFFSET)).cast("B").cast("Q")
+    return offsets.tolist()
+
+
+class TextArray(Sequence[str]):
+    """Read-only sequence of the strings between consecutive ``offsets`` of a UTF-8 buffer, decoded on access."""
+
+    __slots__ = ("_buffer", "_offsets", "_length", "_separator")
+
+    def __init__(self, buffer: memoryview, offsets: np.ndarray, separator: str = "\n"):
+        self._buffer = buffer
+        self._offsets = _index(offsets)
+        self._length = len(offsets) - 1
+        self._separator = len(separator.encode("utf-8"))
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, i: Union[int, slice]):
+        if isinstance(i, slice):
+            return [str(self.view(j), "utf-8") for j in range(*i.indices(self._length))]
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError(i)
+        return str(self.view(i), "utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(self._length):
+            yield str(self.view(i), "utf-8")
+
+    def view(self, i: int) -> memoryview:
+        """Zero-copy bytes of string ``i``."""
+        # every string but the last is followed by a separator that is not part of it
+        end = self._offsets[i + 1] - self._separator if i < self._length - 1 else self._offsets[i + 1]
+        return self._buffer[self._offsets[i]:end]
+
+
+class PageArray(Sequence[List[str]]):
+    """Read-only sequence of the pages of a ``Document``, each the list of its paragraphs."""
+
+    __slots__ = ("_document", "_bounds")
+
+    def __init__(self, document: "Document", bounds: np.ndarray):
+        self._document = document
+        self._bounds = bounds
+
+    def __len__(self) -> int:
+        return max(0, len(self._bounds) - 1)
+
+    def __getitem__(self, p: Union[int, slice]):
+        if isinstance(p, slice):
+            return [self[q] for q in range(*p.indices(len(self)))]
+        if p < 0:
+            p += len(self)
+        if not 0 <= p < len(self):
+            raise IndexError(p)
+        return self._document.paragraphs[int(self._bounds[p]):int(self._bounds[p + 1])]
+
+    def __iter__(self) -> Iterator[List[str]]:
+        for p in range(len(self)):
+            yield self[p]
+
+    def text(self, p: int) -> str:
+        """Paragraphs of page ``p`` joined by newlines."""
+        return self._document.text(int(self._bounds[p]), int(self._bounds[p + 1]))
+
+    @property
+    def num_words(self) -> int:
+        return self._document.words(int(self._bounds[0]), int(self._bounds[-1])) if len(self) else 0
+
+
+class Document:
+    """Paragraphs, pages and gists of one document in a single UTF-8 buffer.
+
+    Paragraphs are stored back to back separated by a newline, followed by the gists, and located by byte
+    offset arrays. Pages are contiguous runs of paragraphs given by ``page_bounds``, so the text of a page is
+    one slice of the buffer. Saved documents are read back with ``mmap`` without copying.
+
+    On-disk layout (little endian), version 1: header ``MAGIC, version: u16, paragraphs: u64, pages: u64,
+    gists: u64, text bytes: u64``, then u64 arrays of paragraph offsets (paragraphs + 1), page bounds
+    (pages + 1, empty without pages) and gist offsets (gists + 1), then the text.
+
+    Word counts of the paragraphs are counted once, on first use, into a prefix sum, so the words of any range
+    of paragraphs and the end of a pagination window are found without scanning the paragraphs again. Word
+    pieces, the backend independent part of ``TokenEstimator`` estimates, are summed the same way.
+    """
+
+    __slots__ = ("_buffer", "paragraph_offsets", "page_bounds", "gist_offsets", "paragraphs", "pages", "gists",
+                 "_word_prefix", "_piece_prefix")
+
+    def __init__(self, buffer: Union[bytes, memoryview, mmap.mmap], paragraph_offsets: np.ndarray,
+                 page_bounds: np.ndarray, gist_offsets: np.ndarray):
+        self._buffer = memoryview(buffer)
+        self.paragraph_offsets = paragraph_offsets
+        self.page_bounds = page_bounds
+        self.gist_offsets = gist_offsets
+        self.paragraphs = TextArray(self._buffer, paragraph_offsets)
+        self.pages = PageArray(self, page_bounds)
+        self.gists = TextArray(self._buffer, gist_offsets)
+        self._word_prefix = None
+        self._piece_prefix = None
+
+    @staticmethod
+    def _pack(texts: Sequence[str], start: int) -> Tuple[bytes, np.ndarray]:
+        encoded = [t.encode("utf-8") for t in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=_OFFSET)
+        # every string is followed by a newline but the last
+        np.cumsum([len(e) + 1 for e in encoded], out=offsets[1:])
+        if encoded:
+            offsets[-1] -= 1
+        return b"\n".join(encoded), offsets + start
+
+    @classmethod
+    def from_paragraphs(cls, paragraphs: Sequence[str], page_bounds: Optional[Sequence[int]] = None,
+                        gists: Sequence[str] = ()) -> "Document":
+        text, paragraph_offsets = cls._pack(paragraphs, 0)
+        gist_text, gist_offsets = cls._pack(gists, len(text) + 1)
+        bounds = np.array(page_bounds if page_bounds is not None else [], dtype=_OFFSET)
+        if len(bounds) and (bounds[0] != 0 or bounds[-1] != len(paragraphs)
+                            or np.any(np.diff(bounds.astype(np.int64)) < 0)):
+            raise ValueError("page bounds must go from 0 to the number of paragraphs")
+        return cls(text + b"\n" + gist_text, paragraph_offsets, bounds, gist_offsets)
+
+    @classmethod
+    def from_pages(cls, pages: Sequence[Sequence[str]], gists: Sequence[str] = ()) -> "Document":
+        """Document whose paragraphs are those of ``pages`` in order."""
+        page_bounds = np.zeros(len(pages) + 1, dtype=_OFFSET)
+        np.cumsum([len(page) for page in pages], out=page_bounds[1:])
+        return cls.from_paragraphs([p for page in pages for p in page], page_bounds, gists)
+
+    def with_reading(self, page_bounds: Sequence[int], gists: Sequence[str]) -> "Document":
+        return Document.from_paragraphs(self.paragraphs, page_bounds, gists)
+
+    def with_pages(self, page_bounds: Sequence[int]) -> "Document":
+        """Same paragraphs and gists split at ``page_bounds``, sharing the buffer and the word counts."""
+        bounds = np.asarray(page_bounds, dtype=_OFFSET)
+        if len(bounds) and (bounds[0] != 0 or bounds[-1] != len(self.paragraphs)):
+            raise ValueError("page bounds must go from 0 to the number of paragraphs")
+        document = Document(self._buffer, self.paragraph_offsets, bounds, self.gist_offsets)
+        document._word_prefix = self._word_prefix
+        document._piece_prefix = self._piece_prefix
+        return document
+
+    def extend(self, paragraphs: Sequence[str]) -> "Document":
+        """Document of these paragraphs followed by ``paragraphs``, without pages or gists.
+
+        Only the new paragraphs are encoded and counted, the word and piece counts so far are carried over.
+        """
+        tail = Document.from_paragraphs(paragraphs)
+        if not len(self.paragraphs) or not len(tail.paragraphs):
+            return tail if not len(self.paragraphs) else self.with_reading([], [])
+        end = int(self.paragraph_offsets[-1])
+        text = b"".join([self._buffer[:end], b"\n", tail._buffer[:int(tail.paragraph_offsets[-1])]])
+        offsets = np.concatenate([self.paragraph_offsets[:-1], tail.paragraph_offsets + np.uint64(end + 1)])
+        document = Document(text + b"\n", offsets, np.zeros(0, dtype=_OFFSET),
+                            np.full(1, len(text) + 1, dtype=_OFFSET))
+        for name in ("_word_prefix", "_piece_prefix"):
+            prefix = getattr(self, name)
+            if prefix is not None:
+                tail_prefix = tail.word_prefix if name == "_word_prefix" else tail.piece_prefix
+                setattr(document, name, np.concatenate([prefix, tail_prefix[1:] + prefix[-1]]))
+        return document
+
+    @property
+    def word_prefix(self) -> np.ndarray:
+        """``word_prefix[j] - word_prefix[i]`` is the number of words in paragraphs ``i`` to ``j - 1``."""
+        if self._word_prefix is None:
+            counts = self._word_counts()
+            prefix = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=prefix[1:])
+            self._word_prefix = prefix
+        return self._word_prefix
+
+    def _word_counts(self) -> np.ndarray:
+        """``count_words`` of every paragraph, counting word starts in the buffer at once.
+
+        Paragraphs with non-ASCII bytes, where Unicode whitespace may separate words, are counted one by one.
+        """
+        offsets = self.paragraph_offsets.astype(np.int64)
+        data = np.frombuffer(self._buffer, dtype=np.uint8, count=int(offsets[-1]))
+        # ASCII bytes ``str.split`` separates words at: \t to \r, \x1c to \x1f and the space
+        space = (data == 32) | (data - np.uint8(9) <= 4) | (data - np.uint8(28) <= 3)
+        starts = ~space
+        starts[1:] &= space[:-1]
+        # paragraphs are separated by a newline, so no word starts in one paragraph and ends in the next
+        counts = np.diff(np.searchsorted(np.flatnonzero(starts), offsets))
+        non_ascii = np.diff(np.searchsorted(np.flatnonzero(data >= 128), offsets))
+        for i in np.flatnonzero(non_ascii):
+            counts[i] = count_words(self.paragraphs[int(i)])
+        return counts
+
+    @property
+    def piece_prefix(self) -> np.ndarray:
+        """``piece_prefix[j] - piece_prefix[i]`` is the number of word pieces in paragraphs ``i`` to ``j - 1``."""
+        if self._piece_prefix is None:
+            prefix = np.zeros(len(self.paragraphs) + 1, dtype=np.int64)
+            np.cumsum(self._piece_counts(), out=prefix[1:])
+            self._piece_prefix = prefix
+        return self._piece_prefix
+
+    def _piece_counts(self) -> np.ndarray:
+        """``count_pieces`` of every paragraph, vectorised over the buffer like ``_word_counts``."""
+        offsets = self.paragraph_offsets.astype(np.int64)
+        data = np.frombuffer(self._buffer, dtype=np.uint8, count=int(offsets[-1]))
+        space = (data == 32) | (data - np.uint8(9) <= 4) | (data - np.uint8(28) <= 3)
+        letter = (data | np.uint8(32)) - np.uint8(97) <= 25
+        digit = data - np.uint8(48) <= 9
+        # every symbol is a piece of its own, letters start a piece after anything but a letter
+        starts = ~(space | letter | digit)
+        starts[:1] |= letter[:1]
+        starts[1:] |= letter[1:] & ~letter[:-1]
+        # and digits start a piece every third digit of a run
+        positions = np.flatnonzero(digit)
+        if len(positions):
+            run_start = np.ones(len(positions), dtype=bool)
+            run_start[1:] = np.diff(positions) != 1
+            first = np.flatnonzero(run_start)
+            index = np.arange(len(positions)) - np.repeat(first, np.diff(np.append(first, len(positions))))
+            starts[positions[index % 3 == 0]] = True
+        counts = np.diff(np.searchsorted(np.flatnonzero(starts), offsets))
+        non_ascii = np.diff(np.searchsorted(np.flatnonzero(data >= 128), offsets))
+        for i in np.flatnonzero(non_ascii):
+            counts[i] = count_pieces(self.paragraphs[int(i)])
+        return counts
+
+    def prefix(self, unit: str = "words") -> np.ndarray:
+        """Prefix sum of the paragraph lengths in ``unit``, "words" or "pieces"."""
+        if unit == "words":
+            return self.word_prefix
+        if unit == "pieces":
+            return self.piece_prefix
+        raise ValueError(f"unknown unit {unit}")
+
+    def length(self, start: int, end: int, unit: str = "words") -> int:
+        prefix = self.prefix(unit)
+        return int(prefix[end] - prefix[start])
+
+    def words(self, start: int, end: int) -> int:
+        return self.length(start, end)
+
+    def window_end(self, i: int, limit: int, stop: Optional[int] = None, unit: str = "words") -> int:
+        """Smallest ``j > i`` such that paragraphs ``i`` to ``j - 1`` are ``limit`` long, else ``stop``."""
+        stop = len(self.paragraphs) if stop is None else stop
+        prefix = self.prefix(unit)
+        return min(stop, i + 1 + int(np.searchsorted(prefix[i + 1:stop], prefix[i] + limit)))
+
+    def digest(self) -> bytes:
+        """SHA-256 of the paragraphs, the same whatever pages and gists the document holds."""
+        end = int(self.paragraph_offsets[-1]) if len(self.paragraph_offsets) else 0
+        sha = hashlib.sha256(self._buffer[:end])
+        sha.update(np.asarray(self.paragraph_offsets, dtype="<u8").tobytes())
+        return sha.digest()
+
+    def text(self, start: int, end: int) -> str:
+        """Paragraphs ``start`` to ``end - 1`` joined by newlines, decoded from one slice of the buffer."""
+        return self.text_view(start, end).tobytes().decode("utf-8")
+
+    def text_view(self, start: int, end: int) -> memoryview:
+        """Zero-copy bytes of ``text(start, end)``."""
+        if start >= end:
+            return self._buffer[0:0]
+        last = self.paragraphs.view(end - 1)
+        return self._buffer[int(self.paragraph_offsets[start]):int(self.paragraph_offsets[end - 1]) + last.nbytes]
+
+    def page_text(self, p: int) -> str:
+        """Paragraphs of page ``p`` joined by newlines."""
+        return self.pages.text(p)
+
+    def page_view(self, p: int) -> memoryview:
+        """Zero-copy bytes of the text of page ``p``."""
+        return self.text_view(int(self.page_bounds[p]), int(self.page_bounds[p + 1]))
+
+    def to_bytes(self) -> bytes:
+        header = _HEADER.pack(MAGIC, FORMAT_VERSION, len(self.paragraphs), len(self.pages), len(self.gists),
+                              self._buffer.nbytes)
+        # the header counts pages, the bounds of a document without any, even ``[0]``, are not written
+        page_bounds = self.page_bounds if len(self.pages) else np.zeros(0, dtype=_OFFSET)
+        return b"".join([header, self.paragraph_offsets.astype(_OFFSET).tobytes(),
+                         page_bounds.astype(_OFFSET).tobytes(), self.gist_offsets.astype(_OFFSET).tobytes(),
+                         self._buffer.tobytes()])
+
+    @classmethod
+    def from_buffer(cls, buffer: Union[bytes, memoryview, mmap.mmap]) -> "Document":
+        """Document over ``buffer`` without copying it."""
+        view = memoryview(buffer)
+        if view.nbytes < _HEADER.size:
+            raise DocumentFormatError("truncated header")
+        magic, version, num_paragraphs, num_pages, num_gists, text_bytes = _HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise DocumentFormatError("not a document")
+        if version != FORMAT_VERSION:
+            raise DocumentFormatError(f"unsupported document format version {version}")
+        offset = _HEADER.size
+        arrays = []
+        for count in (num_paragraphs + 1, num_pages + 1 if num_pages else 0, num_gists + 1):
+            arrays.append(np.frombuffer(view, dtype=_OFFSET, count=count, offset=offset))
+            offset += count * _OFFSET.itemsize
+        if view.nbytes != offset + text_bytes:
+            raise DocumentFormatError("truncated document")
+        return cls(view[offset:], *arrays)
+
+    def save(self, path: str):
+        """Write the document atomically."""
+        directory = os.path.dirname(path) or "."
+        with NamedTemporaryFile("wb", dir=directory, suffix=".tmp", delete=False) as f:
+            f.write(self.to_bytes())
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path: str) -> "Document":
+        """Memory-map a saved document, pages are only read from disk when accessed."""
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(mapped)
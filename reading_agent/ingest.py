@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from reading_agent.agent import Agent
+from reading_agent.artifacts import ArtifactStore
+from reading_agent.backends.base import BackendBase
+from reading_agent.metrics import submit, tracer
+
+logger = logging.getLogger(__name__)
+
+
+class Ingestor:
+    """Extracts, paginates and gists every PDF of a directory, resumably.
+
+    Every stage of every document is checkpointed in the ``ArtifactStore`` under the same keys the app uses,
+    gists every ``gisting_batch_size`` pages. A rerun after a crash skips whatever has been checkpointed. With
+    an extractor that streams its paragraphs and serial pagination, documents are paginated while extracted.
+    """
+
+    def __init__(self, extractor: Callable[[bytes], List[str]], backend: BackendBase, store: ArtifactStore,
+                 document_workers: int = 2, pagination_workers: int = 1, gisting_workers: int = 8,
+                 gisting_batch_size: int = 32):
+        self.extractor = extractor
+        self.backend = backend
+        self.store = store
+        self.document_workers = document_workers
+        self.pagination_workers = pagination_workers
+        self.gisting_workers = gisting_workers
+        self.gisting_batch_size = gisting_batch_size
+
+    def ingest_document(self, path: Path) -> Dict:
+        report = {"document": str(path), "status": "done", "stages": {}, "pages": 0}
+        pdf_bytes = path.read_bytes()
+
+        start = time.perf_counter()
+        paragraphs_key = ArtifactStore.paragraphs_key(pdf_bytes, self.extractor)
+        artifact = self.store.load("paragraphs", paragraphs_key)
+        pages = None
+        if artifact is None:
+            if self.pagination_workers == 1 and hasattr(self.extractor, "stream"):
+                # every page is paginated as soon as it is extracted, the extraction stage includes pagination
+                pages = list(Agent.iter_pagination(self.extractor.stream(pdf_bytes), self.backend, verbose=False))
+                artifact = {"paragraphs": [paragraph for page in pages for paragraph in page]}
+            else:
+                artifact = {"paragraphs": self.extractor(pdf_bytes)}
+            self.store.save("paragraphs", paragraphs_key, artifact)
+            report["stages"]["extraction"] = time.perf_counter() - start
+        paragraphs = artifact["paragraphs"]
+
+        reading_key = ArtifactStore.reading_key(paragraphs, self.backend, max_workers=self.pagination_workers)
+        reading = self.store.load("reading", reading_key)
+        if reading is not None:
+            report["pages"] = len(reading["pages"])
+            report["status"] = "done" if report["stages"] else "skipped"
+            return report
+
+        start = time.perf_counter()
+        artifact = self.store.load("pages", reading_key)
+        if artifact is None:
+            if pages is None:
+                pages = Agent.pagination(paragraphs, self.backend, verbose=False, max_workers=self.pagination_workers)
+            artifact = {"pages": pages}
+            self.store.save("pages", reading_key, artifact)
+            report["stages"]["pagination"] = time.perf_counter() - start
+        pages = artifact["pages"]
+        report["pages"] = len(pages)
+
+        start = time.perf_counter()
+        gists = (self.store.load("gists_partial", reading_key) or {}).get("gists", [])
+        if gists:
+            logger.info(f"[Ingest] {path.name}: resuming gisting at page {len(gists)}/{len(pages)}")
+        while len(gists) < len(pages):
+            batch = pages[len(gists):len(gists) + self.gisting_batch_size]
+            gists += Agent.gisting(batch, self.backend, verbose=False, max_workers=self.gisting_workers)
+            self.store.save("gists_partial", reading_key, {"gists": gists})
+        report["stages"]["gisting"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = Agent.build_index(pages, gists)
+        self.store.save("reading", reading_key, {"pages": pages, "gists": gists, "index": index.to_artifact()})
+        report["stages"]["indexing"] = time.perf_counter() - start
+        return report
+
+    def _run_document(self, path: Path) -> Dict:
+        document = str(path)
+        tokens_before = tracer.document_counter(document, "llm_tokens_total", kind="total")
+        cached_before = tracer.document_counter(document, "llm_tokens_total", kind="cached")
+        with tracer.document(document):
+            try:
+                report = self.ingest_document(path)
+            except Exception as e:
+                logger.exception(f"[Ingest] {path.name} failed, rerun to resume it")
+                report = {"document": document, "status": "failed", "error": f"{type(e).__name__}: {e}",
+                          "stages": {}, "pages": 0}
+        report["tokens"] = int(tracer.document_counter(document, "llm_tokens_total", kind="total") - tokens_before)
+        report["cached_tokens"] = int(
+            tracer.document_counter(document, "llm_tokens_total", kind="cached") - cached_before
+        )
+        logger.info(f"[Ingest] {path.name}: {report['status']}, {report['pages']} pages, {report['tokens']} tokens")
+        return report
+
+    def __call__(self, directory: str, summary_path: Optional[str] = None,
+                 cost_per_1k_tokens: float = 0.0) -> Dict:
+        paths = sorted(Path(directory).rglob("*.pdf"))
+        logger.info(f"[Ingest] {len(paths)} PDFs in {directory}")
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, self.document_workers)) as executor:
+            reports = [f.result() for f in [submit(executor, self._run_document, path) for path in paths]]
+        elapsed = time.perf_counter() - start
+
+        tokens = sum(r["tokens"] for r in reports)
+        processed = [r for r in reports if r["status"] == "done"]
+        summary = {
+            "documents": len(reports),
+            "processed": len(processed),
+            "skipped": sum(r["status"] == "skipped" for r in reports),
+            "failed": sum(r["status"] == "failed" for r in reports),
+            "pages": sum(r["pages"] for r in processed),
+            "seconds": round(elapsed, 2),
+            "documents_per_hour": round(len(processed) / elapsed * 3600, 2) if elapsed else None,
+            "tokens": tokens,
+            "cached_tokens": sum(r["cached_tokens"] for r in reports),
+            "cost": round(tokens / 1000 * cost_per_1k_tokens, 4),
+            "reports": reports,
+        }
+        summary_path = summary_path or os.path.join(directory, "ingest_summary.json")
+        with open(summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        logger.info(
+            f"[Ingest] {summary['processed']} processed, {summary['skipped']} skipped, {summary['failed']} failed "
+            f"in {summary['seconds']}s, {tokens} tokens, summary written to {summary_path}"
+        )
+        return summary
@@ -0,0 +1,374 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("span", default=None)
+_current_stage: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("stage", default=None)
+_current_document: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("document", default=None)
+
+
+@dataclass
+class Span:
+    """One pipeline stage or one backend call."""
+    kind: str
+    name: str
+    stage: Optional[str] = None
+    document: Optional[str] = None
+    backend: Optional[str] = None
+    start: float = field(default_factory=time.time)
+    latency: float = 0.0
+    first_token_latency: Optional[float] = None
+    total_tokens: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    prompt_cached_tokens: int = 0
+    retries: int = 0
+    backoff_seconds: float = 0.0
+    error: Optional[str] = None
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the ``q`` quantile."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Aggregate:
+    """Histograms and counters keyed by metric name and labels."""
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+
+    def observe(self, name: str, labels: Labels, value: float, buckets: Tuple[float, ...]):
+        key = (name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        self.histograms[key].observe(value)
+
+    def inc(self, name: str, labels: Labels, value: float = 1.0):
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0.0) + value
+
+    def add_span(self, span: Span):
+        if span.kind == "stage":
+            labels = (("stage", span.name),)
+            self.observe("stage_latency_seconds", labels, span.latency, LATENCY_BUCKETS)
+            self.inc("stage_backoff_seconds_total", labels, span.backoff_seconds)
+            if span.error:
+                self.inc("stage_errors_total", labels)
+            return
+        labels = (("stage", span.stage or ""), ("backend", span.backend or ""))
+        self.observe("llm_call_latency_seconds", labels, span.latency, LATENCY_BUCKETS)
+        self.observe("llm_call_tokens", labels, span.total_tokens, TOKEN_BUCKETS)
+        self.inc("llm_calls_total", labels)
+        self.inc("llm_retries_total", labels, span.retries)
+        self.inc("llm_backoff_seconds_total", labels, span.backoff_seconds)
+        for kind, tokens in (("input", span.input_tokens), ("output", span.output_tokens),
+                             ("cached", span.cached_tokens), ("prompt_cached", span.prompt_cached_tokens),
+                             ("total", span.total_tokens)):
+            self.inc("llm_tokens_total", labels + (("kind", kind),), tokens)
+        if span.error:
+            self.inc("llm_errors_total", labels)
+
+    def summary(self) -> dict:
+        summary = {}
+        for (name, labels), histogram in self.histograms.items():
+            summary[_format_series(name, labels)] = {
+                "count": histogram.count, "sum": histogram.sum,
+                "p50": histogram.quantile(0.5), "p95": histogram.quantile(0.95), "p99": histogram.quantile(0.99),
+            }
+        for (name, labels), value in self.counters.items():
+            summary[_format_series(name, labels)] = value
+        return summary
+
+
+def _format_series(name: str, labels: Labels) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Tracer:
+    """Collects spans of the reading pipeline.
+
+    Stage spans are opened by ``Agent`` methods, call spans by ``InstrumentedBackend``. Backends report token
+    splits, retries and backoff sleeps of the call in flight through ``record_usage`` and ``record_retry``.
+    Finished spans are aggregated per process and per document, and appended to ``jsonl_path`` if set. Only the
+    ``max_documents`` documents with the most recent spans keep their aggregate, so a long-running server does
+    not grow without bound.
+    """
+
+    def __init__(self, jsonl_path: Optional[str] = None, namespace: str = "reading_agent",
+                 max_documents: int = 1024):
+        self.jsonl_path = jsonl_path
+        self.namespace = namespace
+        self.max_documents = max_documents
+        self.process = _Aggregate()
+        self.documents: "OrderedDict[str, _Aggregate]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def document(self, document: Optional[str]) -> Iterator[None]:
+        """Attribute every span opened inside to ``document``."""
+        token = _current_document.set(document)
+        try:
+            yield
+        finally:
+            _current_document.reset(token)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Span]:
+        span = Span(kind="stage", name=name, stage=name, document=_current_document.get())
+        stage_token = _current_stage.set(name)
+        try:
+            with self._active(span):
+                yield span
+        finally:
+            _current_stage.reset(stage_token)
+
+    @contextmanager
+    def call(self, backend: str, name: str = "query_model") -> Iterator[Span]:
+        with self._active(self.detached_call(backend, name)) as span:
+            yield span
+
+    @staticmethod
+    def detached_call(backend: str, name: str) -> Span:
+        """A call span that is never made current, the caller measures it and hands it to ``finish``."""
+        return Span(kind="call", name=name, stage=_current_stage.get(), document=_current_document.get(),
+                    backend=backend)
+
+    @staticmethod
+    @contextmanager
+    def current(span: Span) -> Iterator[Span]:
+        """Make ``span`` current without measuring or finishing it, e.g. around every step of a stream."""
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+
+    @contextmanager
+    def _active(self, span: Span) -> Iterator[Span]:
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.latency = time.perf_counter() - start
+            _current_span.reset(token)
+            self.finish(span)
+
+    def finish(self, span: Span):
+        with self._lock:
+            self.process.add_span(span)
+            if span.document is not None:
+                self.documents.setdefault(span.document, _Aggregate()).add_span(span)
+                self.documents.move_to_end(span.document)
+                while len(self.documents) > self.max_documents:
+                    self.documents.popitem(last=False)
+            if self.jsonl_path:
+                with open(self.jsonl_path, "a") as f:
+                    f.write(json.dumps(asdict(span)) + "\n")
+
+    @contextmanager
+    def attribute_to(self, stage: str) -> Iterator[None]:
+        """Attribute calls made inside to ``stage`` without opening a stage span."""
+        token = _current_stage.set(stage)
+        try:
+            yield
+        finally:
+            _current_stage.reset(token)
+
+    @staticmethod
+    def record_usage(input_tokens: int = 0, output_tokens: int = 0, cached_tokens: int = 0,
+                     prompt_cached_tokens: int = 0):
+        """Attach the token split of the backend call in flight to its span.
+
+        ``cached_tokens`` were served from the local response cache and not billed, ``prompt_cached_tokens`` are
+        the part of ``input_tokens`` the provider read from its prompt cache.
+        """
+        span = _current_span.get()
+        if span is not None:
+            span.input_tokens += input_tokens
+            span.output_tokens += output_tokens
+            span.cached_tokens += cached_tokens
+            span.prompt_cached_tokens += prompt_cached_tokens
+
+    @staticmethod
+    def record_retry(sleep_seconds: float = 0.0):
+        span = _current_span.get()
+        if span is not None:
+            span.retries += 1
+            span.backoff_seconds += sleep_seconds
+
+    @staticmethod
+    def record_sleep(seconds: float):
+        """Time spent waiting without retrying, e.g. polling for an extraction result."""
+        span = _current_span.get()
+        if span is not None:
+            span.backoff_seconds += seconds
+
+    def document_summary(self, document: str) -> dict:
+        with self._lock:
+            aggregate = self.documents.get(document)
+            return aggregate.summary() if aggregate else {}
+
+    def document_counter(self, document: str, name: str, **labels: str) -> float:
+        """Sum of the ``name`` counters of ``document`` whose labels match ``labels``."""
+        with self._lock:
+            aggregate = self.documents.get(document)
+            if aggregate is None:
+                return 0.0
+            return sum(value for (counter, counter_labels), value in aggregate.counters.items()
+                       if counter == name and labels.items() <= dict(counter_labels).items())
+
+    def process_summary(self) -> dict:
+        with self._lock:
+            return self.process.summary()
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), histogram in sorted(self.process.histograms.items()):
+                metric = f"{self.namespace}_{name}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} histogram")
+                    typed.add(metric)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{_format_series(metric + '_bucket', labels + (('le', le),))} {cumulative}")
+                lines.append(f"{_format_series(metric + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{_format_series(metric + '_count', labels)} {histogram.count}")
+            for (name, labels), value in sorted(self.process.counters.items()):
+                metric = f"{self.namespace}_{name}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} counter")
+                    typed.add(metric)
+                lines.append(f"{_format_series(metric, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        """Serve ``to_prometheus`` on ``/metrics`` from a daemon thread."""
+        tracer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = tracer.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"[Metrics] Serving Prometheus metrics on {host}:{port}/metrics")
+        return server
+
+
+tracer = Tracer()
+
+
+def traced(stage: str):
+    """Run the decorated function, generator or coroutine inside a ``tracer.stage`` span."""
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                # every step runs in a context captured at call time, so the stage neither leaks into the
+                # consumer nor depends on which thread the consumer iterates from
+                context = contextvars.copy_context()
+                span = Span(kind="stage", name=stage, stage=stage, document=context.get(_current_document))
+                context.run(_current_stage.set, stage)
+                context.run(_current_span.set, span)
+                return _traced_steps(context, context.run(func, *args, **kwargs), span)
+            return generator_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def coroutine_wrapper(*args, **kwargs):
+                with tracer.stage(stage):
+                    return await func(*args, **kwargs)
+            return coroutine_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _traced_steps(context: contextvars.Context, generator, span: Span):
+    start = time.perf_counter()
+    try:
+        while True:
+            try:
+                item = context.run(next, generator)
+            except StopIteration as stop:
+                return stop.value
+            yield item
+    except GeneratorExit:
+        raise
+    except BaseException as e:
+        span.error = type(e).__name__
+        raise
+    finally:
+        context.run(generator.close)
+        span.latency = time.perf_counter() - start
+        tracer.finish(span)
+
+
+def submit(executor, fn, *args, **kwargs):
+    """``executor.submit`` that carries the caller's stage and document into the worker thread."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
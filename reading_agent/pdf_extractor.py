@@ -5,17 +5,21 @@ The async versions of the samples require Python 3.6 or later.
 To learn more, please visit the documentation - Quickstart: Document Intelligence (formerly Form Recognizer) SDKs
 https://learn.microsoft.com/azure/ai-services/document-intelligence/quickstarts/get-started-sdks-rest-api?pivots=programming-language-python
 """
-import binascii
+import io
+import logging
 import os
+import threading
 import time
-from typing import List
-from functools import reduce
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional
 
-from azure.ai.documentintelligence.models import AnalyzeResult
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+import pypdfium2 as pdfium
 
-from reading_agent.utils import replace_consecutive_newlines
+from reading_agent.metrics import submit, traced, tracer
+from reading_agent.utils import extractor_identity, replace_consecutive_newlines
+
+if TYPE_CHECKING:
+    from azure.ai.documentintelligence.models import AnalyzeResult
 
 """
 Remember to remove the key from your code when you're done, and never post it publicly. For production, use
@@ -23,79 +27,200 @@ secure methods to store and access your credentials. For more information, see
 https://docs.microsoft.com/en-us/azure/cognitive-services/cognitive-services-security?tabs=command-line%2Ccsharp#environment-variables-and-application-configuration
 """
 
+logger = logging.getLogger(__name__)
+
+_PLAIN_PARAGRAPH = -1
+_FIGURE_PARAGRAPH = -2
+
+DEFAULT_PAGES_PER_CHUNK = 20
+
+# pypdfium2 is not thread-safe, every call made in this process, from any thread, goes through this lock
+_PDFIUM_LOCK = threading.Lock()
+
+
+def _subset_pdf(src: pdfium.PdfDocument, page_indices: List[int]) -> bytes:
+    # called with _PDFIUM_LOCK held
+    dst = pdfium.PdfDocument.new()
+    try:
+        dst.import_pages(src, page_indices)
+        buffer = io.BytesIO()
+        dst.save(buffer)
+        return buffer.getvalue()
+    finally:
+        dst.close()
+
+
+def split_pdf(pdf_bytes: bytes, pages_per_chunk: int) -> List[bytes]:
+    """Split a PDF into standalone PDFs of at most ``pages_per_chunk`` pages each."""
+    with _PDFIUM_LOCK:
+        src = pdfium.PdfDocument(pdf_bytes)
+        try:
+            num_pages = len(src)
+            if num_pages <= pages_per_chunk:
+                return [pdf_bytes]
+            return [_subset_pdf(src, list(range(start, min(start + pages_per_chunk, num_pages))))
+                    for start in range(0, num_pages, pages_per_chunk)]
+        finally:
+            src.close()
+
+
+def _group_lines_into_paragraphs(text: str) -> List[str]:
+    """Group the lines of a page's text layer into paragraphs.
+
+    A paragraph ends at a blank line, or at a line that is clearly shorter than the page's typical line and
+    ends a sentence. Words hyphenated across lines are rejoined.
+    """
+    lines = [line.strip() for line in text.splitlines()]
+    lengths = sorted(len(line) for line in lines if line)
+    if not lengths:
+        return []
+    typical_length = lengths[len(lengths) // 2]
+    paragraphs = []
+    current = ""
+    for line in lines:
+        if not line:
+            if current:
+                paragraphs.append(current)
+                current = ""
+            continue
+        if current.endswith("-") and not current.endswith(" -"):
+            current = current[:-1] + line
+        else:
+            current = f"{current} {line}" if current else line
+        if line[-1] in ".!?:" and len(line) < 0.8 * typical_length:
+            paragraphs.append(current)
+            current = ""
+    if current:
+        paragraphs.append(current)
+    return paragraphs
+
+
+def _extract_text_pages(pdf_bytes: bytes, start: int, stop: int) -> List[List[str]]:
+    """Paragraphs of the pages ``[start, stop)``, module level so it can run in a process pool.
+
+    Callers in this process must hold ``_PDFIUM_LOCK``, pool workers have pdfium to themselves.
+    """
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        pages = []
+        for page_index in range(start, stop):
+            page = pdf[page_index]
+            textpage = page.get_textpage()
+            pages.append(_group_lines_into_paragraphs(textpage.get_text_range()))
+            textpage.close()
+            page.close()
+        return pages
+    finally:
+        pdf.close()
+
 
 class AzureDocumentIntelligenceExtractor:
-    def __init__(self):
+    def __init__(self, pages_per_chunk: int = DEFAULT_PAGES_PER_CHUNK, max_workers: int = 4, poll_interval: float = 1.0,
+                 max_poll_interval: float = 10.0, timeout: float = 3840.0):
+        """
+        Args:
+            pages_per_chunk: larger PDFs are split into chunks of this many pages, analyzed concurrently
+            max_workers: number of chunks in flight at once
+            poll_interval: delay before the first poll, grows by half on every poll
+            max_poll_interval: upper bound of the polling delay
+            timeout: seconds to wait for an analysis before giving up
+        """
         super().__init__()
+        # the Azure SDK is only loaded by the processes that send documents to it
+        from azure.ai.documentintelligence import DocumentIntelligenceClient
+        from azure.core.credentials import AzureKeyCredential
         self.document_intelligence_client = DocumentIntelligenceClient(
             endpoint=os.environ["AZURE_FORM_RECOGNIZER_API_ENDPOINT"],
             credential=AzureKeyCredential(os.environ["AZURE_FORM_RECOGNIZER_API_KEY"])
         )
+        self.pages_per_chunk = pages_per_chunk
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+
+    def identity(self):
+        # tables and paragraphs spanning a chunk boundary are split, so the chunk size changes the output
+        return {"extractor": type(self).__name__, "pages_per_chunk": self.pages_per_chunk}
 
     def __call__(self, pdf_bytes) -> List[str]:
-        paragraphs = []
-        result = self.layout(pdf_bytes)
-        table_elem_indices = [set(indices) for indices in self._extract_table_elements_indices(result.tables)]
-        table_elem_indices_flatten = reduce(set().union, table_elem_indices) if table_elem_indices else []
-        figure_elem_indices = [set(indices) for indices in self._extract_figure_elements_indices(result.figures)]
-        figure_elem_indices_flatten = reduce(set().union, figure_elem_indices) if figure_elem_indices else []
-        i = 0
-        while i < len(result.paragraphs):
-            if i in table_elem_indices_flatten:
-                # check which table does it belong to
-                for table_idx, table_elem_indices_per_table in enumerate(table_elem_indices):
-                    if i in table_elem_indices_per_table:
-                        paragraphs.append(self._dump_table_into_csv(result.tables[table_idx]))
-                        i += len(table_elem_indices_per_table)
-            elif i in figure_elem_indices_flatten:
-                i += 1
-            else:
-                paragraphs.append(result.paragraphs[i].content)
-                i += 1
-        return [replace_consecutive_newlines(x) for x in paragraphs]
+        return list(self.stream(pdf_bytes))
 
-    @staticmethod
-    def _extract_table_elements_indices(instances) -> List[List[int]]:
-        if instances:
-            return [[int(e.rsplit("/", 1)[-1]) for cell in instance["cells"] if cell.elements
-                    for e in cell.elements] for instance in instances]
-        else:
-            return []
+    @traced("extraction")
+    def stream(self, pdf_bytes) -> Iterator[str]:
+        """Yield paragraphs in document order, chunk by chunk as soon as each chunk has been analyzed."""
+        chunks = split_pdf(pdf_bytes, self.pages_per_chunk)
+        if len(chunks) == 1:
+            yield from self.iter_paragraphs(self.layout(chunks[0]))
+            return
+        logger.info(f"[Extraction] Analyzing {len(chunks)} chunks of up to {self.pages_per_chunk} pages")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # element indices are local to every chunk's AnalyzeResult, so chunks are assembled on their own
+            futures = [submit(executor, self.layout, chunk) for chunk in chunks]
+            for future in futures:
+                yield from self.iter_paragraphs(future.result())
+
+    def iter_paragraphs(self, result: "AnalyzeResult") -> Iterator[str]:
+        """Yield the paragraphs of ``result``, with every table rendered once in place of its cells."""
+        owners = self._paragraph_owners(result)
+        tables = result.tables or []
+        emitted = [False] * len(tables)
+        for i, paragraph in enumerate(result.paragraphs or []):
+            owner = owners[i]
+            if owner == _PLAIN_PARAGRAPH:
+                yield replace_consecutive_newlines(paragraph.content)
+            elif owner >= 0 and not emitted[owner]:
+                emitted[owner] = True
+                yield replace_consecutive_newlines(self._dump_table_into_csv(tables[owner]))
 
     @staticmethod
-    def _extract_figure_elements_indices(instances) -> List[List[int]]:
-        if instances:
-            return [[int(e.rsplit("/", 1)[-1]) for e in instance.elements]
-                    for instance in instances if instance.elements]
-        else:
-            return []
+    def _paragraph_owners(result: "AnalyzeResult") -> List[int]:
+        """Index of the table containing every paragraph, ``_FIGURE_PARAGRAPH`` or ``_PLAIN_PARAGRAPH``."""
+        num_paragraphs = len(result.paragraphs or [])
+        owners = [_PLAIN_PARAGRAPH] * num_paragraphs
 
-    def read(self, pdf_bytes) -> AnalyzeResult:
-        poller = self.document_intelligence_client.begin_analyze_document(
-            "prebuilt-read",
-            json={"base64Source": binascii.b2a_base64(pdf_bytes).decode()}
-        )
-        delay = 30
-        max_delay = 3840
-        while not poller.done() and delay < max_delay:
-            time.sleep(delay)
-            delay *= 2
-        result = poller.result()
-        return result
+        def paragraph_indices(elements):
+            for e in elements or []:
+                if e.startswith("/paragraphs/"):
+                    i = int(e[len("/paragraphs/"):])
+                    if i < num_paragraphs:
+                        yield i
 
-    def layout(self, pdf_bytes) -> AnalyzeResult:
-        poller = self.document_intelligence_client.begin_analyze_document(
-            "prebuilt-layout",
-            json={"base64Source": binascii.b2a_base64(pdf_bytes).decode()}
-        )
-        delay = 30
-        max_delay = 3840
-        while not poller.done() and delay < max_delay:
-            time.sleep(delay)
-            delay *= 2
-        result = poller.result()
+        for figure in result.figures or []:
+            for i in paragraph_indices(figure.get("elements")):
+                owners[i] = _FIGURE_PARAGRAPH
+        for table_idx, table in enumerate(result.tables or []):
+            for cell in table["cells"]:
+                for i in paragraph_indices(cell.get("elements")):
+                    owners[i] = table_idx
+        return owners
+
+    def _analyze(self, model_id: str, pdf_bytes) -> "AnalyzeResult":
+        start = time.monotonic()
+        delay = self.poll_interval
+        # a stage of its own rather than a call, the analysis is not an LLM call and polls without retrying
+        with tracer.stage(f"extraction:{model_id}"):
+            poller = self.document_intelligence_client.begin_analyze_document(
+                model_id,
+                analyze_request=io.BytesIO(pdf_bytes),
+                content_type="application/octet-stream",
+            )
+            while not poller.done():
+                if time.monotonic() - start > self.timeout:
+                    raise TimeoutError(f"{model_id} analysis did not finish within {self.timeout} seconds")
+                time.sleep(delay)
+                tracer.record_sleep(delay)
+                delay = min(delay * 1.5, self.max_poll_interval)
+            result = poller.result()
+        logger.info(f"[Extraction] {model_id} finished in {time.monotonic() - start:.1f}s")
         return result
 
+    def read(self, pdf_bytes) -> "AnalyzeResult":
+        return self._analyze("prebuilt-read", pdf_bytes)
+
+    def layout(self, pdf_bytes) -> "AnalyzeResult":
+        return self._analyze("prebuilt-layout", pdf_bytes)
+
     @staticmethod
     def _table_to_csv(table) -> List[List[str]]:
         # Initialize an empty list of lists to store the table data
@@ -111,3 +236,92 @@ class AzureDocumentIntelligenceExtractor:
     def _dump_table_into_csv(self, table) -> str:
         data = self._table_to_csv(table)
         return '\n'.join(', '.join(row) for row in data)
+
+
+class PdfiumTextExtractor:
+    """Extracts paragraphs locally from the text layer of born-digital PDFs.
+
+    Large files are spread over a process pool by page ranges. Pages without a text layer, e.g. scans, are
+    sent to ``AzureDocumentIntelligenceExtractor`` and spliced back in place.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, pages_per_task: int = 16, min_pages_for_pool: int = 32,
+                 fallback: Optional[Callable[[bytes], List[str]]] = None, use_fallback: bool = True):
+        """
+        Args:
+            max_workers: size of the process pool, defaults to the number of CPUs
+            pages_per_task: number of pages extracted by one pool task
+            min_pages_for_pool: smaller files are extracted in the calling process
+            fallback: extractor for pages without text, an ``AzureDocumentIntelligenceExtractor`` is created
+                on first use if not given
+            use_fallback: set to False to drop pages without text instead
+        """
+        self.max_workers = max_workers
+        self.pages_per_task = pages_per_task
+        self.min_pages_for_pool = min_pages_for_pool
+        self.fallback = fallback
+        self.use_fallback = use_fallback
+
+    def identity(self):
+        # the pool settings only change how fast pages are extracted, not what is extracted
+        if not self.use_fallback:
+            fallback = None
+        elif self.fallback is None:
+            fallback = {"extractor": AzureDocumentIntelligenceExtractor.__name__,
+                        "pages_per_chunk": DEFAULT_PAGES_PER_CHUNK}
+        else:
+            fallback = extractor_identity(self.fallback)
+        return {"extractor": type(self).__name__, "fallback": fallback}
+
+    def __call__(self, pdf_bytes) -> List[str]:
+        return list(self.stream(pdf_bytes))
+
+    @traced("extraction")
+    def stream(self, pdf_bytes) -> Iterator[str]:
+        """Yield paragraphs in document order, page range by page range."""
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            num_pages = len(pdf)
+            pdf.close()
+            if num_pages < self.min_pages_for_pool:
+                pages = _extract_text_pages(pdf_bytes, 0, num_pages)
+        # the lock is never held across a yield, a slow consumer must not stall the other threads
+        if num_pages < self.min_pages_for_pool:
+            yield from self._finalize(pdf_bytes, 0, pages)
+            return
+        ranges = [(start, min(start + self.pages_per_task, num_pages))
+                  for start in range(0, num_pages, self.pages_per_task)]
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            # workers are forked while submitting, holding the lock keeps them from copying pdfium mid-call
+            with _PDFIUM_LOCK:
+                futures = [executor.submit(_extract_text_pages, pdf_bytes, start, stop) for start, stop in ranges]
+            for (start, _), future in zip(ranges, futures):
+                yield from self._finalize(pdf_bytes, start, future.result())
+
+    def _finalize(self, pdf_bytes: bytes, start: int, pages: List[List[str]]) -> Iterator[str]:
+        empty_pages = [start + i for i, page in enumerate(pages) if not page]
+        if empty_pages and self.use_fallback:
+            logger.info(f"[Extraction] {len(empty_pages)} pages without text layer, falling back")
+            self._fill_from_fallback(pdf_bytes, pages, start, empty_pages)
+        for page in pages:
+            for paragraph in page:
+                yield replace_consecutive_newlines(paragraph)
+
+    def _fill_from_fallback(self, pdf_bytes: bytes, pages: List[List[str]], start: int, empty_pages: List[int]):
+        if self.fallback is None:
+            self.fallback = AzureDocumentIntelligenceExtractor()
+        # consecutive pages are sent together, so every run's paragraphs can be put back in place
+        runs = []
+        for page_index in empty_pages:
+            if runs and runs[-1][-1] == page_index - 1:
+                runs[-1].append(page_index)
+            else:
+                runs.append([page_index])
+        with _PDFIUM_LOCK:
+            src = pdfium.PdfDocument(pdf_bytes)
+            try:
+                subsets = [_subset_pdf(src, run) for run in runs]
+            finally:
+                src.close()
+        for run, subset in zip(runs, subsets):
+            pages[run[0] - start] = self.fallback(subset)
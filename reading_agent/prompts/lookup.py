@@ -1,5 +1,32 @@
+import re
+
+
+# Look-up and answer prompts are appended to the gist memory, a stable prefix that backends can cache and reuse
+# across the look-up, the answer and every follow-up question about the same document.
+prompt_gist_memory_template = """
+The following text is what you remembered from reading an article, page by page.
+
+Text:
+\"\"\"{}\"\"\"
+"""
+
+
+prompt_outline_memory_template = """
+The following text is an outline of an article, one line per page, from what you remembered reading it.
+
+Outline:
+\"\"\"{}\"\"\"
+"""
+
+
+prompt_candidate_pages_template = """
+What you remembered of the pages most related to the question:
+\"\"\"{}\"\"\"
+"""
+
+
 prompt_parallel_lookup_template = """
-The following text is what you remembered from reading an article and a multiple choice question related to it.
+Below is a multiple choice question related to the article.
 You may read 1 to 6 page(s) of the article again to refresh your memory to prepare yourselve for the question.
 Please respond with which page(s) you would like to read.
 For example, if your only need to read Page 8, respond with \"I want to look up Page [8] to ...\";
@@ -9,28 +36,53 @@ if your would like to read Page 3, 4, 5, 12, 13 and 16, respond with \"I want to
 DO NOT select more pages if you don't need to.
 DO NOT answer the question yet.
 
+Question:
+{}
+
+Take a deep breath and tell me: Which page(s) would you like to read again?
+"""
+
+
+prompt_section_memory_template = """
+The following text is what you remembered from reading an article, section by section.
+
 Text:
 \"\"\"{}\"\"\"
+"""
+
+
+prompt_section_lookup_template = """
+Below is a question related to the article.
+You may open 1 to {} section(s) of the article to recall them in more detail before answering the question.
+Please respond with which section(s) you would like to open.
+For example, if you only need to open Section 2, respond with \"I want to open Section [2] to ...\";
+if you would like to open Section 0 and 5, respond with \"I want to open Section [0, 5] to ...\".
+DO NOT select more sections if you don't need to.
+DO NOT answer the question yet.
 
 Question:
 {}
 
-Take a deep breath and tell me: Which page(s) would you like to read again?
+Take a deep breath and tell me: Which section(s) would you like to open?
+"""
+
+
+prompt_sequential_reread_template = """
+You read the following page(s) of the article again in full:
+\"\"\"{}\"\"\"
 """
 
 
 prompt_sequential_lookup_template = """
-The following text is what you remember from reading a meeting transcript, followed by a question about the transcript. 
-You may read multiple pages of the transcript again to refresh your memory and prepare to answer the question. 
-Each page that you re-read can significantly im- prove your chance of answering the question correctly. 
-Please specify a SINGLE page you would like to read again or say "STOP". 
-To read a page again, respond with “Page $PAGE_NUM”, replacing $PAGE_NUM with the tar- get page number. 
-You can only specify a SINGLE page in your response at this time. To stop, simply say “STOP”. 
+Below is a question related to the article.
+You may read multiple pages of the article again to refresh your memory and prepare to answer the question.
+Each page that you re-read can significantly improve your chance of answering the question correctly.
+Please specify a SINGLE page you would like to read again or say "STOP".
+To read a page again, respond with “Page $PAGE_NUM”, replacing $PAGE_NUM with the target page number.
+You can only specify a SINGLE page in your response at this time. To stop, simply say “STOP”.
 DO NOT answer the question in your response.
 
-Text:
-\"\"\"{}\"\"\"
-Pages re-read already (DO NOT ask to read them again): {LIST OF PAGE NUMBERS ALREADY READ}
+Pages re-read already (DO NOT ask to read them again): {}
 Question:
 {}
 Specify a SINGLE page to read again, or say STOP:
@@ -38,13 +90,46 @@ Specify a SINGLE page to read again, or say STOP:
 
 
 prompt_answer_template = """
-Read the following article and answer a question.
-
-Article:
+You read the following page(s) of the article again in full:
 \"\"\"{}\"\"\"
 
+Answer a question about the article.
+
 Question:
 {}
 
 Answer:
 """
+
+
+prompt_batch_answer_template = """
+You read the following page(s) of the article again in full:
+\"\"\"{}\"\"\"
+
+Answer the numbered questions about the article.
+Answer every question separately, starting each answer on a new line with \"Answer <question number>:\".
+
+Questions:
+{}
+
+Answers:
+"""
+
+
+def parse_sequential_page(response, num_pages):
+    """The page requested in a sequential look-up step, None to stop or if no valid page is named."""
+    match = re.search(r"Page\s*(\d+)", response, flags=re.IGNORECASE)
+    if match is None or int(match.group(1)) >= num_pages:
+        return None
+    return int(match.group(1))
+
+
+def parse_batch_answers(text, num_questions):
+    """Map the 0-based index of every question answered in ``text`` to its answer."""
+    answers = {}
+    parts = re.split(r"^\s*Answer\s*(\d+)\s*:", text, flags=re.MULTILINE)
+    for number, answer in zip(parts[1::2], parts[2::2]):
+        index = int(number) - 1
+        if 0 <= index < num_questions and index not in answers:
+            answers[index] = answer.strip()
+    return answers
@@ -0,0 +1,126 @@
+import logging
+import re
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+Embed = Callable[[List[str]], np.ndarray]
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class RetrievalIndex:
+    """BM25 index over the pages of a document, optionally fused with embedding similarity.
+
+    Postings are stored term by term in flat arrays holding the precomputed BM25 weight of every (term, page)
+    pair, so scoring a query is a single ``np.bincount`` over the postings of its terms.
+    """
+
+    def __init__(self, vocabulary: Dict[str, int], indptr: np.ndarray, page_ids: np.ndarray, weights: np.ndarray,
+                 num_pages: int, embeddings: Optional[np.ndarray] = None, embed: Optional[Embed] = None):
+        """
+        Args:
+            vocabulary: term to term id
+            indptr: postings of term ``t`` are ``indptr[t]:indptr[t + 1]``
+            page_ids: page of every posting
+            weights: BM25 weight of every posting
+            num_pages: number of indexed pages
+            embeddings: one L2-normalized row per page
+            embed: embeds query texts into the space of ``embeddings``
+        """
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.page_ids = page_ids
+        self.weights = weights
+        self.num_pages = num_pages
+        self.embeddings = embeddings
+        self.embed = embed
+
+    @classmethod
+    def build(cls, texts: List[str], k1: float = 1.5, b: float = 0.75,
+              embed: Optional[Embed] = None) -> "RetrievalIndex":
+        """Index ``texts``, one per page, embedding them with ``embed`` if given."""
+        counts = [Counter(tokenize(text)) for text in texts]
+        lengths = np.array([sum(c.values()) for c in counts], dtype=np.float64)
+        average_length = lengths.mean() if len(texts) and lengths.mean() > 0 else 1.0
+
+        postings: Dict[str, List[int]] = {}
+        for page_id, c in enumerate(counts):
+            for term in c:
+                postings.setdefault(term, []).append(page_id)
+        vocabulary = {term: term_id for term_id, term in enumerate(postings)}
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(postings[term]) for term in vocabulary])
+        page_ids = np.array([p for term in vocabulary for p in postings[term]], dtype=np.int64)
+        frequencies = np.array([counts[p][term] for term in vocabulary for p in postings[term]], dtype=np.float64)
+
+        document_frequencies = np.diff(indptr).astype(np.float64)
+        idf = np.log1p((len(texts) - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        norms = k1 * (1 - b + b * lengths / average_length)
+        weights = np.repeat(idf, np.diff(indptr)) * frequencies * (k1 + 1) / (frequencies + norms[page_ids])
+
+        embeddings = cls._normalize(embed(texts)) if embed is not None and texts else None
+        return cls(vocabulary, indptr, page_ids, weights, len(texts), embeddings, embed)
+
+    @staticmethod
+    def _normalize(matrix: np.ndarray) -> np.ndarray:
+        matrix = np.asarray(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def bm25(self, query: str) -> np.ndarray:
+        term_ids = [self.vocabulary[t] for t in set(tokenize(query)) if t in self.vocabulary]
+        if not term_ids:
+            return np.zeros(self.num_pages)
+        selected = np.concatenate([np.arange(self.indptr[t], self.indptr[t + 1]) for t in term_ids])
+        return np.bincount(self.page_ids[selected], weights=self.weights[selected], minlength=self.num_pages)
+
+    def scores(self, query: str, embedding_weight: float = 0.5) -> np.ndarray:
+        """BM25 scores, min-max scaled and averaged with cosine similarities if the index has embeddings."""
+        scores = self.bm25(query)
+        if self.embeddings is None or self.embed is None:
+            return scores
+        similarities = self.embeddings @ self._normalize(self.embed([query]))[0]
+        return (1 - embedding_weight) * self._scale(scores) + embedding_weight * self._scale(similarities)
+
+    @staticmethod
+    def _scale(scores: np.ndarray) -> np.ndarray:
+        low, high = scores.min(), scores.max()
+        return (scores - low) / (high - low) if high > low else np.zeros_like(scores)
+
+    def search(self, query: str, top_k: int, embedding_weight: float = 0.5) -> List[int]:
+        """Page ids of the ``top_k`` best matches, best first."""
+        scores = self.scores(query, embedding_weight)
+        top_k = min(top_k, self.num_pages)
+        if top_k <= 0:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        return [int(i) for i in best[np.argsort(-scores[best], kind="stable")]]
+
+    def to_artifact(self) -> Dict[str, Any]:
+        return {
+            "vocabulary": list(self.vocabulary),
+            "indptr": self.indptr.tolist(),
+            "page_ids": self.page_ids.tolist(),
+            "weights": self.weights.tolist(),
+            "num_pages": self.num_pages,
+            "embeddings": self.embeddings.tolist() if self.embeddings is not None else None,
+        }
+
+    @classmethod
+    def from_artifact(cls, artifact: Dict[str, Any], embed: Optional[Embed] = None) -> "RetrievalIndex":
+        embeddings = artifact.get("embeddings")
+        return cls(
+            {term: term_id for term_id, term in enumerate(artifact["vocabulary"])},
+            np.array(artifact["indptr"], dtype=np.int64),
+            np.array(artifact["page_ids"], dtype=np.int64),
+            np.array(artifact["weights"], dtype=np.float64),
+            artifact["num_pages"],
+            np.array(embeddings, dtype=np.float32) if embeddings is not None else None,
+            embed,
+        )
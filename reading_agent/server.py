@@ -0,0 +1,257 @@
+"""
+Headless HTTP API over the reading pipeline, for services calling it at high concurrency.
+
+    POST /documents/{document_id}/extract   PDF bytes as the body
+    POST /documents/{document_id}/read      {"backend": "gpt"}
+    POST /documents/{document_id}/ask       {"question": "...", "backend": "gpt"}
+    GET  /stats
+
+Everything is kept in an ``ArtifactStore`` under the same keys as the Gradio app and ``ingest``, so documents
+read by either are answered here without being read again.
+"""
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+from fastapi import FastAPI, HTTPException, Request
+from pydantic import BaseModel
+
+from reading_agent.agent import Agent
+from reading_agent.artifacts import ArtifactStore
+from reading_agent.backends.admission import AdmissionControl
+from reading_agent.backends.cache import ResponseCache
+from reading_agent.backends.instrumented import InstrumentedBackend
+from reading_agent.backends.registry import BACKEND_NAMES, get_backend
+from reading_agent.document import Document
+from reading_agent.metrics import tracer
+from reading_agent.retrieval import RetrievalIndex
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_DOCUMENT_ID = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+
+
+class Coalescer:
+    """Runs one computation per key at a time, every request for a key in flight awaits the same result.
+
+    The computation is shielded from its waiters, so a client going away does not cancel it for the others.
+    Failures are fanned out like results and the next request for the key starts over.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def run(self, key: Hashable, compute: Callable[[], Awaitable[T]]) -> T:
+        future = self._in_flight.get(key)
+        if future is None:
+            future = self._in_flight[key] = asyncio.ensure_future(compute())
+            future.add_done_callback(lambda done: self._in_flight.pop(key, None)
+                                     if self._in_flight.get(key) is done else None)
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._in_flight), "started": self.started, "coalesced": self.coalesced}
+
+
+class ReadRequest(BaseModel):
+    backend: str = "gpt"
+
+
+class AskRequest(BaseModel):
+    question: str
+    backend: str = "gpt"
+
+
+class ReadingService:
+    """Extraction, reading and question answering by document id, with identical requests coalesced.
+
+    Args:
+        store: where paragraphs, pages, gists and the id of every document are kept
+        extractor: blocking PDF extractor, run in a worker thread
+        response_cache: optional cache of backend responses
+        max_concurrent_calls: backend calls in flight at once over all requests and backends
+        pagination_workers: shards paginated concurrently per document
+        gisting_workers: pages gisted concurrently per document
+        index_top_k: only show the gists of the k best matching pages when answering, disabled if None
+        max_documents: read documents kept in memory for answering, and ids of documents whose reading keys
+            are remembered per backend
+    """
+
+    def __init__(self, store: ArtifactStore, extractor: Callable[[bytes], List[str]],
+                 response_cache: Optional[ResponseCache] = None, max_concurrent_calls: int = 16,
+                 pagination_workers: int = 1, gisting_workers: int = 8, index_top_k: Optional[int] = None,
+                 max_documents: int = 64):
+        self.store = store
+        self.extractor = extractor
+        self.response_cache = response_cache
+        self.admission = AdmissionControl(max_concurrent_calls)
+        self.pagination_workers = pagination_workers
+        self.gisting_workers = gisting_workers
+        self.index_top_k = index_top_k
+        self.max_documents = max_documents
+        self.coalescer = Coalescer()
+        self._readings: "OrderedDict[str, Tuple[Document, Optional[RetrievalIndex]]]" = OrderedDict()
+        # reading key of every document and backend, so questions do not hash the paragraphs again
+        self._reading_keys: "OrderedDict[Tuple[str, InstrumentedBackend], str]" = OrderedDict()
+
+    def backend(self, name: str) -> InstrumentedBackend:
+        if name not in BACKEND_NAMES:
+            raise HTTPException(400, f"Unknown backend {name}, expected one of {', '.join(BACKEND_NAMES)}")
+        return get_backend(name, self.response_cache, self.admission)
+
+    async def _paragraphs(self, document_id: str) -> List[str]:
+        entry = await asyncio.to_thread(self.store.load, "document", document_id)
+        if entry is None:
+            raise HTTPException(404, f"Document {document_id} has not been extracted")
+        artifact = await asyncio.to_thread(self.store.load, "paragraphs", entry["paragraphs_key"])
+        if artifact is None:
+            raise HTTPException(404, f"Paragraphs of document {document_id} are missing")
+        return artifact["paragraphs"]
+
+    def _reading_key(self, document_id: str, backend: InstrumentedBackend, paragraphs: List[str]) -> str:
+        key = ArtifactStore.reading_key(paragraphs, backend, max_workers=self.pagination_workers)
+        self._reading_keys[(document_id, backend)] = key
+        self._reading_keys.move_to_end((document_id, backend))
+        while len(self._reading_keys) > self.max_documents * len(BACKEND_NAMES):
+            self._reading_keys.popitem(last=False)
+        return key
+
+    async def extract(self, document_id: str, pdf_bytes: bytes) -> Dict[str, Any]:
+        paragraphs_key = await asyncio.to_thread(ArtifactStore.paragraphs_key, pdf_bytes, self.extractor)
+
+        async def compute():
+            artifact = await asyncio.to_thread(self.store.load, "paragraphs", paragraphs_key)
+            if artifact is None:
+                with tracer.document(document_id):
+                    artifact = {"paragraphs": await asyncio.to_thread(self.extractor, pdf_bytes)}
+                await asyncio.to_thread(self.store.save, "paragraphs", paragraphs_key, artifact)
+            await asyncio.to_thread(self.store.save, "document", document_id, {"paragraphs_key": paragraphs_key})
+            for cached in [cached for cached in self._reading_keys if cached[0] == document_id]:
+                del self._reading_keys[cached]
+            return {"document_id": document_id, "paragraphs": len(artifact["paragraphs"])}
+
+        # uploads of different files under the same id are not merged, the key holds the hash of the bytes
+        return await self.coalescer.run(("extract", document_id, paragraphs_key), compute)
+
+    async def read(self, document_id: str, backend_name: str) -> Dict[str, Any]:
+        backend = self.backend(backend_name)
+
+        async def compute():
+            paragraphs = await self._paragraphs(document_id)
+            key = self._reading_key(document_id, backend, paragraphs)
+            artifact = await asyncio.to_thread(self.store.load, "reading", key)
+            if artifact is not None:
+                return {"document_id": document_id, "pages": len(artifact["pages"]), "cached": True}
+            start = time.perf_counter()
+            with tracer.document(document_id):
+                pages = await Agent.apagination(paragraphs, backend, verbose=False,
+                                                max_workers=self.pagination_workers)
+                gists = await Agent.agisting(pages, backend, verbose=False, max_workers=self.gisting_workers)
+                index = await asyncio.to_thread(Agent.build_index, pages, gists)
+            document = Document.from_pages(pages, gists)
+            await asyncio.to_thread(self.store.save, "reading", key,
+                                    {"pages": pages, "gists": gists, "index": index.to_artifact()})
+            await asyncio.to_thread(self.store.save_document, "reading", key, document)
+            self._remember(key, document, index)
+            logger.info(f"[Server] Read {document_id} into {len(pages)} pages in {time.perf_counter() - start:.2f}s")
+            return {"document_id": document_id, "pages": len(pages), "cached": False}
+
+        return await self.coalescer.run(("read", document_id, backend_name), compute)
+
+    def _remember(self, key: str, document: Document, index: Optional[RetrievalIndex]):
+        self._readings[key] = (document, index)
+        self._readings.move_to_end(key)
+        while len(self._readings) > self.max_documents:
+            self._readings.popitem(last=False)
+
+    async def _reading(self, document_id: str,
+                       backend: InstrumentedBackend) -> Tuple[Document, Optional[RetrievalIndex]]:
+        key = self._reading_keys.get((document_id, backend))
+        if key is None:
+            key = self._reading_key(document_id, backend, await self._paragraphs(document_id))
+        else:
+            self._reading_keys.move_to_end((document_id, backend))
+        if key in self._readings:
+            self._readings.move_to_end(key)
+            return self._readings[key]
+        artifact = await asyncio.to_thread(self.store.load, "reading", key)
+        if artifact is None:
+            raise HTTPException(409, f"Document {document_id} has not been read with this backend")
+        document = await asyncio.to_thread(self.store.load_document, "reading", key) or \
+            Document.from_pages(artifact["pages"], artifact["gists"])
+        index = RetrievalIndex.from_artifact(artifact["index"]) if "index" in artifact else None
+        self._remember(key, document, index)
+        return document, index
+
+    async def ask(self, document_id: str, question: str, backend_name: str) -> Dict[str, Any]:
+        backend = self.backend(backend_name)
+        question = ' '.join(question.split())
+        if not question:
+            raise HTTPException(400, "Empty question")
+
+        async def compute():
+            document, index = await self._reading(document_id, backend)
+            start = time.perf_counter()
+            with tracer.document(document_id):
+                if self.index_top_k is not None and index is not None:
+                    answer = await Agent.aparallel_lookup(document.gists, document.pages, question, backend,
+                                                          verbose=False, index=index, top_k=self.index_top_k)
+                else:
+                    answer = await Agent.aparallel_lookup(document.gists, document.pages, question, backend,
+                                                          verbose=False)
+            return {"document_id": document_id, "question": question, "answer": answer,
+                    "latency": time.perf_counter() - start}
+
+        return await self.coalescer.run(("ask", document_id, backend_name, question), compute)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.coalescer.stats(), "llm_calls": self.admission.stats(),
+                "documents_in_memory": len(self._readings)}
+
+
+def create_app(service: ReadingService) -> FastAPI:
+    app = FastAPI(title="Reading Agent")
+
+    def check_id(document_id: str):
+        if not _DOCUMENT_ID.match(document_id):
+            raise HTTPException(400, "Document ids are 1 to 128 letters, digits, '_', '.' or '-'")
+
+    @app.post("/documents/{document_id}/extract")
+    async def extract(document_id: str, request: Request):
+        check_id(document_id)
+        pdf_bytes = await request.body()
+        if not pdf_bytes:
+            raise HTTPException(400, "Send the PDF as the request body")
+        return await service.extract(document_id, pdf_bytes)
+
+    @app.post("/documents/{document_id}/read")
+    async def read(document_id: str, body: ReadRequest):
+        check_id(document_id)
+        return await service.read(document_id, body.backend)
+
+    @app.post("/documents/{document_id}/ask")
+    async def ask(document_id: str, body: AskRequest):
+        check_id(document_id)
+        return await service.ask(document_id, body.question, body.backend)
+
+    @app.get("/stats")
+    async def stats():
+        return service.stats()
+
+    return app
+
+
+def serve(service: ReadingService, host: str = "127.0.0.1", port: int = 8000):
+    import uvicorn
+    logger.info(f"[Server] Serving the reading API on {host}:{port}")
+    uvicorn.run(create_app(service), host=host, port=port, log_level="info")
@@ -0,0 +1,94 @@
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
+
+from reading_agent.backends.base import BackendBase
+
+# runs of letters, digits in groups of up to three and single symbols, close to how BPE tokenizers split text
+_PIECE = re.compile(r"[^\W\d_]+|\d{1,3}|[^\w\s]|_")
+
+# share of the context window prompts are sized to, left for estimation error
+PROMPT_MARGIN = 0.9
+
+# frozen ratios are rounded up to this step, so the calibration of another process sizes the same pages
+SIZING_STEP = 0.05
+
+
+def count_pieces(text: str) -> int:
+    """Word pieces of ``text``, the backend independent part of the token estimate."""
+    return len(_PIECE.findall(text))
+
+
+class TokenEstimator:
+    """Fast local estimate of the tokens a backend bills for a text.
+
+    Tokens are estimated as word pieces times ``tokens_per_piece``, a ratio calibrated on every call from the
+    input tokens the backend reports, so prose and CSV tables are both estimated with the backend's own rate.
+    Pages, gist parts and re-read pages are sized with ``frozen`` estimators instead, so that reading the same
+    input again sends the same prompts, and hits the response cache, however the calibration moved since.
+    """
+
+    def __init__(self, tokens_per_piece: float = 1.15, smoothing: float = 0.1, max_snapshots: int = 4096):
+        self.tokens_per_piece = tokens_per_piece
+        self.smoothing = smoothing
+        self.max_snapshots = max_snapshots
+        self._snapshots: "OrderedDict[Hashable, TokenEstimator]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def estimate(self, text: str) -> int:
+        return self.from_pieces(count_pieces(text))
+
+    def from_pieces(self, pieces: int) -> int:
+        return math.ceil(pieces * self.tokens_per_piece)
+
+    def to_pieces(self, tokens: int) -> int:
+        """Most word pieces estimated at no more than ``tokens``."""
+        return int(tokens / self.tokens_per_piece)
+
+    def observe(self, text: str, input_tokens: int):
+        """Calibrate against the ``input_tokens`` the backend billed for a prompt ``text``."""
+        pieces = count_pieces(text)
+        if pieces <= 0 or input_tokens <= 0:
+            return
+        with self._lock:
+            self.tokens_per_piece += self.smoothing * (input_tokens / pieces - self.tokens_per_piece)
+
+    def frozen(self, *keys: Hashable) -> "TokenEstimator":
+        """Uncalibrated estimator sizing the prompts of the input identified by ``keys``.
+
+        The first key already given one keeps it, else the current ratio rounded up to ``SIZING_STEP`` is taken.
+        Every key is then given it, the ``max_snapshots`` most recently used are remembered.
+        """
+        with self._lock:
+            snapshot = next((self._snapshots[key] for key in keys if key in self._snapshots), None)
+            if snapshot is None:
+                ratio = math.ceil(round(self.tokens_per_piece / SIZING_STEP, 6)) * SIZING_STEP
+                snapshot = TokenEstimator(round(ratio, 6), smoothing=0.0, max_snapshots=0)
+            for key in keys:
+                self._snapshots[key] = snapshot
+                self._snapshots.move_to_end(key)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+        return snapshot
+
+
+_estimators: Dict[Tuple[str, str], TokenEstimator] = {}
+_estimators_lock = threading.Lock()
+
+
+def get_estimator(backend: BackendBase) -> TokenEstimator:
+    """The process-wide estimator of the model ``backend`` calls, created on first use."""
+    identity = backend.identity()
+    key = (str(identity.get("backend")), str(identity.get("model", "")))
+    with _estimators_lock:
+        estimator = _estimators.get(key)
+        if estimator is None:
+            estimator = _estimators[key] = TokenEstimator()
+    return estimator
+
+
+def prompt_tokens(backend: BackendBase) -> int:
+    """Estimated tokens a prompt may take so that it and the longest response fit the context window."""
+    return int((backend.context_window - backend.max_output_tokens) * PROMPT_MARGIN)
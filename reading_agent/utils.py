@@ -1,5 +1,7 @@
+import ast
+import hashlib
 import re
-from typing import List
+from typing import Any, Dict, List
 
 
 def count_words(text):
@@ -7,6 +9,17 @@ def count_words(text):
     return len(text.split())
 
 
+def document_id(paragraphs: List[str]) -> str:
+    """Short content hash identifying a document in logs and metrics."""
+    return hashlib.sha256("\n\n".join(paragraphs).encode("utf-8")).hexdigest()[:16]
+
+
+def extractor_identity(extractor: Any) -> Dict[str, Any]:
+    """Everything that determines the paragraphs ``extractor`` returns, its class and output-affecting settings."""
+    identity = getattr(extractor, "identity", None)
+    return identity() if callable(identity) else {"extractor": type(extractor).__name__}
+
+
 def encode_paragraphs(raw: str):
     return raw.split("\n\n")
 
@@ -24,7 +37,8 @@ def decode_gists(gists: List[str]) -> str:
 
 
 def encode_pages(raw: str):
-    return [eval(p.split(":", 1)[1].strip()) for p in raw.split("\n\n")]
+    # pages are shown as Python list literals, parsed without evaluating anything else
+    return [ast.literal_eval(p.split(":", 1)[1].strip()) for p in raw.split("\n\n")]
 
 
 def decode_pages(pages: List[List[str]]) -> str:
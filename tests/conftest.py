@@ -0,0 +1,55 @@
+import random
+import re
+
+import pytest
+
+from reading_agent.backends.mock import MockBackend
+
+_LABEL = re.compile(r"^<(\d+)>$", flags=re.MULTILINE)
+
+
+class WindowOnlyBackend(MockBackend):
+    """Mock choosing break points from the pagination window alone, ignoring the page before it.
+
+    Speculative shards and pages paginated again after an edit are shown another page before them than the
+    serial pagination, so only with such a model do they have to land exactly where it does. Every prompt is
+    kept in ``prompts``.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.prompts = []
+
+    def respond(self, prompt):
+        with self._lock:
+            self.prompts.append(prompt)
+        first = _LABEL.search(prompt)
+        if "Break point:" not in prompt or first is None:
+            return super().respond(prompt)
+        labels = _LABEL.findall(prompt)
+        rng = random.Random(f"{self.seed}:{prompt[first.start():]}")
+        label = labels[min(len(labels) - 1, int(len(labels) * rng.uniform(0.5, 1.0)))]
+        response = f"Break point: <{label}>\nBecause it ends a section."
+        return self._token_count(prompt), self._token_count(response), response
+
+    def count(self, marker: str) -> int:
+        """Prompts sent containing ``marker``."""
+        return sum(marker in prompt for prompt in self.prompts)
+
+
+@pytest.fixture
+def window_only_backend():
+    return WindowOnlyBackend
+
+
+@pytest.fixture
+def make_paragraphs():
+    """Deterministic paragraphs of prose, numbers and punctuation, 20 to 120 words each."""
+    def make(num_paragraphs: int, seed: int = 0):
+        rng = random.Random(seed)
+        vocabulary = ["the", "model", "reads", "pages", "of", "a", "long", "report,", "gist", "memory", "2024",
+                      "revenue", "grew", "by", "12.5%", "while", "costs", "fell.", "Section", "(see", "table)"]
+        return [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(20, 120)))
+                for _ in range(num_paragraphs)]
+
+    return make
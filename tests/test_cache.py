@@ -0,0 +1,46 @@
+import itertools
+
+from reading_agent.backends import cache as cache_module
+from reading_agent.backends.cache import CachedBackend, ResponseCache
+from reading_agent.backends.mock import MockBackend
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_the_ttl(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, "time", clock)
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), ttl_seconds=60)
+    cache.put("a", 10, "first")
+    clock.now += 59
+    assert cache.get("a") == (10, "first")
+    clock.now += 2
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(cache_module.time, "time", lambda: float(next(ticks)))
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"), max_entries=2)
+    cache.put("a", 1, "first")
+    cache.put("b", 2, "second")
+    assert cache.get("a") == (1, "first")
+    cache.put("c", 3, "third")
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == (1, "first")
+    assert cache.get("c") == (3, "third")
+
+
+def test_hits_report_no_billed_tokens(tmp_path):
+    backend = CachedBackend(MockBackend(), ResponseCache(str(tmp_path / "responses.sqlite")))
+    token_usage, response = backend.query_model("Question: what grew?\nAnswer:")
+    assert backend.query_model("Question: what grew?\nAnswer:") == (0, response)
+    assert backend.stats() == {"hits": 1, "misses": 1, "cached_tokens": token_usage}
@@ -0,0 +1,88 @@
+import pytest
+
+from reading_agent.document import Document
+from reading_agent.tokens import count_pieces
+from reading_agent.utils import count_words
+
+
+def assert_same(loaded: Document, document: Document):
+    assert list(loaded.paragraphs) == list(document.paragraphs)
+    assert list(loaded.pages) == list(document.pages)
+    assert list(loaded.gists) == list(document.gists)
+
+
+@pytest.mark.parametrize("pages, gists", [
+    ([], []),
+    ([["only paragraph"]], ["gist"]),
+    ([["first", "second"]], []),
+    ([["a", "b"], ["c"], ["ünïcode ✓"]], ["g0", "g1", "g2"]),
+])
+def test_save_and_load(tmp_path, pages, gists):
+    document = Document.from_pages(pages, gists)
+    path = str(tmp_path / "document.bin")
+    document.save(path)
+    loaded = Document.load(path)
+    assert_same(loaded, document)
+    assert_same(Document.from_buffer(loaded.to_bytes()), document)
+
+
+def test_paragraphs_without_pages_round_trip():
+    document = Document.from_paragraphs(["a", "b"])
+    loaded = Document.from_buffer(document.to_bytes())
+    assert list(loaded.paragraphs) == ["a", "b"]
+    assert len(loaded.pages) == 0
+
+
+PARAGRAPHS = [
+    "",
+    "one",
+    "  leading and trailing spaces  ",
+    "tabs\tand\x0bvertical\x0cfeeds\rand\x1cfile\x1dgroup\x1erecord\x1funit separators",
+    "numbers 1234567 3.14159 and 2024-10-18, symbols (a+b)*c != d_e",
+    "ünïcode wörds, non breaking spaces and 数字一二三",
+    "CSV,row,with,,empty,cells;\"quoted\"",
+    "x" * 1000,
+]
+
+
+def test_word_counts_match_count_words():
+    document = Document.from_paragraphs(PARAGRAPHS)
+    assert document._word_counts().tolist() == [count_words(p) for p in PARAGRAPHS]
+    assert Document.from_paragraphs(["a"])._word_counts().tolist() == [1]
+    assert Document.from_paragraphs([])._word_counts().tolist() == []
+
+
+def test_pagination_windows_match_word_counts():
+    document = Document.from_paragraphs(PARAGRAPHS * 3)
+    counts = [count_words(p) for p in PARAGRAPHS * 3]
+    for i in range(len(counts)):
+        for limit in (1, 5, 40, 10_000):
+            end = document.window_end(i, limit)
+            assert end == len(counts) or sum(counts[i:end]) >= limit
+            assert sum(counts[i:end - 1]) < limit
+
+
+def test_piece_counts_match_count_pieces():
+    document = Document.from_paragraphs(PARAGRAPHS)
+    assert document._piece_counts().tolist() == [count_pieces(p) for p in PARAGRAPHS]
+    assert document.length(0, len(PARAGRAPHS), "pieces") == sum(count_pieces(p) for p in PARAGRAPHS)
+    assert Document.from_paragraphs([])._piece_counts().tolist() == []
+    assert Document.from_paragraphs([""])._piece_counts().tolist() == [0]
+
+
+@pytest.mark.parametrize("head, tail", [
+    ([], ["a"]),
+    (["a b"], []),
+    (["a b", ""], ["", "c 123"]),
+    (PARAGRAPHS[:3], PARAGRAPHS[3:]),
+])
+def test_extend_matches_the_whole_document(head, tail):
+    document = Document.from_paragraphs(head)
+    document.prefix("words"), document.prefix("pieces")
+    extended = document.extend(tail)
+    whole = Document.from_paragraphs(head + tail)
+    assert list(extended.paragraphs) == head + tail
+    assert extended.word_prefix.tolist() == whole.word_prefix.tolist()
+    assert extended.piece_prefix.tolist() == whole.piece_prefix.tolist()
+    assert extended.digest() == whole.digest()
+    assert_same(Document.from_buffer(extended.to_bytes()), whole)
@@ -0,0 +1,46 @@
+from reading_agent.agent import Agent
+from reading_agent.artifacts import ArtifactStore
+from reading_agent.ingest import Ingestor
+
+
+class TextExtractor:
+    """Stands in for a PDF extractor, the test files hold their paragraphs as plain text."""
+
+    def __call__(self, pdf_bytes):
+        return pdf_bytes.decode("utf-8").split("\n\n")
+
+
+def test_ingestion_resumes_gisting_from_its_checkpoint(tmp_path, make_paragraphs, window_only_backend):
+    documents = tmp_path / "documents"
+    documents.mkdir()
+    paragraphs = make_paragraphs(120)
+    (documents / "report.pdf").write_text("\n\n".join(paragraphs))
+    store = ArtifactStore(str(tmp_path / "artifacts"))
+    backend = window_only_backend(seed=14, max_output_tokens=256)
+    respond = backend.respond
+
+    def fail_from_third_batch(prompt):
+        if backend.count("Please shorten the following passage") >= 8:
+            raise RuntimeError("backend went away")
+        return respond(prompt)
+
+    backend.respond = fail_from_third_batch
+    ingest = Ingestor(TextExtractor(), backend, store, gisting_workers=1, gisting_batch_size=4)
+    summary = ingest(str(documents), summary_path=str(tmp_path / "summary.json"))
+    assert summary["failed"] == 1
+
+    backend.respond = respond
+    backend.prompts.clear()
+    summary = ingest(str(documents), summary_path=str(tmp_path / "summary.json"))
+    assert summary["processed"] == 1
+    pages = Agent.pagination(paragraphs, window_only_backend(seed=14, max_output_tokens=256), verbose=False)
+    # the pages and the first two batches of gists are not asked for again
+    assert backend.count("Break point:") == 0
+    assert backend.count("Please shorten the following passage") == len(pages) - 8
+    reading_key = ArtifactStore.reading_key(paragraphs, backend, max_workers=1)
+    reading = store.load("reading", reading_key)
+    assert reading["pages"] == pages
+    assert reading["gists"] == Agent.gisting(pages, window_only_backend(seed=14, max_output_tokens=256), verbose=False)
+
+    summary = ingest(str(documents), summary_path=str(tmp_path / "summary.json"))
+    assert summary["skipped"] == 1
@@ -0,0 +1,149 @@
+import asyncio
+import re
+import threading
+
+import pytest
+
+from reading_agent.agent import Agent, LookupStrategySelector
+from reading_agent.backends.instrumented import InstrumentedBackend
+from reading_agent.backends.mock import MockBackend
+from reading_agent.metrics import Tracer
+
+
+class TokenCountingBackend(MockBackend):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.total_tokens = 0
+        self._count_lock = threading.Lock()
+
+    def query_model(self, prompt, cache_prefix=None, **kwargs):
+        token_usage, response = super().query_model(prompt, cache_prefix, **kwargs)
+        with self._count_lock:
+            self.total_tokens += token_usage
+        return token_usage, response
+
+
+def test_grouped_answer_tokens_add_up_to_the_calls(make_paragraphs):
+    paragraphs = make_paragraphs(40)
+    pages = [paragraphs[i:i + 5] for i in range(0, len(paragraphs), 5)]
+    gists = [' '.join(page)[:200] for page in pages]
+    questions = [f"What happened in section {i}?" for i in range(12)]
+    shared = 0
+    for seed in range(16):
+        backend = TokenCountingBackend(seed=seed)
+        results = Agent.batch_lookup(gists, pages, questions, backend, group_answers=True)
+        shared += any(result.shared_with > 1 for result in results)
+        assert sum(result.token_usage for result in results) == backend.total_tokens
+    assert shared
+
+
+def test_duplicate_questions_split_their_tokens(make_paragraphs):
+    paragraphs = make_paragraphs(40)
+    pages = [paragraphs[i:i + 5] for i in range(0, len(paragraphs), 5)]
+    gists = [' '.join(page)[:200] for page in pages]
+    questions = ["what grew?", "what  grew?", "who reads?"]
+    for group_answers in (False, True):
+        backend = TokenCountingBackend()
+        results = Agent.batch_lookup(gists, pages, questions, backend, group_answers=group_answers)
+        assert [result.question for result in results] == questions
+        assert results[0].answer == results[1].answer
+        assert results[0].shared_with == results[1].shared_with >= 2
+        assert results[0].token_usage >= results[1].token_usage
+        assert sum(result.token_usage for result in results) == backend.total_tokens
+
+
+def test_follow_up_questions_hit_the_prefix_cache(make_paragraphs):
+    paragraphs = make_paragraphs(40)
+    pages = [paragraphs[i:i + 5] for i in range(0, len(paragraphs), 5)]
+    gists = [' '.join(page)[:200] for page in pages]
+    backend = MockBackend()
+    Agent.parallel_lookup(gists, pages, "What grew last quarter?", backend, verbose=False)
+    Agent.parallel_lookup(gists, pages, "And what shrank?", backend, verbose=False)
+    # the look-up, its answer and both calls of the follow-up all start with the same gist memory
+    assert backend.calls == 4
+    assert backend.prefix_misses == 1
+    assert backend.prefix_hits == 3
+
+
+def test_async_lookup_matches_the_blocking_one(make_paragraphs):
+    paragraphs = make_paragraphs(40)
+    pages = [paragraphs[i:i + 5] for i in range(0, len(paragraphs), 5)]
+    gists = [' '.join(page)[:200] for page in pages]
+    for seed in range(4):
+        question = f"What happened in section {seed}?"
+        answer = Agent.parallel_lookup(gists, pages, question, MockBackend(seed=seed), verbose=False)
+        assert asyncio.run(Agent.aparallel_lookup(gists, pages, question, MockBackend(seed=seed),
+                                                  verbose=False)) == answer
+
+
+def test_memory_overrunning_the_context_window_is_looked_up_by_section(make_paragraphs):
+    backend = MockBackend(context_window=2048, max_output_tokens=256)
+    paragraphs = make_paragraphs(150)
+    pages = Agent.pagination(paragraphs, backend, verbose=False)
+    gists = Agent.gisting(pages, backend, verbose=False)
+    assert not Agent.memory_fits(gists, backend)
+    with pytest.raises(ValueError, match="gist_tree"):
+        Agent.lookup(gists, pages, "What grew?", backend, verbose=False)
+    tree = Agent.gist_tree(gists, backend, verbose=False)
+    selector = LookupStrategySelector()
+    result = Agent.lookup(gists, pages, "What grew?", backend, strategy=selector, verbose=False, tree=tree)
+    assert result.strategy == "hierarchical"
+    assert result.answer
+    assert "".join(Agent.stream_lookup(gists, pages, "What grew?", backend, verbose=False, tree=tree)) == result.answer
+
+
+def test_streamed_answers_match_the_blocking_ones_and_report_their_tokens(make_paragraphs):
+    paragraphs = make_paragraphs(40)
+    pages = [paragraphs[i:i + 5] for i in range(0, len(paragraphs), 5)]
+    gists = [' '.join(page)[:200] for page in pages]
+    question = "What grew last quarter?"
+    result = Agent.lookup(gists, pages, question, MockBackend(), verbose=False)
+
+    backend = TokenCountingBackend()
+    stream = Agent.stream_lookup(gists, pages, question, backend, verbose=False)
+    deltas = []
+    while True:
+        try:
+            deltas.append(next(stream))
+        except StopIteration as stop:
+            streamed = stop.value
+            break
+    assert len(deltas) > 1
+    assert "".join(deltas) == streamed.answer == result.answer
+    assert streamed.token_usage == result.token_usage == backend.total_tokens
+
+    # the streamed call is traced with the usage of the whole call
+    blocking, streaming = Tracer(), Tracer()
+    answer = Agent.parallel_lookup(gists, pages, question, InstrumentedBackend(MockBackend(), blocking),
+                                   verbose=False)
+    assert "".join(Agent.stream_parallel_lookup(gists, pages, question,
+                                                InstrumentedBackend(MockBackend(), streaming),
+                                                verbose=False)) == answer
+    total = 'llm_tokens_total{stage="lookup",backend="MockBackend",kind="total"}'
+    assert streaming.process_summary()[total] == blocking.process_summary()[total] == result.token_usage
+
+
+def test_gist_tree_levels_and_sections_opened(make_paragraphs, window_only_backend):
+    paragraphs = make_paragraphs(70)
+    pages = [[paragraph] for paragraph in paragraphs]
+    gists = [' '.join(paragraph.split()[:20]) for paragraph in paragraphs]
+    backend = window_only_backend(seed=17)
+    tree = Agent.gist_tree(gists, backend, branching=4, verbose=False)
+    assert [len(level) for level in tree.levels] == [70, 18, 5, 2]
+    assert tree.levels[0] == gists
+
+    backend.prompts.clear()
+    assert Agent.hierarchical_lookup(tree, pages, "What grew?", backend, max_sections=2, verbose=False)
+    section_prompts = [prompt for prompt in backend.prompts if "would you like to open" in prompt]
+    page_prompt = next(prompt for prompt in backend.prompts if "would you like to read again" in prompt)
+    assert len(section_prompts) == len(tree.levels) - 1
+    shown = [[int(i) for i in re.findall(r'^(?:""")?<Section (\d+)>', prompt, flags=re.MULTILINE)]
+             for prompt in section_prompts]
+    shown.append([int(i) for i in re.findall(r'^(?:""")?<Page (\d+)>', page_prompt, flags=re.MULTILINE)])
+    assert shown[0] == list(range(len(tree.levels[-1])))
+    # below the top, only the entries of at most two sections opened one level up are shown, all of them
+    for level, entries in zip(range(len(tree.levels) - 1, 0, -1), shown[1:]):
+        opened = sorted({entry // tree.branching for entry in entries})
+        assert 1 <= len(opened) <= 2
+        assert set(opened) <= set(shown[len(tree.levels) - 1 - level])
+        assert entries == [child for i in opened for child in tree.children(level, i)]
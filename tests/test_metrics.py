@@ -0,0 +1,12 @@
+from reading_agent.metrics import Tracer
+
+
+def test_only_the_most_recent_documents_are_kept():
+    tracer = Tracer(max_documents=2)
+    for document in ["a", "b", "a", "c"]:
+        with tracer.document(document), tracer.stage("reading"):
+            pass
+    assert list(tracer.documents) == ["a", "c"]
+    assert tracer.document_summary("b") == {}
+    assert tracer.document_summary("a")['stage_latency_seconds{stage="reading"}']["count"] == 2
+    assert tracer.process_summary()['stage_latency_seconds{stage="reading"}']["count"] == 4
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from reading_agent.agent import Agent
+from reading_agent.backends.mock import MockBackend
+
+
+@pytest.mark.parametrize("num_paragraphs", [1, 7, 60, 300])
+@pytest.mark.parametrize("word_limit", [None, 600])
+def test_sharded_pagination_matches_serial(make_paragraphs, window_only_backend, num_paragraphs, word_limit):
+    paragraphs = make_paragraphs(num_paragraphs, seed=num_paragraphs)
+    backend = window_only_backend(seed=2)
+    serial = Agent.pagination(paragraphs, backend, word_limit=word_limit, verbose=False)
+    assert [p for page in serial for p in page] == paragraphs
+    for max_workers in (2, 4, 8):
+        assert Agent.pagination(paragraphs, backend, word_limit=word_limit, verbose=False,
+                                max_workers=max_workers) == serial
+        assert asyncio.run(Agent.apagination(paragraphs, backend, word_limit=word_limit, verbose=False,
+                                             max_workers=max_workers)) == serial
+
+
+def test_hard_boundaries_split_at_the_shard_starts(make_paragraphs):
+    paragraphs = make_paragraphs(120)
+    pages = Agent.pagination(paragraphs, MockBackend(seed=2), word_limit=600, verbose=False, max_workers=4,
+                             max_divergence=None)
+    assert [p for page in pages for p in page] == paragraphs
+    starts = set(Agent._shard_starts(len(paragraphs), 4))
+    ends = {sum(len(page) for page in pages[:k + 1]) for k in range(len(pages))}
+    assert starts <= ends | {0}
+
+
+@pytest.mark.parametrize("word_limit", [None, 600])
+def test_paginating_a_stream_matches_the_whole_document(make_paragraphs, word_limit):
+    paragraphs = make_paragraphs(150, seed=8)
+    read = []
+
+    def extract():
+        for paragraph in paragraphs:
+            read.append(paragraph)
+            yield paragraph
+
+    backend = MockBackend(seed=8)
+    pages = Agent.iter_pagination(extract(), backend, word_limit=word_limit, verbose=False)
+    first_page = next(pages)
+    # the first page is chosen long before the last paragraph is extracted
+    assert len(read) < len(paragraphs) // 2
+    streamed = [first_page] + list(pages)
+    assert streamed == Agent.pagination(paragraphs, backend, word_limit=word_limit, verbose=False)
+    reading = list(Agent.stream_reading(iter(paragraphs), backend, word_limit=word_limit, verbose=False))
+    assert [page for page, _ in reading] == streamed
+    assert [gist for _, gist in reading] == Agent.gisting(streamed, backend, verbose=False)
+
+
+def test_paginating_an_empty_stream():
+    assert list(Agent.iter_pagination(iter([]), MockBackend(), verbose=False)) == []
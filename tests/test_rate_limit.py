@@ -0,0 +1,19 @@
+import time
+
+import pytest
+
+from reading_agent.backends.rate_limit import RateLimiter
+
+
+def test_failed_calls_return_their_reservation():
+    # a bucket of 100 tokens refilling in 10 seconds
+    limiter = RateLimiter("test", tokens_per_minute=600)
+
+    def fail():
+        raise ValueError("invalid request")
+
+    with pytest.raises(ValueError):
+        limiter.call(fail, 100, lambda e: False)
+    start = time.perf_counter()
+    assert limiter.call(lambda: "ok", 100, lambda e: False) == "ok"
+    assert time.perf_counter() - start < 1
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from reading_agent.agent import Agent
+from reading_agent.backends.mock import MockBackend
+
+
+@pytest.mark.parametrize("word_limit", [None, 600])
+@pytest.mark.parametrize("edited", [0, 100, 199])
+def test_editing_a_paragraph_only_gists_the_pages_it_touches(make_paragraphs, window_only_backend, word_limit,
+                                                            edited):
+    paragraphs = make_paragraphs(200)
+    backend = window_only_backend(seed=22)
+    pages = Agent.pagination(paragraphs, backend, word_limit=word_limit, verbose=False)
+    gists = Agent.gisting(pages, backend, verbose=False)
+    assert len(pages) > 4
+
+    paragraphs[edited] += " An added sentence."
+    backend.prompts.clear()
+    new_pages, new_gists = Agent.incremental_reading(paragraphs, pages, gists, backend, word_limit=word_limit,
+                                                     verbose=False)
+
+    # the model sees the same windows, so adopting the previous pages changes nothing but the calls made
+    assert new_pages == Agent.pagination(paragraphs, window_only_backend(seed=22), word_limit=word_limit,
+                                         verbose=False)
+    assert len(new_gists) == len(new_pages)
+    previous = {'\n'.join(page): gist for page, gist in zip(pages, gists)}
+    touched = [page for page in new_pages if '\n'.join(page) not in previous]
+    assert any(paragraphs[edited] in page for page in touched)
+    # the page with the edit, the page whose window reached into it, and the page after them
+    assert len(touched) <= 3
+    assert backend.count("Please shorten the following passage") == len(touched)
+    assert backend.count("Break point:") <= len(touched)
+    for page, gist in zip(new_pages, new_gists):
+        if '\n'.join(page) in previous:
+            assert gist == previous['\n'.join(page)]
+
+
+def test_concurrent_gisting_keeps_page_order(make_paragraphs):
+    paragraphs = make_paragraphs(60)
+    pages = [paragraphs[i:i + 3] for i in range(0, len(paragraphs), 3)]
+    serial = Agent.gisting(pages, MockBackend(), verbose=False)
+    # random latencies finish the pages out of order
+    backend = MockBackend(latency_median=0.005, latency_sigma=1.0)
+    assert Agent.gisting(pages, backend, verbose=False, max_workers=8) == serial
+    assert asyncio.run(Agent.agisting(pages, backend, verbose=False, max_workers=8)) == serial
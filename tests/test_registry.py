@@ -0,0 +1,42 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from reading_agent.backends import registry
+from reading_agent.backends.admission import AdmissionControl, AdmissionControlledBackend
+from reading_agent.backends.cache import CachedBackend, ResponseCache
+from reading_agent.backends.mock import MockBackend
+
+
+def test_backend_modules_are_imported_on_first_use():
+    script = (
+        "import sys\n"
+        "from reading_agent.backends.registry import get_backend\n"
+        "modules = ['reading_agent.backends.' + m for m in ('chatgpt', 'gemini', 'bedrock', 'mock')]\n"
+        "print([m in sys.modules for m in modules])\n"
+        "get_backend('mock')\n"
+        "print([m in sys.modules for m in modules])\n"
+    )
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            cwd=Path(__file__).resolve().parents[1]).stdout
+    assert output.splitlines() == ["[False, False, False, False]", "[False, False, False, True]"]
+
+
+def test_unknown_backend_names_are_rejected():
+    with pytest.raises(ValueError, match="Unknown backend claude"):
+        registry.get_backend("claude")
+    assert "claude" not in registry._backends
+
+
+def test_backends_are_shared_and_wrapped_once(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+    admission = AdmissionControl(2)
+    wrapped = registry.get_backend("mock", cache, admission)
+    assert registry.get_backend("mock", cache, admission) is wrapped
+    assert isinstance(wrapped.backend, CachedBackend)
+    assert isinstance(wrapped.backend.backend, AdmissionControlledBackend)
+    # every wrapping shares the one client of the backend
+    assert registry.get_backend("mock").backend is registry._backends["mock"]
+    assert isinstance(registry._backends["mock"], MockBackend)
@@ -0,0 +1,52 @@
+import math
+from collections import Counter
+
+import pytest
+
+from reading_agent.retrieval import RetrievalIndex, tokenize
+
+
+def reference_bm25(texts, query, k1=1.5, b=0.75):
+    counts = [Counter(tokenize(text)) for text in texts]
+    average_length = sum(sum(c.values()) for c in counts) / len(counts)
+    scores = []
+    for c in counts:
+        length = sum(c.values())
+        score = 0.0
+        for term in set(tokenize(query)):
+            frequency = c[term]
+            if not frequency:
+                continue
+            document_frequency = sum(term in other for other in counts)
+            idf = math.log1p((len(texts) - document_frequency + 0.5) / (document_frequency + 0.5))
+            score += idf * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * length / average_length))
+        scores.append(score)
+    return scores
+
+
+def test_bm25_ranks_pages_like_the_formula(make_paragraphs):
+    texts = make_paragraphs(30, seed=18)
+    texts[7] += " dividend dividend dividend"
+    texts[21] += " dividend"
+    index = RetrievalIndex.build(texts)
+    for query in ["dividend", "revenue grew", "Costs fell while revenue grew by 12.5%", "unknown words"]:
+        assert index.bm25(query).tolist() == pytest.approx(reference_bm25(texts, query))
+    assert index.search("dividend", 2) == [7, 21]
+    assert index.search("dividend revenue", 5)[:2] == [7, 21]
+
+
+def test_shorter_pages_rank_first_at_equal_frequency():
+    texts = ["budget " + "filler " * 5, "budget " + "filler " * 50, "nothing relevant here"]
+    index = RetrievalIndex.build(texts)
+    assert index.search("budget", 3) == [0, 1, 2]
+    assert index.search("budget", 10) == [0, 1, 2]
+    assert index.search("budget", 0) == []
+
+
+def test_index_artifact_round_trip(make_paragraphs):
+    texts = make_paragraphs(12, seed=1)
+    index = RetrievalIndex.build(texts)
+    restored = RetrievalIndex.from_artifact(index.to_artifact())
+    for query in ["gist memory", "Section table"]:
+        assert restored.bm25(query).tolist() == index.bm25(query).tolist()
+        assert restored.search(query, 4) == index.search(query, 4)
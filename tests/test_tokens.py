@@ -0,0 +1,39 @@
+from reading_agent.agent import Agent
+from reading_agent.backends.cache import CachedBackend, ResponseCache
+from reading_agent.backends.instrumented import InstrumentedBackend
+from reading_agent.backends.mock import MockBackend
+from reading_agent.tokens import SIZING_STEP, TokenEstimator, get_estimator
+
+
+def test_frozen_estimator_ignores_later_calibration():
+    estimator = TokenEstimator(tokens_per_piece=1.12)
+    frozen = estimator.frozen("document")
+    assert frozen.tokens_per_piece == 1.15
+    for _ in range(50):
+        estimator.observe("one two three four", 2)
+    assert estimator.tokens_per_piece < 1.15 - SIZING_STEP
+    assert estimator.frozen("document") is frozen
+    # an edited document keeps the snapshot of the document it was read from
+    assert estimator.frozen("document", "edited") is frozen
+    assert estimator.frozen("edited") is frozen
+    assert estimator.frozen("other").tokens_per_piece < frozen.tokens_per_piece
+
+
+def test_reading_again_only_hits_the_cache(tmp_path, make_paragraphs):
+    paragraphs = make_paragraphs(400)
+    cached = CachedBackend(MockBackend(seed=23), ResponseCache(str(tmp_path / "responses.sqlite")))
+    backend = InstrumentedBackend(cached)
+    estimator = get_estimator(backend)
+
+    pages = Agent.pagination(paragraphs, backend, verbose=False)
+    gists = Agent.gisting(pages, backend, verbose=False)
+    calibrated = estimator.tokens_per_piece
+    assert len(pages) > 2
+    misses = cached.misses
+
+    assert Agent.pagination(paragraphs, backend, verbose=False) == pages
+    assert Agent.gisting(pages, backend, verbose=False) == gists
+    assert cached.misses == misses
+    assert cached.hits == misses
+    # the calibration did move, only the sizing of this document stayed put
+    assert abs(calibrated - 1.15) > SIZING_STEP